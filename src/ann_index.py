@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+import json
+from shutil import rmtree
+
+import numpy as np
+
+import array_store
+import embedding_ops
+
+
+_META_FILENAME      = 'Index.json'
+_CENTROIDS_FILENAME = 'Centroids.npy'
+_LISTS_FILENAME     = 'Lists.npy'
+_IDS_FILENAME       = 'Ids.npy'
+
+# Metrics of DeepFace.verify. Embeddings are normalized for all but euclidean, all three then
+# rank neighbours in the same order.
+METRICS = ['cosine', 'euclidean', 'euclidean_l2']
+
+# The number of lists grows with the square root of the number of embeddings, and k-means is
+# trained on a sample of this many embeddings per list.
+_LISTS_PER_SQRT_ROWS   = 4
+_TRAIN_ROWS_PER_LIST   = 64
+_KMEANS_ITERATIONS     = 20
+# Embeddings appended after training are added to the nearest list, until there are this many
+# times more of them than the index was trained on and the lists are trained again.
+_RETRAIN_GROWTH        = 4
+
+
+
+class IVFIndex:
+    # Inverted file index over the rows of the embeddings store: embeddings are assigned to the
+    # list of their nearest k-means centroid, and a query is only compared to the embeddings of
+    # the n_probe lists whose centroids are nearest to it. The index stores the list and face id
+    # of each row, the embeddings themselves are read from the memory-mapped store.
+
+    def __init__(self, index_dir, metric, chunk_size = 4096):
+        self.index_dir  = index_dir
+        self.metric     = metric
+        self.chunk_size = chunk_size
+        self.centroids  = None
+        self.n_trained  = 0
+        self._lists     = None
+        self._ids       = None
+
+        meta = _load_meta(index_dir)
+        if meta is not None and meta['metric'] == metric:
+            self.centroids = np.load(index_dir / _CENTROIDS_FILENAME)
+            self.n_trained = meta['n_trained']
+            self._lists    = array_store.AppendableArray(index_dir / _LISTS_FILENAME, np.int32, ())
+            self._ids      = array_store.AppendableArray(index_dir / _IDS_FILENAME, np.int64, ())
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+    @property
+    def n_rows(self):
+        return min(self._lists.n_rows, self._ids.n_rows) if self._lists is not None else 0
+
+
+    def sync(self, ids, embeddings, seed = 0):
+        # Brings the index up to date with the embeddings store: rows appended since the last sync
+        # are added to their nearest list, and the index is built again from scratch if it does not
+        # exist yet, if rows were deleted from the store or if it grew too much since training.
+        # Returns the number of rows added.
+        if not len(ids):
+            return 0
+
+        n_rows = self.n_rows
+        stale  = (self.centroids is None
+                  or n_rows > len(ids)
+                  or not np.array_equal(self._ids.read()[:n_rows], ids[:n_rows])
+                  or len(ids) > _RETRAIN_GROWTH * max(self.n_trained, 1))
+
+        if stale:
+            self._train(embeddings, seed)
+            n_rows = 0
+
+        # Lists are committed after ids, so a row is only counted once it has both.
+        self._lists.truncate(n_rows)
+        self._ids.truncate(n_rows)
+        for rows in embedding_ops.iter_chunks(len(ids) - n_rows, self.chunk_size):
+            rows = slice(rows.start + n_rows, rows.stop + n_rows)
+            self._ids.append(ids[rows])
+            self._lists.append(self._assign(self._load_chunk(embeddings, rows)))
+            self._ids.commit()
+            self._lists.commit()
+
+        return len(ids) - n_rows
+
+
+    def search(self, queries, embeddings, k, n_probe, max_distance = None):
+        # Returns, for each query, the (face id, distance) pairs of its k nearest embeddings among
+        # the n_probe nearest lists, sorted by distance and within max_distance if given.
+        if self.centroids is None:
+            return [[] for _ in queries]
+
+        queries = self._normalize(np.asarray(queries, dtype = np.float32))
+        lists   = self._lists.read()[:self.n_rows]
+        ids     = self._ids.read()[:self.n_rows]
+        probes, _ = embedding_ops.knn(queries, self.centroids, n_probe, self.chunk_size)
+
+        results = []
+        for query, query_probes in zip(queries, probes):
+            rows = np.flatnonzero(np.isin(lists, query_probes))
+            if not len(rows):
+                results.append([])
+                continue
+
+            candidates = self._load_chunk(embeddings, rows)
+            neighbours, distances = embedding_ops.knn(query[np.newaxis], candidates, k, self.chunk_size)
+            distances  = self._to_metric(distances[0])
+            keep       = distances <= max_distance if max_distance is not None else slice(None)
+            results.append(list(zip(ids[rows[neighbours[0]]][keep].tolist(), distances[keep].tolist())))
+
+        return results
+
+
+    def close(self):
+        for store in (self._lists, self._ids):
+            if store is not None:
+                store.close()
+
+
+    def _train(self, embeddings, seed):
+        # k-means on a random sample of the embeddings, which replaces any previous index.
+        self.close()
+        rmtree(self.index_dir, ignore_errors = True)
+        self.index_dir.mkdir(parents = True)
+
+        rng      = np.random.default_rng(seed)
+        n_lists  = max(1, min(int(_LISTS_PER_SQRT_ROWS * np.sqrt(len(embeddings))), len(embeddings) // _TRAIN_ROWS_PER_LIST))
+        n_sample = min(len(embeddings), n_lists * _TRAIN_ROWS_PER_LIST)
+        sample   = self._load_chunk(embeddings, np.sort(rng.choice(len(embeddings), n_sample, replace = False)))
+
+        self.centroids = sample[rng.choice(n_sample, n_lists, replace = False)]
+        for _ in range(_KMEANS_ITERATIONS):
+            assignment = self._assign(sample)
+            counts     = np.bincount(assignment, minlength = n_lists)
+            sums       = np.zeros_like(self.centroids)
+            np.add.at(sums, assignment, sample)
+
+            # Empty lists are given a new random centroid.
+            empty = counts == 0
+            self.centroids[~empty] = sums[~empty] / counts[~empty, np.newaxis]
+            self.centroids[empty]  = sample[rng.choice(n_sample, empty.sum())]
+            self.centroids         = self._normalize(self.centroids)
+
+        self.n_trained = len(embeddings)
+        np.save(self.index_dir / _CENTROIDS_FILENAME, self.centroids)
+        self._lists = array_store.AppendableArray(self.index_dir / _LISTS_FILENAME, np.int32, ())
+        self._ids   = array_store.AppendableArray(self.index_dir / _IDS_FILENAME, np.int64, ())
+        with open(self.index_dir / _META_FILENAME, 'w') as file:
+            json.dump({'metric': self.metric, 'n_trained': self.n_trained, 'n_lists': n_lists}, file)
+
+
+    def _assign(self, points):
+        return embedding_ops.knn(points, self.centroids, 1, self.chunk_size)[0][:, 0].astype(np.int32)
+
+
+    def _load_chunk(self, embeddings, rows):
+        return self._normalize(np.asarray(embeddings[rows], dtype = np.float32))
+
+
+    def _normalize(self, points):
+        return points if self.metric == 'euclidean' else embedding_ops.l2_normalize(points)
+
+
+    def _to_metric(self, distances):
+        # Distances are euclidean, between normalized embeddings for cosine and euclidean_l2.
+        if self.metric == 'cosine':
+            return distances ** 2 / 2
+        return distances
+
+
+
+def sync_existing(index_dir, embeddings_path, embedding_ids_path):
+    # Adds new embeddings to the index if one was built, so that the next search does not have to.
+    meta = _load_meta(index_dir)
+    if meta is None or not embeddings_path.is_file():
+        return 0
+
+    ids, embeddings = array_store.open_embeddings(embeddings_path, embedding_ids_path)
+    with IVFIndex(index_dir, meta['metric']) as index:
+        return index.sync(ids, embeddings)
+
+
+
+def _load_meta(index_dir):
+    try:
+        with open(index_dir / _META_FILENAME) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+
+import os
+import struct
+
+import numpy as np
+
+
+_NPY_PREAMBLE  = np.lib.format.magic(1, 0)
+_NPY_ALIGNMENT = 64
+_COMPACT_ROWS  = 1 << 16
+
+
+
+class AppendableArray:
+    # A .npy file which grows by appending rows, readable at any time with np.load(mmap_mode = 'r').
+    # The shape in the header only counts committed rows: rows appended after the last commit,
+    # e.g. by an interrupted run, are ignored by readers and overwritten when appending again.
+
+    def __init__(self, path, dtype = None, row_shape = None):
+        self.path  = path
+        self._file = None
+
+        if not path.is_file():
+            if dtype is None or row_shape is None:
+                raise ValueError(f'Cannot create {path} without knowing the dtype and shape of its rows!')
+            _create_npy(path, np.dtype(dtype), tuple(row_shape))
+
+        self._open()
+
+        if dtype is not None and np.dtype(dtype) != self.dtype:
+            raise ValueError(f'{path} stores {self.dtype} values but {np.dtype(dtype)} values were requested!')
+        if row_shape is not None and tuple(row_shape) != self.row_shape:
+            raise ValueError(f'{path} stores rows of shape {self.row_shape} but rows of shape {tuple(row_shape)} were requested!')
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+    def append(self, rows):
+        rows = np.ascontiguousarray(rows, dtype = self.dtype)
+        if rows.shape[1:] != self.row_shape:
+            raise ValueError(f'Cannot append rows of shape {rows.shape[1:]} to {self.path} which stores rows of shape {self.row_shape}!')
+
+        self._file.write(rows.tobytes())
+        self._n_pending += len(rows)
+
+
+    def commit(self):
+        # Rows are flushed before the header counts them, so the header never refers to missing data.
+        self._file.flush()
+        self.n_rows    += self._n_pending
+        self._n_pending = 0
+
+        self._file.seek(0)
+        self._file.write(_npy_header(self.dtype, (self.n_rows, *self.row_shape), self._data_offset))
+        self._file.seek(0, os.SEEK_END)
+        self._file.flush()
+
+
+    def truncate(self, n_rows):
+        self._n_pending = 0
+        self.n_rows     = min(self.n_rows, n_rows)
+        self._file.truncate(self._data_offset + self.n_rows * self._row_nbytes)
+        self._file.seek(0, os.SEEK_END)
+        self.commit()
+
+
+    def compact(self, keep):
+        # Rewrites the file keeping only the committed rows where keep is True, streaming the data
+        # in chunks so that memory stays bounded.
+        tmp_path = self.path.with_suffix('.tmp')
+        data     = self.read()
+
+        with AppendableArray(tmp_path, self.dtype, self.row_shape) as tmp_array:
+            for start in range(0, self.n_rows, _COMPACT_ROWS):
+                end = start + _COMPACT_ROWS
+                tmp_array.append(data[start:end][keep[start:end]])
+            tmp_array.commit()
+
+        del data
+        self.close()
+        os.replace(tmp_path, self.path)
+        self._open()
+
+
+    def read(self, mmap_mode = 'r'):
+        return np.load(self.path, mmap_mode = mmap_mode)
+
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+    def _open(self):
+        with open(self.path, 'rb') as file:
+            version = np.lib.format.read_magic(file)
+            read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+            shape, _, self.dtype = read_header(file)
+            self._data_offset = file.tell()
+
+        self.row_shape   = shape[1:]
+        self.n_rows      = shape[0]
+        self._row_nbytes = self.dtype.itemsize * int(np.prod(self.row_shape, dtype = np.int64))
+        self._n_pending  = 0
+
+        # Drops rows which were appended but never committed.
+        self._file = open(self.path, 'r+b')
+        self._file.truncate(self._data_offset + self.n_rows * self._row_nbytes)
+        self._file.seek(0, os.SEEK_END)
+
+
+
+def _npy_header(dtype, shape, size):
+    # Header of the .npy format 1.0, padded with spaces to exactly size bytes.
+    header = repr({'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': shape})
+    header = header.ljust(size - len(_NPY_PREAMBLE) - 3) + '\n'
+    if len(_NPY_PREAMBLE) + 2 + len(header) != size:
+        raise ValueError(f'Header of shape {shape} does not fit in {size} bytes!')
+    return _NPY_PREAMBLE + struct.pack('<H', len(header)) + header.encode('latin1')
+
+
+
+def _create_npy(path, dtype, row_shape):
+    # The header is sized for the largest number of rows, so that it can always be rewritten in place.
+    size = len(_NPY_PREAMBLE) + 3 + len(repr({'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': (10 ** 15, *row_shape)}))
+    size = size + _NPY_ALIGNMENT - size % _NPY_ALIGNMENT
+    with open(path, 'wb') as file:
+        file.write(_npy_header(dtype, (0, *row_shape), size))
+
+
+
+class EmbeddingsWriter:
+    # Appends embeddings to an AppendableArray together with the id of the face each row belongs to,
+    # which is stored in a second AppendableArray. Rows are committed to both files at once.
+
+    def __init__(self, embeddings_path, ids_path, dtype, append):
+        # Embeddings written before ids were stored cannot be appended to.
+        if not append or not ids_path.is_file():
+            embeddings_path.unlink(missing_ok = True)
+            ids_path.unlink(missing_ok = True)
+
+        self.dtype            = np.dtype(dtype)
+        self._ids             = AppendableArray(ids_path, np.int64, ())
+        self._embeddings      = AppendableArray(embeddings_path, dtype) if embeddings_path.is_file() else None
+        self._embeddings_path = embeddings_path
+
+        # The ids are committed after the embeddings, so an interrupted commit may leave either file
+        # with a few more rows than the other.
+        n_rows = min(self._ids.n_rows, self._embeddings.n_rows if self._embeddings else 0)
+        self._ids.truncate(n_rows)
+        if self._embeddings is not None:
+            self._embeddings.truncate(n_rows)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+    @property
+    def ids(self):
+        return np.array(self._ids.read()) if self._ids.n_rows else np.empty(0, dtype = np.int64)
+
+
+    def append(self, ids, embeddings):
+        if self._embeddings is None:
+            self._embeddings = AppendableArray(self._embeddings_path, self.dtype, np.shape(embeddings)[1:])
+        self._embeddings.append(embeddings)
+        self._ids.append(ids)
+
+
+    def commit(self):
+        self._embeddings.commit()
+        self._ids.commit()
+
+
+    def retain(self, ids):
+        # Drops the rows of faces which are not in ids anymore, e.g. faces of deleted photos.
+        keep = np.isin(self.ids, ids)
+        if keep.all():
+            return
+
+        self._embeddings.compact(keep)
+        self._ids.compact(keep)
+
+
+    def close(self):
+        if self._embeddings is not None:
+            self._embeddings.close()
+        self._ids.close()
+
+
+
+def open_embeddings(embeddings_path, ids_path, mmap_mode = 'r'):
+    # Returns the face ids and the embeddings, memory-mapped by default.
+    embeddings = np.load(embeddings_path, mmap_mode = mmap_mode)
+
+    # Embeddings written before ids were stored belong to faces 0 to n - 1.
+    if not ids_path.is_file():
+        return np.arange(len(embeddings)), embeddings
+
+    ids    = np.load(ids_path, mmap_mode = mmap_mode)
+    n_rows = min(len(ids), len(embeddings))
+    return ids[:n_rows], embeddings[:n_rows]
+
+
+class RowSubset:
+    # Some rows of a (possibly memory-mapped) 2D array, which can be indexed like the array itself
+    # but only reads the rows indexed, so that a subset of embeddings on disk is used without
+    # loading them all. rows must be increasing.
+
+    def __init__(self, array, rows):
+        self.array = array
+        self.rows  = np.asarray(rows)
+        self.dtype = array.dtype
+        self.shape = (len(self.rows), *array.shape[1:])
+
+
+    def __len__(self):
+        return len(self.rows)
+
+
+    def __getitem__(self, rows):
+        return self.array[self.rows[rows]]
+
+
+    def __array__(self, dtype = None, copy = None):
+        return np.asarray(self.array[self.rows], dtype = dtype)
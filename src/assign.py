@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+
+# Constants is imported first so that it sets up the environment variables.
+import constants
+
+import os
+import pathlib
+
+import numpy as np
+
+import crop_store
+import embedding_ops
+import utils
+
+
+# Folder of the faces HDBSCAN did not put in any cluster.
+NOISE_LABEL = str(-1)
+
+
+
+def scan_clustered_faces(clustered_faces_dir):
+    # Returns the path of each face in the clusters directory by patch id, its folder being its
+    # current label, including any manual renaming or moving.
+    faces = {}
+    for label_dir in os.scandir(clustered_faces_dir):
+        if label_dir.is_dir():
+            for entry in os.scandir(label_dir.path):
+                stem, extension = os.path.splitext(entry.name)
+                if extension == '.png' and stem.isdigit():
+                    faces[int(stem)] = pathlib.Path(entry.path)
+    return faces
+
+
+
+def save_clusterer(clusterer_path, clusterer, patch_ids, normalize):
+    # Saves a clusterer fitted with prediction_data, with the ids of the faces it was fitted on and
+    # how they were preprocessed, so that new faces can later be predicted without fitting again.
+    # Imported here, as it takes a while to load, which only saving and loading clusterers needs.
+    import joblib
+
+    tmp_path = clusterer_path.with_suffix('.tmp')
+    joblib.dump({'clusterer': clusterer, 'patch_ids': np.asarray(patch_ids), 'normalize': normalize}, tmp_path)
+    os.replace(tmp_path, clusterer_path)
+
+
+
+def assign_new_faces(clustered_faces_dir, cropped_faces_dir, cluster_labels_path, assigned_ids_path, clusterer_path, patch_ids, embeddings,
+                     method, k, max_distance, min_agreement, normalize, chunk_size, mode, n_workers):
+    # Assigns the faces which were neither clustered by the last full run nor assigned since, and
+    # those still pending, to the folders of the clusters directory, leaving every other face where
+    # it is. Faces matching no folder are placed in the pending folder. New faces are told by their
+    # ids rather than by the clusters directory, so that faces deleted from it are not exported
+    # again. Returns the number of faces assigned and pending.
+    if not cluster_labels_path.is_file():
+        raise RuntimeError(f'No labels found at {cluster_labels_path}, run cluster.py without --assign first!')
+
+    known_ids      = np.union1d(utils.load_csv(cluster_labels_path).id.to_numpy(), load_assigned_ids(assigned_ids_path))
+    existing_faces = scan_clustered_faces(clustered_faces_dir)
+    pending_ids    = {patch_id for patch_id, path in existing_faces.items() if path.parent.name == constants.PENDING_FACES_DIRNAME}
+    is_new         = ~np.isin(patch_ids, known_ids)
+    new_rows       = np.flatnonzero(is_new | np.isin(patch_ids, list(pending_ids)))
+    if not len(new_rows):
+        return 0, 0
+
+    # Faces of the noise and pending folders are not a reference for any cluster.
+    labelled_faces = {patch_id: path.parent.name for patch_id, path in existing_faces.items()
+                      if path.parent.name not in (NOISE_LABEL, constants.PENDING_FACES_DIRNAME)}
+
+    if method == 'predict':
+        labels = _predict_labels(clusterer_path, embeddings[new_rows], labelled_faces)
+    else:
+        labels = _knn_labels(patch_ids, embeddings, new_rows, labelled_faces, k, max_distance, min_agreement, normalize, chunk_size)
+
+    # Pending faces which matched a folder are moved there, new faces are exported.
+    to_export_ids, to_export_labels = [], []
+    for patch_id, label in zip(patch_ids[new_rows].tolist(), labels):
+        if patch_id in pending_ids:
+            if label != constants.PENDING_FACES_DIRNAME:
+                path = existing_faces[patch_id]
+                os.replace(path, clustered_faces_dir / label / path.name)
+        else:
+            to_export_ids.append(patch_id)
+            to_export_labels.append(label)
+
+    with crop_store.open_reader(cropped_faces_dir) as crop_reader:
+        crop_store.export_faces(crop_reader, clustered_faces_dir, to_export_ids, to_export_labels, mode, n_workers)
+
+    save_assigned_ids(assigned_ids_path, np.union1d(load_assigned_ids(assigned_ids_path), patch_ids[is_new]))
+
+    n_pending = sum(label == constants.PENDING_FACES_DIRNAME for label in labels)
+    return len(labels) - n_pending, n_pending
+
+
+
+def load_assigned_ids(assigned_ids_path):
+    # Ids of the faces assigned since the last full run, which clears them as its labels include
+    # every face.
+    if not assigned_ids_path.is_file():
+        return np.empty(0, dtype = np.int64)
+    return np.load(assigned_ids_path)
+
+
+
+def save_assigned_ids(assigned_ids_path, assigned_ids):
+    tmp_path = assigned_ids_path.with_suffix('.tmp')
+    with open(tmp_path, 'wb') as file:
+        np.save(file, np.asarray(assigned_ids, dtype = np.int64))
+    os.replace(tmp_path, assigned_ids_path)
+
+
+
+def default_max_distance(model, normalize):
+    # The distance DeepFace.verify accepts between two faces of the same person. Imported here, as
+    # it loads the dependencies of the recognition models, which clustering otherwise does not need.
+    from deepface.modules import verification
+    return verification.find_threshold(model, 'euclidean_l2' if normalize else 'euclidean')
+
+
+
+def _knn_labels(patch_ids, embeddings, new_rows, labelled_faces, k, max_distance, min_agreement, normalize, chunk_size):
+    # Each new face takes the folder most of its k nearest labelled faces within max_distance are
+    # in, if they agree enough. The labelled faces are those currently in the clusters directory,
+    # so that manual corrections are taken into account.
+    order          = np.argsort(patch_ids, kind = 'stable')
+    labelled_ids   = np.fromiter(labelled_faces, dtype = np.int64, count = len(labelled_faces))
+    positions      = np.minimum(np.searchsorted(patch_ids[order], labelled_ids), len(order) - 1)
+    found          = patch_ids[order][positions] == labelled_ids
+    reference_rows = order[positions[found]]
+    reference_ids  = labelled_ids[found]
+
+    if not len(reference_rows):
+        return [constants.PENDING_FACES_DIRNAME] * len(new_rows)
+
+    folders, reference_codes = np.unique([labelled_faces[patch_id] for patch_id in reference_ids.tolist()], return_inverse = True)
+
+    # Rows are read in increasing order, which is much faster on a memory-mapped file.
+    sorted_rows     = np.argsort(reference_rows)
+    references      = _load_points(embeddings, reference_rows[sorted_rows], normalize)
+    reference_codes = reference_codes[sorted_rows]
+    queries         = _load_points(embeddings, new_rows, normalize)
+
+    neighbours, distances = embedding_ops.knn(queries, references, k, chunk_size)
+    votes = np.where(distances <= max_distance, reference_codes[neighbours], -1)
+
+    # Votes of each face for the folder of each of its neighbours, counted for all neighbours at
+    # once by comparing every pair of neighbours.
+    valid       = votes >= 0
+    counts      = ((votes[:, :, np.newaxis] == votes[:, np.newaxis, :]) & valid[:, np.newaxis, :]).sum(axis = 2) * valid
+    best        = counts.argmax(axis = 1)
+    best_counts = counts[np.arange(len(votes)), best]
+    agreement   = best_counts / np.maximum(valid.sum(axis = 1), 1)
+    matched     = (best_counts > 0) & (agreement >= min_agreement)
+
+    best_codes = votes[np.arange(len(votes)), best]
+    return [folders[code] if is_matched else constants.PENDING_FACES_DIRNAME for code, is_matched in zip(best_codes, matched)]
+
+
+
+def _predict_labels(clusterer_path, new_points, labelled_faces):
+    # Predicts the cluster of each new face with the clusterer of the last full run, then maps each
+    # cluster to the folder most of its faces are currently in. HDBSCAN and joblib are imported
+    # here, as they take about a second to load, which the knn method does not need.
+    import hdbscan
+    import joblib
+
+    if not clusterer_path.is_file():
+        raise RuntimeError(f'No clusterer found at {clusterer_path}, run cluster.py without --accelerate first!')
+
+    state     = joblib.load(clusterer_path)
+    clusterer = state['clusterer']
+    points    = np.asarray(new_points, dtype = np.float64)
+    if state['normalize']:
+        points = embedding_ops.l2_normalize(points)
+
+    predicted, _ = hdbscan.approximate_predict(clusterer, points)
+
+    votes = {}
+    for patch_id, cluster in zip(state['patch_ids'].tolist(), clusterer.labels_.tolist()):
+        if cluster >= 0 and patch_id in labelled_faces:
+            folder_votes = votes.setdefault(cluster, {})
+            folder_votes[labelled_faces[patch_id]] = folder_votes.get(labelled_faces[patch_id], 0) + 1
+    folders = {cluster: max(folder_votes, key = folder_votes.get) for cluster, folder_votes in votes.items()}
+
+    return [folders.get(cluster, constants.PENDING_FACES_DIRNAME) for cluster in predicted.tolist()]
+
+
+
+def _load_points(embeddings, rows, normalize):
+    points = np.asarray(embeddings[rows], dtype = np.float32)
+    return embedding_ops.l2_normalize(points) if normalize else points
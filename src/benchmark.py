@@ -0,0 +1,537 @@
+# -*- coding: utf-8 -*-
+
+# Constants is imported first so that it sets up the environment variables.
+import constants
+
+import os
+import sys
+import json
+import time
+import pathlib
+import argparse
+import contextlib
+import platform
+import tempfile
+import datetime
+import subprocess
+from collections import defaultdict
+
+import cv2
+import numpy as np
+import hdbscan
+from sklearn.metrics import adjusted_mutual_info_score
+
+import cluster
+import copy_photos_person
+import crop_store
+import embedding_ops
+import face_store
+import image_io
+import microclusters
+import model_server
+import pipeline
+import quality
+import utils
+
+
+_STAGES = ['startup', 'walk', 'decode', 'detect', 'embed', 'cluster', 'copy']
+
+# Entry points whose startup, i.e. the time to import their modules and show their help, is timed.
+_SCRIPTS = ['extract_faces.py', 'make_embeddings.py', 'cluster.py', 'copy_photos_person.py',
+            'export_faces.py', 'search.py', 'merge_shards.py', 'model_server.py']
+# Seconds to wait for the model server to load its models.
+_SERVER_TIMEOUT = 600
+# Number of faces of the work directory make_embeddings.py and search.py are run on end to end.
+_TINY_WORK_DIR_FACES = 8
+
+# Input size of the stub embedder, the same as Facenet's.
+_STUB_FACE_SIZE       = 160
+_STUB_EMBEDDING_SIZE  = 128
+_BENCHMARK_LABELS     = 4
+
+
+
+def main():
+    args = parse_args()
+
+    if args.command == 'compare':
+        regressions = compare(_load_results(args.baseline), _load_results(args.results), args.tolerance, args.min_seconds)
+        sys.exit(1 if regressions else 0)
+
+    results = {'environment': _environment(),
+               'config'     : {key: value for key, value in vars(args).items() if key != 'command'},
+               'results'    : {}}
+
+    with tempfile.TemporaryDirectory(dir = args.scratch_dir or args.input_dir.parent) as scratch_dir:
+        run_benchmarks(args, pathlib.Path(scratch_dir), results['results'])
+
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent = 4, default = str)
+    print(f'Results written to {args.output}.')
+
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description = "This script times each stage of the pipeline in isolation on a library generated with make_synthetic_library.py, with CPU-only stand-ins for the models by default, and compares the results with those of a previous run to catch regressions.",
+                                     formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+    commands = parser.add_subparsers(dest = 'command', required = True)
+
+    run = commands.add_parser('run',
+                              help = 'Run the benchmarks and write their results as JSON.',
+                              formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+
+    run.add_argument('-i', '--input_dir',
+                     required = True,
+                     type = pathlib.Path,
+                     help = 'Library to benchmark on, e.g. generated with make_synthetic_library.py.')
+
+    run.add_argument('-o', '--output',
+                     required = True,
+                     type = pathlib.Path,
+                     help = 'Path of the JSON file in which to write the results.')
+
+    run.add_argument('--stages',
+                     nargs = '+',
+                     choices = _STAGES,
+                     default = _STAGES,
+                     help = 'Stages to benchmark.')
+
+    run.add_argument('-r', '--repeats',
+                     type = int,
+                     default = 3,
+                     help = 'Number of times each benchmark is run. The fastest time is kept to reduce noise, so the files are in the OS cache except for the first repetition.')
+
+    run.add_argument('--scratch_dir',
+                     default = None,
+                     type = pathlib.Path,
+                     help = 'Directory in which temporary files are written. Defaults to the parent of the input directory, so that hardlinks to the library are possible.')
+
+    run.add_argument('--walk_workers',
+                     type = int,
+                     default = 8,
+                     help = 'Number of threads of the parallel directory walk.')
+
+    run.add_argument('--secs_between_frames',
+                     type = float,
+                     default = 1.0,
+                     help = 'Seconds between the video frames decoded.')
+
+    run.add_argument('--detector',
+                     type = str,
+                     default = 'haar',
+                     help = 'Face detector: "haar" for the Haar cascade bundled with OpenCV, which needs no download, or any detector backend of DeepFace, e.g. "opencv" or "retinaface".')
+
+    run.add_argument('--detect_images',
+                     type = int,
+                     default = 50,
+                     help = 'Number of photos faces are detected in.')
+
+    run.add_argument('--embed_model',
+                     type = str,
+                     default = None,
+                     help = 'DeepFace model computing the embeddings, e.g. "Facenet". By default, a random projection stands in for the model so that only loading, preprocessing and batching are timed.')
+
+    run.add_argument('--embed_faces',
+                     type = int,
+                     default = 512,
+                     help = 'Number of synthetic faces embedded.')
+
+    run.add_argument('--batch_sizes',
+                     nargs = '+',
+                     type = int,
+                     default = [1, 16, 64],
+                     help = 'Batch sizes the embeddings are computed with.')
+
+    run.add_argument('--cluster_sizes',
+                     nargs = '+',
+                     type = int,
+                     default = [2000, 8000, 32000],
+                     help = 'Numbers of synthetic embeddings clustered.')
+
+    run.add_argument('--cluster_dims',
+                     nargs = '+',
+                     type = int,
+                     default = [128, 512],
+                     help = 'Dimensionalities of the synthetic embeddings clustered.')
+
+    run.add_argument('--cluster_exact_max',
+                     type = int,
+                     default = 10000,
+                     help = 'Largest number of embeddings clustered without --accelerate, as it takes quadratic memory and time.')
+
+    run.add_argument('--knn',
+                     type = int,
+                     default = 30,
+                     help = 'Number of neighbours of each embedding with --accelerate.')
+
+    run.add_argument('--copy_modes',
+                     nargs = '+',
+                     choices = ['copy', 'hardlink', 'reflink', 'symlink'],
+                     default = ['copy', 'hardlink'],
+                     help = 'Modes of copy_photos_person.py to benchmark.')
+
+    run.add_argument('--copy_workers',
+                     type = int,
+                     default = 8,
+                     help = 'Number of threads copying photos.')
+
+    run.add_argument('-s', '--seed',
+                     type = int,
+                     default = 0,
+                     help = 'Seed of the synthetic faces and embeddings.')
+
+    compare_parser = commands.add_parser('compare',
+                                         help = 'Compare results with a baseline and exit with an error if any benchmark regressed.',
+                                         formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+
+    compare_parser.add_argument('baseline',
+                                type = pathlib.Path,
+                                help = 'Results of the reference run.')
+
+    compare_parser.add_argument('results',
+                                type = pathlib.Path,
+                                help = 'Results of the run to check.')
+
+    compare_parser.add_argument('-t', '--tolerance',
+                                type = float,
+                                default = 0.15,
+                                help = 'Relative slowdown beyond which a benchmark is flagged as a regression.')
+
+    compare_parser.add_argument('--min_seconds',
+                                type = float,
+                                default = 0.01,
+                                help = 'Benchmarks taking less than this in the baseline are too noisy to be flagged, only their change is shown.')
+
+    args = parser.parse_args()
+
+    return args
+
+
+
+def run_benchmarks(args, scratch_dir, results):
+    rng   = np.random.default_rng(args.seed)
+    files = [path for path, _, _ in utils.scan_files(args.input_dir)]
+
+    # Formats are needed by most stages, they are only timed by the walk stage.
+    formats = {path: image_io.classify_file(path, False) for path in files}
+    photos  = [path for path, file_format in formats.items() if image_io._FORMATS[file_format][0] == image_io._FileType.IMAGE]
+
+    def measure(name, fn, n_items, unit, **extra):
+        seconds = min(_time(fn) for _ in range(args.repeats))
+        results[name] = {'seconds': seconds, 'items': n_items, 'unit': unit, 'per_second': n_items / seconds if seconds > 0 else None, **extra}
+        print(f'{name:<45} {seconds:>10.3f} s {results[name]["per_second"] or 0:>12.1f} {unit}/s')
+
+    if 'startup' in args.stages:
+        for script in _SCRIPTS:
+            measure(f'startup/{script}', lambda: _run_script([script, '-h']), 1, 'runs')
+
+        # The scripts which load models are run end to end on a tiny work directory, loading the
+        # model themselves (cold) or using a running model server (warm). References are not run
+        # through a detector, which the detect stage times.
+        if args.embed_model is not None:
+            tiny_work_dir  = scratch_dir / 'Tiny Work'
+            reference_path = _make_tiny_work_dir(tiny_work_dir, rng)
+            commands       = {'make_embeddings.py': ['make_embeddings.py', '-w', str(tiny_work_dir), '-m', args.embed_model, '-n', 'base'],
+                              'search.py'         : ['search.py', '-w', str(tiny_work_dir), '-r', str(reference_path)]}
+
+            for script, command in commands.items():
+                measure(f'startup/{script}/{args.embed_model}/cold', lambda: _run_script(command), 1, 'runs')
+
+            # Socket paths are limited to about a hundred characters, so it is not in the scratch
+            # directory but in a short private one.
+            with tempfile.TemporaryDirectory(prefix = 'benchmark-') as socket_dir, \
+                 _model_server(pathlib.Path(socket_dir) / 'model_server.sock', args.embed_model) as socket_path:
+                for script, command in commands.items():
+                    measure(f'startup/{script}/{args.embed_model}/warm', lambda: _run_script([*command, '--model_server', str(socket_path)]), 1, 'runs')
+
+    if 'walk' in args.stages:
+        measure('walk/serial', lambda: utils.scan_files(args.input_dir), len(files), 'files')
+        measure('walk/threads', lambda: utils.scan_files(args.input_dir, args.walk_workers), len(files), 'files')
+        measure('walk/classify', lambda: [image_io.classify_file(path, False) for path in files], len(files), 'files')
+
+    if 'decode' in args.stages:
+        files_per_format = defaultdict(list)
+        for path, file_format in formats.items():
+            files_per_format[file_format].append(path)
+
+        for file_format, paths in sorted(files_per_format.items()):
+            if image_io._FORMATS[file_format][0] == image_io._FileType.UNKNOWN:
+                continue
+            measure(f'decode/{file_format}', lambda: _decode(paths, file_format, args.secs_between_frames), len(paths), 'files')
+
+    if 'detect' in args.stages:
+        detect = _make_detector(args.detector)
+        images = [image for path in photos[:args.detect_images] for _, image in image_io.iter_file_images(path, False, 0, file_format = formats[path])]
+        measure(f'detect/{args.detector}', lambda: [detect(image) for image in images], len(images), 'images')
+
+    if 'embed' in args.stages:
+        cropped_faces_dir = scratch_dir / constants.CROPPED_FACES_DIRNAME
+        cropped_faces_dir.mkdir()
+        with crop_store.PngCropWriter(cropped_faces_dir) as writer:
+            for patch_id in range(args.embed_faces):
+                writer.write(patch_id, _make_face(rng))
+
+        embedder = _make_embedder(args.embed_model, rng)
+        with crop_store.open_reader(cropped_faces_dir) as crop_reader:
+            for batch_size in args.batch_sizes:
+                measure(f'embed/{args.embed_model or "stub"}/batch={batch_size}', lambda: _embed(embedder, crop_reader, args.embed_faces, batch_size), args.embed_faces, 'faces')
+
+            faces = [crop_reader.read(patch_id) for patch_id in range(args.embed_faces)]
+            boxes = [(0, 0, face.shape[1], face.shape[0]) for face in faces]
+            measure('embed/quality_scores', lambda: quality.score_faces(faces, boxes, [None] * len(faces)), args.embed_faces, 'faces')
+
+    if 'cluster' in args.stages:
+        for n_points in args.cluster_sizes:
+            for n_dims in args.cluster_dims:
+                points, truth = _make_blobs(n_points, n_dims, rng)
+
+                if n_points <= args.cluster_exact_max:
+                    labels = _cluster_exact(points)
+                    measure(f'cluster/exact/n={n_points},d={n_dims}', lambda: _cluster_exact(points), n_points, 'points',
+                            ami = adjusted_mutual_info_score(truth, labels))
+
+                labels = _cluster_accelerated(points, args.knn)
+                measure(f'cluster/accelerate/n={n_points},d={n_dims}', lambda: _cluster_accelerated(points, args.knn), n_points, 'points',
+                        ami = adjusted_mutual_info_score(truth, labels))
+
+                labels = _cluster_two_stage(points)
+                measure(f'cluster/two_stage/n={n_points},d={n_dims}', lambda: _cluster_two_stage(points), n_points, 'points',
+                        ami = adjusted_mutual_info_score(truth, labels))
+
+    if 'copy' in args.stages:
+        work_dir = scratch_dir / 'Work'
+        _make_work_dir(work_dir, photos)
+        labels = [str(label) for label in range(_BENCHMARK_LABELS)]
+        images_per_label = copy_photos_person.collect_images(work_dir / constants.CLUSTERED_FACES_DIRNAME, labels,
+                                                             work_dir / constants.FACE_METADATA_DIRNAME)
+
+        for mode in args.copy_modes:
+            def copy():
+                # Each repetition copies into a new directory, as copying over a previous copy is
+                # what --resume does and is not what is timed here.
+                output_dir = pathlib.Path(tempfile.mkdtemp(dir = scratch_dir))
+                copy_photos_person.copy_images({output_dir / label: images for label, images in images_per_label.items()},
+                                               mode, False, args.copy_workers)
+            n_images = sum(map(len, images_per_label.values()))
+            measure(f'copy/{mode}', copy, n_images, 'images')
+
+
+
+def _time(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+
+def _run_script(arguments):
+    subprocess.run([sys.executable, *arguments], cwd = pathlib.Path(__file__).parent, check = True, stdout = subprocess.DEVNULL)
+
+
+
+@contextlib.contextmanager
+def _model_server(socket_path, model_name):
+    # Runs model_server.py with the model loaded and no detector, as the "skip" detector of the
+    # references needs none, until the block exits.
+    server = subprocess.Popen([sys.executable, 'model_server.py', '-s', str(socket_path), '-m', model_name, '--normalization', 'base', '-d'],
+                              cwd = pathlib.Path(__file__).parent, stdout = subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + _SERVER_TIMEOUT
+        while not model_server._is_listening(socket_path):
+            if server.poll() is not None or time.monotonic() > deadline:
+                raise RuntimeError('The model server did not start!')
+            time.sleep(0.1)
+        yield socket_path
+    finally:
+        server.terminate()
+        server.wait()
+
+
+
+def _decode(paths, file_format, secs_between_frames):
+    for path in paths:
+        for _ in image_io.iter_file_images(path, True, secs_between_frames, file_format = file_format):
+            pass
+
+
+
+def _make_detector(detector_name):
+    if detector_name == 'haar':
+        classifier = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+        return lambda image: classifier.detectMultiScale(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY))
+
+    # Imported here so that the default benchmarks do not need Tensorflow to be loaded.
+    import detection
+    return lambda image: detection.detect_faces(image, detector_name, True, 0, 0)
+
+
+
+class _StubEmbedder:
+    # Stands in for embedding.FaceEmbedder with the same preprocessing steps and a random projection
+    # instead of the model, so that loading and batching can be timed without any model.
+
+    def __init__(self, rng):
+        self.projection = rng.standard_normal((_STUB_FACE_SIZE * _STUB_FACE_SIZE * 3, _STUB_EMBEDDING_SIZE), dtype = np.float32)
+
+
+    def preprocess(self, face):
+        face = cv2.resize(face[:, :, ::-1], (_STUB_FACE_SIZE, _STUB_FACE_SIZE), interpolation = cv2.INTER_AREA)
+        return (face.astype(np.float32) / 255)[np.newaxis]
+
+
+    def embed(self, preprocessed_faces):
+        faces = np.concatenate(preprocessed_faces, axis = 0)
+        return faces.reshape(len(faces), -1) @ self.projection
+
+
+
+def _make_embedder(model_name, rng):
+    if model_name is None:
+        return _StubEmbedder(rng)
+
+    # Imported here so that the default benchmarks do not need Tensorflow to be loaded.
+    import embedding
+    return embedding.FaceEmbedder(model_name, 'base')
+
+
+
+def _embed(embedder, crop_reader, n_faces, batch_size):
+    # Same loop as make_embeddings.py, without writing the embeddings.
+    def load_batch(ids):
+        return [embedder.preprocess(crop_reader.read(id_)) for id_ in ids]
+
+    batches = [range(i, min(i + batch_size, n_faces)) for i in range(0, n_faces, batch_size)]
+    for faces in pipeline.iter_prefetched(load_batch, batches):
+        embedder.embed(faces)
+
+
+
+def _make_face(rng):
+    size = int(rng.integers(80, 240))
+    face = rng.integers(0, 256, (8, 8, 3), dtype = np.uint8)
+    return cv2.resize(face, (size, size), interpolation = cv2.INTER_CUBIC)
+
+
+
+def _make_blobs(n_points, n_dims, rng):
+    # Gaussian blobs on the unit sphere, like the faces of one person each, of sizes following a
+    # power law as in photo libraries, plus 10% of uniformly scattered noise points.
+    n_clusters = max(2, n_points // 100)
+    sizes      = rng.pareto(1.5, n_clusters) + 1
+    truth      = rng.choice(n_clusters, size = n_points, p = sizes / sizes.sum())
+
+    centers = embedding_ops.l2_normalize(rng.standard_normal((n_clusters, n_dims)))
+    points  = centers[truth] + rng.standard_normal((n_points, n_dims)) * 0.3 / np.sqrt(n_dims)
+
+    noise = rng.random(n_points) < 0.1
+    points[noise] = embedding_ops.l2_normalize(rng.standard_normal((noise.sum(), n_dims)))
+    truth[noise]  = -1
+
+    return points.astype(np.float32), truth
+
+
+
+def _cluster_exact(points):
+    return hdbscan.HDBSCAN(min_samples = 1, min_cluster_size = 20).fit_predict(points.astype(np.float64))
+
+
+
+def _cluster_accelerated(points, knn):
+    data = embedding_ops.knn_distance_graph(cluster.preprocess_embeddings(points, False, 0, False, 4096), knn, 4096)
+    return hdbscan.HDBSCAN(min_samples = 1, min_cluster_size = 20, metric = 'precomputed').fit_predict(data)
+
+
+
+def _cluster_two_stage(points):
+    n_micro_clusters = microclusters.n_micro_clusters(len(points), 20)
+    centroids, weights, micro_labels = microclusters.compress(points, n_micro_clusters, False, 1, 1 << 30, 4096)
+    return microclusters.cluster_weighted(centroids.astype(np.float64), weights, {'min_samples': 1, 'min_cluster_size': 20})[micro_labels]
+
+
+
+def _make_work_dir(work_dir, photos):
+    # Work directory as left by cluster.py, with one face per photo spread over a few clusters.
+    clustered_faces_dir = work_dir / constants.CLUSTERED_FACES_DIRNAME
+    for label in range(_BENCHMARK_LABELS):
+        (clustered_faces_dir / str(label)).mkdir(parents = True)
+
+    with face_store.FaceStoreWriter(work_dir / constants.FACE_METADATA_DIRNAME) as face_writer:
+        for patch_id, path in enumerate(photos):
+            face_writer.append(path, [(patch_id, np.nan, *[-1] * 4, np.nan, *[-1] * 6, False, *[np.nan] * 5)])
+            (clustered_faces_dir / str(patch_id % _BENCHMARK_LABELS) / f'{patch_id}.png').touch()
+        face_writer.commit()
+
+
+
+def _make_tiny_work_dir(work_dir, rng):
+    # Work directory as left by extract_faces.py with a few synthetic faces, whose references are
+    # taken whole as faces by the "skip" detector. Returns the path of a reference photo.
+    (work_dir / constants.CROPPED_FACES_DIRNAME).mkdir(parents = True)
+    with face_store.FaceStoreWriter(work_dir / constants.FACE_METADATA_DIRNAME) as face_writer, \
+         crop_store.PngCropWriter(work_dir / constants.CROPPED_FACES_DIRNAME) as crop_writer:
+        for patch_id in range(_TINY_WORK_DIR_FACES):
+            crop_writer.write(patch_id, _make_face(rng))
+            face_writer.append(work_dir / f'{patch_id}.jpg', [(patch_id, np.nan, *[-1] * 4, np.nan, *[-1] * 6, False, *[np.nan] * 5)])
+        face_writer.commit()
+
+    utils.update_settings(work_dir / constants.SETTINGS_FILENAME, detector_name = 'skip', min_confidence = 0, min_size = 0, align_output_faces = False)
+
+    reference_path = work_dir / 'Reference.png'
+    cv2.imwrite(str(reference_path), _make_face(rng))
+    return reference_path
+
+
+
+def _environment():
+    return {'date'     : datetime.datetime.now().isoformat(timespec = 'seconds'),
+            'platform' : platform.platform(),
+            'python'   : platform.python_version(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'numpy'    : np.__version__,
+            'opencv'   : cv2.__version__,
+            'hdbscan'  : getattr(hdbscan, '__version__', None)}
+
+
+
+def _load_results(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+
+def compare(baseline, current, tolerance, min_seconds):
+    # Prints the change of the time of each benchmark and returns the names of those which are
+    # slower than the baseline by more than tolerance.
+    for key in ['platform', 'processor', 'cpu_count']:
+        if baseline['environment'].get(key) != current['environment'].get(key):
+            print(f'Warning: {key} differs from the baseline ({baseline["environment"].get(key)} vs {current["environment"].get(key)}).')
+
+    regressions = []
+    print(f'{"Benchmark":<45} {"Baseline [s]":>13} {"Current [s]":>12} {"Change":>8}')
+    for name, result in current['results'].items():
+        if name not in baseline['results']:
+            print(f'{name:<45} {"":>13} {result["seconds"]:>12.3f} {"new":>8}')
+            continue
+
+        previous = baseline['results'][name]['seconds']
+        change   = result['seconds'] / previous - 1 if previous > 0 else 0
+        flag     = ''
+        # Changes of the shortest benchmarks are mostly noise.
+        if previous >= min_seconds and change > tolerance:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        elif previous >= min_seconds and change < -tolerance / (1 + tolerance):
+            flag = '  improved'
+        print(f'{name:<45} {previous:>13.3f} {result["seconds"]:>12.3f} {change:>+8.1%}{flag}')
+
+    for name in baseline['results'].keys() - current['results'].keys():
+        print(f'{name:<45} missing from the results')
+
+    print(f'{len(regressions)} regression(s) beyond {tolerance:.0%}.')
+    return regressions
+
+
+
+if __name__ == '__main__':
+    main()
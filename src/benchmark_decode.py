@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+# Constants is imported first so that it sets up the environment variables.
+import constants
+
+import time
+import pathlib
+import argparse
+from collections import defaultdict
+
+import cv2
+from PIL import Image, ImageOps
+from numpy import asarray
+
+import image_io
+import utils
+
+
+
+def main():
+    args = parse_args()
+
+    print('Timing file decoding...')
+    timings = benchmark_decode(args.input_dir, args.repeats)
+
+    print(f'{"Format":<12} {"Files":>6} {"Previous [ms]":>14} {"Current [ms]":>13} {"Speed-up":>9}')
+    for file_format, (n_files, previous_ms, current_ms) in sorted(timings.items()):
+        print(f'{file_format:<12} {n_files:>6} {previous_ms:>14.2f} {current_ms:>13.2f} {previous_ms / current_ms:>8.2f}x')
+
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description = "This script times, per file format, how long it takes to classify and decode the sample files within a directory with the previous and the current image_io implementations.",
+                                     formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-i', '--input_dir',
+                        required = True,
+                        type = pathlib.Path,
+                        help = 'Directory containing sample images and videos (e.g. JPEG, HEIC, AVIF, PNG and MP4 files).')
+
+    parser.add_argument('-r', '--repeats',
+                        type = int,
+                        default = 5,
+                        help = 'Number of times each file is decoded. The fastest time is kept to reduce noise.')
+
+    args = parser.parse_args()
+
+    return args
+
+
+
+def _previous_file_is_image_or_video(path):
+    # Classification as done before magic bytes were sniffed: a full PIL verify, then an OpenCV open.
+    try:
+        Image.open(path).verify()
+        return image_io._FileType.IMAGE
+
+    except Exception:
+        pass
+
+    cap = cv2.VideoCapture(str(path))
+
+    if cap.isOpened():
+        if cap.get(cv2.CAP_PROP_FRAME_COUNT) > 1:
+            return image_io._FileType.VIDEO
+
+        return image_io._FileType.IMAGE
+
+    return image_io._FileType.UNKNOWN
+
+
+
+def _previous_load_image(path):
+    # Loading as done before: the image was decoded with PIL, then decoded again with OpenCV.
+    try:
+        image = Image.open(path)
+        image = ImageOps.exif_transpose(image)
+        image = asarray(image.convert('BGR'))
+    except Exception:
+        image = None
+
+    return cv2.imread(str(path), cv2.IMREAD_COLOR)
+
+
+
+def _previous_decode(path):
+    file_type = _previous_file_is_image_or_video(path)
+
+    if file_type == image_io._FileType.IMAGE:
+        _previous_load_image(path)
+
+    elif file_type == image_io._FileType.VIDEO:
+        next(image_io._iter_video(path, 0), None)
+
+
+
+def _current_decode(path):
+    # Videos are timed up to their first frame, like for the previous implementation.
+    next(image_io.iter_file_images(path, True, 0), None)
+
+
+
+def _time_fastest(fn, path, repeats):
+    fastest = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn(path)
+        fastest = min(fastest, time.perf_counter() - start)
+    return fastest
+
+
+
+def benchmark_decode(input_dir, repeats):
+    previous_secs = defaultdict(list)
+    current_secs  = defaultdict(list)
+
+    for path in utils.iter_files(input_dir):
+        file_format = image_io.sniff_format(path)
+        previous_secs[file_format].append(_time_fastest(_previous_decode, path, repeats))
+        current_secs[file_format].append(_time_fastest(_current_decode, path, repeats))
+
+    return {file_format: (len(secs),
+                          1000 * sum(secs) / len(secs),
+                          1000 * sum(current_secs[file_format]) / len(secs))
+            for file_format, secs in previous_secs.items()}
+
+
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
@@ -3,29 +3,86 @@
 # Constants is imported first so that it sets up the environment variables.
 import constants
 
+import os
 import pathlib
 import argparse
 import shutil
 
 import numpy as np
-import hdbscan
-from tqdm import tqdm
+import pandas as pd
+
+import array_store
+import assign
+import crop_store
+import embedding_ops
+import face_store
+import profiling
+import quality
+import utils
 
 
 
 
 def main():
     args = parse_args()
+    profiling.start(args.profile, args.cprofile)
 
     cropped_faces_dir    = args.work_dir / constants.CROPPED_FACES_DIRNAME
     embeddings_file_path = args.work_dir / constants.EMBEDDINGS_FILENAME
+    embedding_ids_path   = args.work_dir / constants.EMBEDDING_IDS_FILENAME
     clustered_faces_dir  = args.work_dir / constants.CLUSTERED_FACES_DIRNAME
+    cluster_labels_path  = args.work_dir / constants.CLUSTER_LABELS_FILENAME
     hdbscan_cache_dir    = args.work_dir / constants.HDBSCAN_CACHE_DIRNAME
+    sweep_results_path   = args.work_dir / constants.SWEEP_RESULTS_FILENAME
+    clusterer_path       = args.work_dir / constants.CLUSTERER_FILENAME
+    assigned_ids_path    = args.work_dir / constants.ASSIGNED_IDS_FILENAME
+    settings_path        = args.work_dir / constants.SETTINGS_FILENAME
+    face_store_dir       = args.work_dir / constants.FACE_METADATA_DIRNAME
+    faces_csv_path       = args.work_dir / constants.FACES_CSV_FILENAME
+
+    with utils.print_duration('Loading embeddings'):
+        patch_ids, embeddings = array_store.open_embeddings(embeddings_file_path, embedding_ids_path, mmap_mode = 'r')
+
+    # Faces below the quality thresholds are left out, including when assigning new faces. Only the
+    # embeddings of the other faces are read.
+    quality_thresholds = quality.thresholds(args)
+    if quality_thresholds:
+        face_metadata = face_store.load_faces(face_store_dir, ['id', *quality.COLUMNS], faces_csv_path)
+        rejected, failed_ids = quality.rejected_ids(face_metadata, quality_thresholds)
+        n_rejected, failed_counts = quality.count_rejected(patch_ids, rejected, failed_ids)
+        print(quality.report(failed_counts, n_rejected, len(patch_ids), 'clustered'))
+        profiling.count('faces_rejected_quality', n_rejected)
+
+        if n_rejected:
+            # Without --accelerate or --two_stage, HDBSCAN compares every pair of faces.
+            if not args.accelerate and not args.two_stage:
+                print(f'{1 - (1 - n_rejected / len(patch_ids)) ** 2:.1%} fewer pairs of faces to compare.')
+            kept_rows             = np.flatnonzero(~np.isin(patch_ids, rejected))
+            patch_ids, embeddings = np.asarray(patch_ids[kept_rows]), array_store.RowSubset(embeddings, kept_rows)
+
+    if args.assign:
+        if not clustered_faces_dir.is_dir():
+            raise RuntimeError(f'No clusters found in {clustered_faces_dir}, run cluster.py without --assign first!')
+
+        max_distance = args.assign_max_distance
+        if max_distance is None and args.assign_method == 'knn':
+            max_distance = assign.default_max_distance(utils.load_settings(settings_path).get('model', 'Facenet'), args.normalize)
+
+        with utils.print_duration('Assigning new faces'):
+            n_assigned, n_pending = assign.assign_new_faces(clustered_faces_dir, cropped_faces_dir, cluster_labels_path, assigned_ids_path,
+                                                            clusterer_path, patch_ids, embeddings, args.assign_method, args.assign_knn, max_distance,
+                                                            args.assign_min_agreement, args.normalize, args.chunk_size, args.materialize,
+                                                            args.materialize_workers)
+
+        print(f'Process completed. {n_assigned} faces assigned to a cluster, {n_pending} pending in the "{constants.PENDING_FACES_DIRNAME}" folder.')
+        return
+
+    # Imported here, as HDBSCAN and scikit-learn take about a second to load, which neither --assign
+    # nor the help of the script need.
+    import hdbscan
+    import microclusters
+    import sweep
 
-    print('Loading embeddings...')
-    embeddings = np.load(embeddings_file_path)
-    
-    print('Clustering...')
     hdbscan_kwargs = {'min_samples'              : args.min_samples,
                       'min_cluster_size'         : args.min_cluster_size,
                       'cluster_selection_epsilon': args.cluster_selection_epsilon,
@@ -34,14 +91,83 @@ def main():
                       'memory'                   : str(hdbscan_cache_dir)}
     if not args.store_cache:
         hdbscan_kwargs.pop('memory')
+    exact_kwargs = {name: value for name, value in hdbscan_kwargs.items() if name != 'memory'}
+
+    # With --two_stage, the embeddings are compressed into micro-clusters which are clustered in
+    # place of the faces, each face then taking the label of its micro-cluster.
+    face_embeddings = embeddings
+    if args.two_stage:
+        n_micro_clusters = args.n_micro_clusters or microclusters.n_micro_clusters(len(embeddings), args.min_cluster_size)
+        with utils.print_duration(f'Compressing embeddings into {n_micro_clusters} micro-clusters'):
+            embeddings, weights, micro_labels = microclusters.compress(face_embeddings, n_micro_clusters, args.normalize, args.micro_epochs,
+                                                                       args.max_memory << 20, args.chunk_size)
+
+    if args.accelerate:
+        with utils.print_duration('Preprocessing embeddings'):
+            points = preprocess_embeddings(embeddings, args.normalize, args.pca_dims, args.whiten, args.chunk_size)
+
+        with utils.print_duration(f'Building the {args.knn} nearest neighbours graph'):
+            data = embedding_ops.knn_distance_graph(points, args.knn, args.chunk_size)
+        hdbscan_kwargs['metric'] = 'precomputed'
+
+    else:
+        # HDBSCAN needs the whole matrix in memory, in double precision whatever the stored dtype.
+        data = np.asarray(embeddings, dtype = np.float64)
+        if args.normalize:
+            data = embedding_ops.l2_normalize(data)
     
-    clusterer = hdbscan.HDBSCAN(**hdbscan_kwargs)
-    labels = clusterer.fit_predict(embeddings)
+    if args.sweep:
+        ground_truth = utils.load_csv(args.ground_truth) if args.ground_truth else None
+        with utils.print_duration('Sweeping hyperparameters'):
+            results = sweep.run_sweep(data, patch_ids, hdbscan_kwargs,
+                                      args.sweep_min_samples or [args.min_samples],
+                                      args.sweep_min_cluster_size or [args.min_cluster_size],
+                                      args.sweep_cluster_selection_epsilon or [args.cluster_selection_epsilon],
+                                      args.sweep_cluster_selection_method or [args.cluster_selection_method],
+                                      ground_truth, args.sweep_workers)
+
+        results.to_csv(sweep_results_path, index = False)
+        print(results.head(10).to_string(index = False))
+        print(f'Process completed. {len(results)} combinations evaluated, results saved to {sweep_results_path}.')
+        return
+
+    # The prediction data lets --assign predict the cluster of new faces. HDBSCAN does not support
+    # it for a precomputed graph.
+    save_clusterer = args.save_clusterer and not args.accelerate and not args.two_stage
+
+    with utils.print_duration('Clustering'):
+        if args.two_stage:
+            labels = microclusters.cluster_weighted(data, weights, hdbscan_kwargs)[micro_labels]
+        else:
+            clusterer = hdbscan.HDBSCAN(**hdbscan_kwargs, prediction_data = save_clusterer)
+            labels = clusterer.fit_predict(data)
 
     print(f'{np.unique(labels).size - 1} clusters found.')
 
-    print('Grouping clustered faces into separate directories...')
-    group_faces_images(cropped_faces_dir, clustered_faces_dir, labels)
+    if args.two_stage and args.compare_exact:
+        with utils.print_duration(f'Clustering {args.compare_exact} embeddings in two stages and exactly for comparison'):
+            scores = microclusters.compare_with_exact(face_embeddings, args.compare_exact, n_micro_clusters, exact_kwargs, args.normalize,
+                                                      args.micro_epochs, args.max_memory << 20, args.chunk_size)
+        print(', '.join(f'{name}: {value:.3f}' if isinstance(value, float) else f'{name}: {value}' for name, value in scores.items()))
+
+    if save_clusterer:
+        with utils.print_duration('Saving the clusterer'):
+            assign.save_clusterer(clusterer_path, clusterer, patch_ids, args.normalize)
+
+    # Labels of the previous run tell which faces changed cluster when updating the clusters directory.
+    previous_labels = None
+    if args.update and cluster_labels_path.is_file() and clustered_faces_dir.is_dir():
+        previous_labels = utils.load_csv(cluster_labels_path)
+
+    pd.DataFrame({'id': patch_ids, 'label': labels}).to_csv(cluster_labels_path, index = False)
+    assigned_ids_path.unlink(missing_ok = True)
+
+    if args.group_faces:
+        with utils.print_duration('Grouping clustered faces into separate directories'):
+            n_missing = group_faces_images(cropped_faces_dir, clustered_faces_dir, patch_ids, labels,
+                                           args.materialize, args.materialize_workers, previous_labels)
+        if n_missing:
+            print(f'{n_missing} extracted faces were not found and could not be grouped.')
 
     print(f'Process completed.')
 
@@ -84,27 +210,266 @@ def parse_args():
                         default = True,
                         help = 'Whether or not to store the cache for the HDBSCAN algorithm. This may help speed up consecutive runs.')
     
-    args = parser.parse_args()
+    parser.add_argument('-g', '--group_faces',
+                        action = argparse.BooleanOptionalAction,
+                        default = True,
+                        help = 'Whether or not to copy all faces into one subfolder per cluster. Without it, only the labels are saved and export_faces.py can be used to export the clusters to review.')
+    
+    parser.add_argument('--materialize',
+                        choices = ['hardlink', 'symlink', 'reflink', 'copy'],
+                        default = 'hardlink',
+                        help = 'How faces are placed into the clusters directory. Hardlinks and reflinks take no extra space and fall back to copies where the filesystem does not support them. Faces extracted with --crop_format packed are always copied.')
 
-    return args
+    parser.add_argument('--materialize_workers',
+                        type = int,
+                        default = 8,
+                        help = 'Number of threads placing faces into the clusters directory.')
 
+    parser.add_argument('-u', '--update',
+                        action = argparse.BooleanOptionalAction,
+                        default = False,
+                        help = 'Whether or not to update the existing clusters directory instead of recreating it. Each cluster is matched to the existing folder holding most of its faces, whatever its number or name. Only faces whose cluster changed since the previous run are moved, new faces are added and faces which are not clustered anymore are removed. Other faces are left where they are, including in renamed folders.')
+
+    parser.add_argument('-a', '--accelerate',
+                        action = argparse.BooleanOptionalAction,
+                        default = False,
+                        help = 'Whether or not to run HDBSCAN on a precomputed sparse graph of the nearest neighbours of each face, instead of letting it compute all pairwise distances. Much faster on large collections. Only supports the euclidean metric.')
 
+    parser.add_argument('-k', '--knn',
+                        type = int,
+                        default = 30,
+                        help = 'Number of nearest neighbours of each face kept in the graph when using --accelerate. Must be at least --min_samples.')
 
-def group_faces_images(cropped_faces_dir, clustered_faces_dir, labels):
+    parser.add_argument('-l', '--normalize',
+                        action = argparse.BooleanOptionalAction,
+                        default = False,
+                        help = 'Whether or not to scale embeddings to unit length before clustering, so that euclidean distances rank faces like cosine distances.')
+
+    parser.add_argument('-p', '--pca_dims',
+                        type = int,
+                        default = 0,
+                        help = 'Number of dimensions the embeddings are reduced to with PCA when using --accelerate. 0 disables the reduction.')
+
+    parser.add_argument('--whiten',
+                        action = argparse.BooleanOptionalAction,
+                        default = False,
+                        help = 'Whether or not to scale the PCA components to unit variance.')
+
+    parser.add_argument('--chunk_size',
+                        type = int,
+                        default = 4096,
+                        help = 'Number of embeddings processed at once when using --accelerate. Memory use grows with its square.')
     
-    # Delete folder if already existing and create subdirectory structure.
-    if clustered_faces_dir.is_dir():
-        shutil.rmtree(clustered_faces_dir)
-    clustered_faces_dir.mkdir()
-    cluster_dir_paths = {label: clustered_faces_dir / str(label) for label in np.unique(labels)}
+    parser.add_argument('--sweep',
+                        action = argparse.BooleanOptionalAction,
+                        default = False,
+                        help = 'Whether or not to evaluate every combination of the --sweep_* hyperparameters instead of clustering once. The HDBSCAN hierarchy is built once per min_samples value and reused for all other hyperparameters. Results are saved to a CSV in the work directory and nothing is grouped.')
+
+    parser.add_argument('--sweep_min_samples',
+                        type = int,
+                        nargs = '+',
+                        help = 'Values of --min_samples to sweep. Defaults to the value of --min_samples.')
+
+    parser.add_argument('--sweep_min_cluster_size',
+                        type = int,
+                        nargs = '+',
+                        help = 'Values of --min_cluster_size to sweep. Defaults to the value of --min_cluster_size.')
+
+    parser.add_argument('--sweep_cluster_selection_epsilon',
+                        type = float,
+                        nargs = '+',
+                        help = 'Values of --cluster_selection_epsilon to sweep. Defaults to the value of --cluster_selection_epsilon.')
+
+    parser.add_argument('--sweep_cluster_selection_method',
+                        nargs = '+',
+                        choices = ['eom', 'leaf'],
+                        help = 'Values of --cluster_selection_method to sweep. Defaults to the value of --cluster_selection_method.')
+
+    parser.add_argument('--sweep_workers',
+                        type = int,
+                        default = os.cpu_count(),
+                        help = 'Number of processes evaluating hyperparameters in parallel when using --sweep.')
+
+    parser.add_argument('--ground_truth',
+                        type = pathlib.Path,
+                        default = None,
+                        help = 'CSV with columns "id" and "label" giving the person of a subset of faces, e.g. a labels CSV written by cluster.py and corrected by hand. When using --sweep, each combination is scored against it.')
     
-    for directory in cluster_dir_paths.values():
-       directory.mkdir()
-       
-    # Copy cropped faces.
-    for image_id, label in enumerate(tqdm(labels, ascii = True, desc = 'Files copied')):
-        image_filename = f"{image_id}.png"
-        shutil.copy(cropped_faces_dir / image_filename, cluster_dir_paths[label] / image_filename)
+    parser.add_argument('--two_stage',
+                        action = argparse.BooleanOptionalAction,
+                        default = False,
+                        help = 'Whether or not to first compress the embeddings into micro-clusters with mini-batch k-means, reading them from disk in batches, and to run HDBSCAN on the micro-clusters instead of on every face. Makes clustering libraries of millions of faces possible in bounded memory, at some cost in accuracy. Can be combined with --accelerate, which then applies to the micro-clusters.')
+
+    parser.add_argument('--n_micro_clusters',
+                        type = int,
+                        default = 0,
+                        help = 'Number of micro-clusters with --two_stage. 0 uses two per --min_cluster_size faces.')
+
+    parser.add_argument('--micro_epochs',
+                        type = int,
+                        default = 1,
+                        help = 'Number of passes over the embeddings to fit the micro-clusters with --two_stage.')
+
+    parser.add_argument('--max_memory',
+                        type = int,
+                        default = 2048,
+                        help = 'Approximate memory in MB used to build the micro-clusters with --two_stage. Sets the number of embeddings read from disk at once.')
+
+    parser.add_argument('--compare_exact',
+                        type = int,
+                        default = 0,
+                        help = 'With --two_stage, number of randomly sampled faces clustered both in two stages and directly with HDBSCAN, with the same parameters, to report how much the two clusterings agree. The micro-clusters of the sample are clustered without --accelerate. 0 disables the comparison.')
+
+    parser.add_argument('--save_clusterer',
+                        action = argparse.BooleanOptionalAction,
+                        default = True,
+                        help = f'Whether or not to save the fitted clusterer with its prediction data to "{constants.CLUSTERER_FILENAME}", for --assign_method predict. Not available with --accelerate.')
+
+    parser.add_argument('--assign',
+                        action = argparse.BooleanOptionalAction,
+                        default = False,
+                        help = f'Whether or not to only assign the faces which were neither clustered by the last full run nor assigned since, e.g. after an incremental run of the previous steps, to its existing folders instead of clustering again. Other faces, folder names and manual changes are kept. Faces matching no folder are placed in a "{constants.PENDING_FACES_DIRNAME}" folder, and assigned again by the next run.')
+
+    parser.add_argument('--assign_method',
+                        choices = ['knn', 'predict'],
+                        default = 'knn',
+                        help = 'How faces are assigned with --assign. "knn" votes among the nearest faces currently in each folder, so it follows manual changes. "predict" uses the clusterer saved by the last full run, then maps each of its clusters to the folder most of its faces are in.')
+
+    parser.add_argument('--assign_knn',
+                        type = int,
+                        default = 10,
+                        help = 'Number of nearest faces voting for the folder of a new face with --assign_method knn.')
+
+    parser.add_argument('--assign_max_distance',
+                        type = float,
+                        default = None,
+                        help = 'Largest distance at which a face votes for the folder of a new face with --assign_method knn. Defaults to the euclidean (or euclidean_l2 with --normalize) threshold DeepFace.verify uses for the model of the embeddings.')
+
+    parser.add_argument('--assign_min_agreement',
+                        type = float,
+                        default = 0.5,
+                        help = 'Minimum fraction of the votes a folder needs to be assigned a new face with --assign_method knn.')
+
+    quality.add_arguments(parser)
+    profiling.add_arguments(parser)
+
+    args = parser.parse_args()
+
+    if args.two_stage and args.sweep:
+        parser.error('--two_stage does not support --sweep.')
+    if args.accelerate and args.metric != 'euclidean':
+        parser.error('--accelerate only supports the euclidean metric.')
+    if args.accelerate and args.knn < max(args.sweep_min_samples or [args.min_samples]):
+        parser.error('--knn must be at least --min_samples.')
+
+    return args
+
+
+
+def preprocess_embeddings(embeddings, normalize, pca_dims, whiten, chunk_size):
+    # Returns the embeddings as float32, optionally normalized and reduced with PCA. The input may
+    # be memory-mapped, it is only read chunk_size rows at a time.
+    if pca_dims <= 0 or pca_dims >= embeddings.shape[1]:
+        return embedding_ops.transform(embeddings, None, None, normalize, chunk_size)
+
+    mean, components = embedding_ops.fit_pca(embeddings, pca_dims, whiten, normalize, chunk_size)
+    return embedding_ops.transform(embeddings, mean, components, normalize, chunk_size)
+
+
+
+def group_faces_images(cropped_faces_dir, clustered_faces_dir, patch_ids, labels, mode, n_workers, previous_labels = None):
+    # Returns the number of faces which could not be grouped, as they may be missing if
+    # extract_faces was run with --save_crops none.
+    if previous_labels is not None:
+        patch_ids, labels = update_faces_images(clustered_faces_dir, patch_ids, labels, previous_labels)
+
+    else:
+        # Delete folder if already existing and create subdirectory structure.
+        if clustered_faces_dir.is_dir():
+            shutil.rmtree(clustered_faces_dir)
+        clustered_faces_dir.mkdir()
+
+    with crop_store.open_reader(cropped_faces_dir) as crop_reader:
+        return crop_store.export_faces(crop_reader, clustered_faces_dir, patch_ids, labels, mode, n_workers)
+
+
+
+def update_faces_images(clustered_faces_dir, patch_ids, labels, previous_labels):
+    # Clusters are numbered arbitrarily by every run, so each new cluster is first matched to the
+    # folder holding most of its faces, which keeps the names of renamed folders. Faces whose
+    # cluster changed since previous_labels, i.e. whose new folder is not the one most faces of
+    # their previous cluster are in, are moved to their new folder wherever they currently are in
+    # clustered_faces_dir. Other faces are left where they are, including manually moved ones, and
+    # faces which are not in patch_ids anymore are deleted. Returns the patch ids and folders of
+    # the faces which still need exporting.
+    existing_faces   = assign.scan_clustered_faces(clustered_faces_dir)
+    current_folders  = {patch_id: path.parent.name for patch_id, path in existing_faces.items()}
+    folders          = _match_folders(patch_ids, labels, current_folders)
+    previous_labels  = dict(zip(previous_labels.id, previous_labels.label))
+    previous_folders = _majority_folders(previous_labels, current_folders)
+    missing_ids, missing_folders = [], []
+    n_moved = 0
+
+    for patch_id, label in zip(patch_ids.tolist(), np.asarray(labels).tolist()):
+        folder = folders[label]
+        path   = existing_faces.pop(patch_id, None)
+        if path is None:
+            missing_ids.append(patch_id)
+            missing_folders.append(folder)
+
+        elif path.parent.name != folder and previous_folders.get(previous_labels.get(patch_id)) != folder:
+            folder_dir = clustered_faces_dir / folder
+            folder_dir.mkdir(exist_ok = True)
+            os.replace(path, folder_dir / path.name)
+            n_moved += 1
+
+    for path in existing_faces.values():
+        path.unlink()
+
+    for label_dir in clustered_faces_dir.iterdir():
+        if label_dir.is_dir() and not any(label_dir.iterdir()):
+            label_dir.rmdir()
+
+    print(f'{n_moved} faces moved, {len(existing_faces)} removed and {len(missing_ids)} to add.')
+    return np.array(missing_ids, dtype = np.int64), np.array(missing_folders, dtype = str)
+
+
+
+def _match_folders(patch_ids, labels, current_folders):
+    # Returns the folder of each label. Clusters and folders are paired one to one so as to keep
+    # as many faces as possible in place, ignoring the noise and pending folders. Clusters paired
+    # with no folder get a folder named after their label, or the next free number. Imported
+    # here, as --assign and the help of the script do not need it.
+    from scipy.optimize import linear_sum_assignment
+
+    faces   = pd.DataFrame({'label': labels, 'folder': [current_folders.get(patch_id) for patch_id in patch_ids.tolist()]})
+    faces   = faces[(faces.label >= 0) & ~faces.folder.isin([None, assign.NOISE_LABEL, constants.PENDING_FACES_DIRNAME])]
+    overlap = pd.crosstab(faces.label, faces.folder)
+    rows, columns = linear_sum_assignment(overlap.to_numpy(), maximize = True)
+
+    folders = {label: folder for label, folder, n_faces in zip(overlap.index[rows].tolist(), overlap.columns[columns], overlap.to_numpy()[rows, columns])
+               if n_faces > 0}
+    folders[-1] = assign.NOISE_LABEL
+
+    used_names = set(folders.values())
+    next_name  = 0
+    for label in np.unique(labels).tolist():
+        if label in folders:
+            continue
+        name = str(label)
+        while name in used_names:
+            name, next_name = str(next_name), next_name + 1
+        folders[label] = name
+        used_names.add(name)
+
+    return folders
+
+
+
+def _majority_folders(labels, current_folders):
+    # The folder most faces of each label are currently in, labels being a dict by patch id.
+    faces = pd.DataFrame({'label': list(labels.values()), 'folder': [current_folders.get(patch_id) for patch_id in labels]}).dropna()
+    return faces.groupby('label').folder.agg(lambda folders: folders.value_counts().idxmax()).to_dict()
 
 
 
@@ -8,7 +8,21 @@ os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'    # Set Tensorflow logging to ERROR.
 
 EXTENSION_HIST_FILENAME = 'Extensions.png'
 FACES_CSV_FILENAME      = 'Faces.csv'
+FACE_METADATA_DIRNAME   = 'Face Metadata'
+MANIFEST_FILENAME       = 'Manifest.csv'
+INVENTORY_FILENAME      = 'Inventory.csv'
 CROPPED_FACES_DIRNAME   = 'Extracted Faces'
+CROPS_INDEX_FILENAME    = 'Index.npy'
 EMBEDDINGS_FILENAME     = 'Embeddings.npy'
+EMBEDDING_IDS_FILENAME  = 'Embedding Ids.npy'
+IMAGE_HASHES_FILENAME   = 'Image Hashes.npy'
 CLUSTERED_FACES_DIRNAME = 'Clusters'
-HDBSCAN_CACHE_DIRNAME   = 'HDBSCAN Cache'
\ No newline at end of file
+CLUSTER_LABELS_FILENAME = 'Labels.csv'
+HDBSCAN_CACHE_DIRNAME   = 'HDBSCAN Cache'
+CLUSTERER_FILENAME      = 'Clusterer.joblib'
+PENDING_FACES_DIRNAME   = 'Pending'
+ASSIGNED_IDS_FILENAME   = 'Assigned Ids.npy'
+SWEEP_RESULTS_FILENAME  = 'Sweep Results.csv'
+SETTINGS_FILENAME       = 'Settings.json'
+SEARCH_INDEX_DIRNAME    = 'Search Index'
+SEARCH_RESULTS_FILENAME = 'Search Results.csv'
\ No newline at end of file
@@ -3,42 +3,66 @@
 # Constants is imported first so that it sets up the environment variables.
 import constants
 
+import os
 import pathlib
 import argparse
 import shutil
+import concurrent.futures
+from collections import defaultdict
 
 from tqdm import tqdm
 
+import assign
+import face_store
+import profiling
 import utils
 
 
 
 def main():
     args = parse_args()
-    
+    profiling.start(args.profile, args.cprofile)
+
     faces_csv_path      = args.work_dir / constants.FACES_CSV_FILENAME
+    face_store_dir      = args.work_dir / constants.FACE_METADATA_DIRNAME
     clustered_faces_dir = args.work_dir / constants.CLUSTERED_FACES_DIRNAME
-    
-    # Delete folder if already existing and (re-)create it.
-    if args.output_dir.is_dir():
+
+    # The noise and pending folders hold the faces of no cluster, not those of a person.
+    labels = args.labels
+    if args.all:
+        labels = sorted(p.name for p in clustered_faces_dir.iterdir()
+                        if p.is_dir() and p.name not in (assign.NOISE_LABEL, constants.PENDING_FACES_DIRNAME))
+
+    # Delete folder if already existing and (re-)create it, unless resuming a previous copy.
+    if args.output_dir.is_dir() and not args.resume:
         shutil.rmtree(args.output_dir)
-    args.output_dir.mkdir()
-    
-    print('Loading CSV...')
-    df = utils.load_csv(faces_csv_path)
-    
+    args.output_dir.mkdir(parents = True, exist_ok = True)
+
+    print('Finding images...')
+    images_per_label = collect_images(clustered_faces_dir, labels, face_store_dir, faces_csv_path)
+
+    # A single label is copied straight into the output directory, several into one subfolder each.
+    if len(labels) == 1:
+        destinations = {args.output_dir: images_per_label[labels[0]]}
+    else:
+        destinations = {args.output_dir / label: images for label, images in images_per_label.items()}
+
     print('Copying...')
-    num_to_copy, not_found = copy_images(clustered_faces_dir / str(args.label), args.output_dir, df)
+    num_to_copy, not_found, num_duplicates, num_skipped = copy_images(destinations, args.mode, args.resume, args.workers)
 
     print(f'Process completed.')
+    if num_duplicates:
+        print(f'{num_duplicates} images were identical to another image and were copied once.')
+    if num_skipped:
+        print(f'{num_skipped} images were already copied by a previous run.')
     if not_found:
         print(f'{len(not_found)} out of {num_to_copy} images were not found:')
-        print('\n'.join(not_found))
+        print('\n'.join(map(str, not_found)))
 
 
 
 def parse_args():
-    parser = argparse.ArgumentParser(description = "This script allows to copy all original images inside which one of the faces within a chosen directory are present.",,
+    parser = argparse.ArgumentParser(description = "This script allows to copy all original images inside which one of the faces within a chosen directory are present.",
                                      formatter_class = argparse.ArgumentDefaultsHelpFormatter)
 
     parser.add_argument('-w', '--work_dir',
@@ -46,52 +70,153 @@ def parse_args():
                         type = pathlib.Path,
                         help = 'Output directory from step extract_faces. It contains the extracted faces and the CSV.')
 
-    parser.add_argument('-l', '--label',
-                        required = True,
+    labels = parser.add_mutually_exclusive_group(required = True)
+
+    labels.add_argument('-l', '--label', '--labels',
+                        dest = 'labels',
+                        nargs = '+',
                         type = str,
-                        help = 'Label of the cluster to extract original images of.')
+                        help = 'Label(s) of the cluster(s) to extract original images of. With several labels, the images of each are copied into a subfolder named after it.')
+
+    labels.add_argument('-a', '--all',
+                        action = 'store_true',
+                        help = f'Extract original images of every cluster, each into a subfolder named after it. The "{assign.NOISE_LABEL}" folder of faces in no cluster and the "{constants.PENDING_FACES_DIRNAME}" folder of faces cluster.py --assign matched to no cluster are skipped.')
 
     parser.add_argument('-o', '--output_dir',
                         required = True,
                         type = pathlib.Path,
                         help = 'Output directory in which to copy original images containing the selected cropped faces.')
 
+    parser.add_argument('-m', '--mode',
+                        choices = ['copy', 'hardlink', 'reflink', 'symlink'],
+                        default = 'copy',
+                        help = 'How original images are placed into the output directory. Hardlinks and reflinks take no extra space and fall back to copies where the filesystem does not support them.')
+
+    parser.add_argument('-j', '--workers',
+                        type = int,
+                        default = 8,
+                        help = 'Number of threads copying images in parallel.')
+
+    parser.add_argument('-r', '--resume',
+                        action = argparse.BooleanOptionalAction,
+                        default = False,
+                        help = 'Whether or not to keep the output directory of a previous run and skip images which were already copied, i.e. whose copy has the same size and contents.')
+
+    profiling.add_arguments(parser)
+
     args = parser.parse_args()
-    
+
     return args
 
 
 
-def get_unused_destination_path(output_dir, basename):
-    # If basename already exists in output_dir, preserve both files.
+def collect_images(clustered_faces_dir, labels, face_store_dir, faces_csv_path = None):
+    # Returns, for each label, the sorted original images containing a face of its folder. The
+    # images of all faces are looked up at once in the face metadata.
+    face_ids, face_labels = [], []
+    for label in labels:
+        for entry in os.scandir(clustered_faces_dir / str(label)):
+            stem = os.path.splitext(entry.name)[0]
+            if stem.isdigit():
+                face_ids.append(int(stem))
+                face_labels.append(label)
+
+    images_per_label = {label: set() for label in labels}
+    for label, image_paths in zip(face_labels, face_store.source_paths(face_store_dir, face_ids, faces_csv_path)):
+        images_per_label[label].update(image_paths)
+
+    return {label: sorted(map(pathlib.Path, images)) for label, images in images_per_label.items()}
+
+
+
+def assign_destination_names(image_paths):
+    # If several images share a basename, preserve all of them by appending " (i)" to all but the
+    # first. Names are assigned from a table in memory rather than by probing the filesystem, and
+    # depend only on the images, so that a resumed run gives each image the same name again.
+    used_names = set()
+    next_index = defaultdict(int)
+    names      = []
+
+    for image_path in image_paths:
+        name = image_path.name
+        while name in used_names:
+            next_index[image_path.name] += 1
+            name = f'{image_path.stem} ({next_index[image_path.name]}){image_path.suffix}'
+
+        used_names.add(name)
+        names.append(name)
+
+    return names
+
+
+
+def _stat_size(path):
+    try:
+        return os.stat(path).st_size
+    except FileNotFoundError:
+        return None
+
 
-    destination_path = output_dir / basename
-    stem = destination_path.stem
-    i = 0
 
-    while destination_path.is_file():
-        i += 1
-        destination_path = destination_path.with_stem(f'{stem} ({i})')
+def copy_images(destinations, mode, resume, n_workers):
+    # destinations maps each output directory to the images to copy into it. Byte-identical images
+    # are only copied once per directory. Returns the number of images, the images not found, the
+    # number of duplicates and the number of images skipped as already copied.
+    with concurrent.futures.ThreadPoolExecutor(n_workers) as executor:
+        all_images = sorted({image for images in destinations.values() for image in images})
+        sizes      = dict(zip(all_images, executor.map(_stat_size, all_images)))
 
-    return destination_path
+        # Only images whose size is shared with another image can be duplicates and need hashing.
+        images_per_size = defaultdict(list)
+        for image, size in sizes.items():
+            if size is not None:
+                images_per_size[size].append(image)
+        to_hash = [image for images in images_per_size.values() if len(images) > 1 for image in images]
+        with profiling.stage('hash'):
+            hashes = dict(zip(to_hash, executor.map(utils.hash_file, to_hash)))
 
+        not_found      = [image for image, size in sizes.items() if size is None]
+        num_duplicates = 0
+        copies         = []
 
+        for output_dir, images in destinations.items():
+            output_dir.mkdir(exist_ok = True)
+            seen_hashes = set()
+            unique      = []
+            for image in images:
+                if sizes[image] is None:
+                    continue
+                if image in hashes:
+                    if hashes[image] in seen_hashes:
+                        num_duplicates += 1
+                        continue
+                    seen_hashes.add(hashes[image])
+                unique.append(image)
 
-def copy_images(selected_dir, output_dir, df):
-    patch_ids = [int(p.stem) for p in selected_dir.iterdir()]
-    images_to_copy = [pathlib.Path(p) for p in df[df.id.isin(patch_ids)].image_path.unique()]
+            copies += [(image, output_dir / name) for image, name in zip(unique, assign_destination_names(unique))]
 
-    images_not_found = []
-    for image_path in tqdm(images_to_copy, ascii = True, desc = 'Files copied'):
+        def copy(image, destination_path):
+            if resume and os.path.lexists(destination_path):
+                if _is_same_file(image, destination_path, sizes[image], hashes.get(image)):
+                    return True
+                os.unlink(destination_path)
 
-        if not image_path.is_file():
-            images_not_found.append(image_path)
-            continue
+            with profiling.stage('copy'):
+                utils.link_file(image, destination_path, mode)
+            profiling.count('bytes_copied', sizes[image])
+            return False
 
-        destination_path = get_unused_destination_path(output_dir, image_path.name)
-        shutil.copy(image_path, destination_path)
+        skipped = executor.map(copy, *zip(*copies)) if copies else []
+        num_skipped = sum(tqdm(skipped, total = len(copies), ascii = True, desc = 'Files copied'))
 
-    return len(images_to_copy), images_not_found
+    return len(all_images), not_found, num_duplicates, num_skipped
+
+
+
+def _is_same_file(image_path, destination_path, size, content_hash):
+    if _stat_size(destination_path) != size:
+        return False
+    return utils.hash_file(destination_path) == (content_hash or utils.hash_file(image_path))
 
 
 
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+
+# Constants is imported first so that it sets up the environment variables.
+import constants
+
+import os
+import mmap
+import threading
+import concurrent.futures
+
+import cv2
+import numpy as np
+from tqdm import tqdm
+
+import array_store
+import profiling
+import utils
+
+
+_INDEX_DTYPE = np.dtype([('id', '<i8'), ('shard', '<i4'), ('length', '<i4'), ('offset', '<i8')])
+
+
+
+def _shard_path(cropped_faces_dir, shard):
+    return cropped_faces_dir / f'Shard {shard:05d}.bin'
+
+
+
+def _existing_format(cropped_faces_dir):
+    if (cropped_faces_dir / constants.CROPS_INDEX_FILENAME).is_file():
+        return 'packed'
+    if any(cropped_faces_dir.glob('*.png')):
+        return 'png'
+    return None
+
+
+
+class PngCropWriter:
+    # Saves each face as its own PNG file, named after its patch id.
+
+    def __init__(self, cropped_faces_dir):
+        self.cropped_faces_dir = cropped_faces_dir
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+    def write(self, patch_id, image):
+        with profiling.stage('encode'):
+            success, encoded = cv2.imencode('.png', image)
+        if not success:
+            raise ValueError(f'Failed to encode face {patch_id}!')
+
+        with profiling.stage('save'), open(self.cropped_faces_dir / f"{patch_id}.png", 'wb') as file:
+            file.write(encoded.tobytes())
+        profiling.count('bytes_written', len(encoded))
+
+
+    def commit(self):
+        pass
+
+
+    def retain(self, patch_ids):
+        # Deletes faces not in patch_ids, including those saved by an interrupted run.
+        patch_ids = set(patch_ids)
+        for entry in os.scandir(self.cropped_faces_dir):
+            stem, extension = os.path.splitext(entry.name)
+            if extension == '.png' and stem.isdigit() and int(stem) not in patch_ids:
+                os.unlink(entry.path)
+
+
+
+class PackedCropWriter:
+    # Appends PNG-encoded faces to a few large shard files instead of one file per face. Each face
+    # is located by a row (id, shard, length, offset) of an index stored as an AppendableArray, whose
+    # committed rows only refer to data already flushed to the shards. write() is thread-safe.
+
+    def __init__(self, cropped_faces_dir, shard_size):
+        self.cropped_faces_dir = cropped_faces_dir
+        self.shard_size        = shard_size
+        self._index            = array_store.AppendableArray(cropped_faces_dir / constants.CROPS_INDEX_FILENAME, _INDEX_DTYPE, ())
+        self._lock             = threading.Lock()
+
+        # Shards are append-only, a new one is started by every run and whenever one is full.
+        index         = self._index.read()
+        self._shard   = int(index['shard'].max()) + 1 if len(index) else 0
+        self._file    = open(_shard_path(cropped_faces_dir, self._shard), 'ab')
+        self._pending = []
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+    def write(self, patch_id, image):
+        with profiling.stage('encode'):
+            success, encoded = cv2.imencode('.png', image)
+        if not success:
+            raise ValueError(f'Failed to encode face {patch_id}!')
+
+        profiling.count('bytes_written', len(encoded))
+        with profiling.stage('save'), self._lock:
+            if self._file.tell() + len(encoded) > self.shard_size and self._file.tell() > 0:
+                self._file.close()
+                self._shard += 1
+                self._file = open(_shard_path(self.cropped_faces_dir, self._shard), 'ab')
+
+            self._pending.append((patch_id, self._shard, len(encoded), self._file.tell()))
+            self._file.write(encoded.tobytes())
+
+
+    def commit(self):
+        with self._lock:
+            self._file.flush()
+            self._index.append(np.array(self._pending, dtype = _INDEX_DTYPE))
+            self._index.commit()
+            self._pending = []
+
+
+    def retain(self, patch_ids):
+        # Drops index rows of faces not in patch_ids. Their bytes stay in the shards but are never read.
+        index = self._index.read()
+        keep  = np.isin(index['id'], patch_ids)
+        del index
+        if not keep.all():
+            self._index.compact(keep)
+
+
+    def close(self):
+        self._file.close()
+        self._index.close()
+
+
+
+def open_writer(cropped_faces_dir, crop_format, shard_size):
+    existing_format = _existing_format(cropped_faces_dir)
+    if existing_format not in (None, crop_format):
+        raise ValueError(f'Faces in {cropped_faces_dir} are saved as {existing_format}, they cannot be extended with {crop_format} faces!')
+
+    if crop_format == 'packed':
+        return PackedCropWriter(cropped_faces_dir, shard_size)
+    return PngCropWriter(cropped_faces_dir)
+
+
+
+class PngCropReader:
+
+    def __init__(self, cropped_faces_dir):
+        self.cropped_faces_dir = cropped_faces_dir
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+    def read(self, patch_id):
+        image = cv2.imread(str(self.cropped_faces_dir / f"{patch_id}.png"), cv2.IMREAD_COLOR)
+        if image is None:
+            raise FileNotFoundError(f'Face {patch_id} not found in {self.cropped_faces_dir}!')
+        return image
+
+
+    def export(self, patch_id, path, mode = 'copy'):
+        utils.link_file(self.cropped_faces_dir / f"{patch_id}.png", path, mode)
+
+
+
+class PackedCropReader:
+    # Random access to the faces of a PackedCropWriter through memory maps of its shards.
+
+    def __init__(self, cropped_faces_dir):
+        self.cropped_faces_dir = cropped_faces_dir
+
+        # When a face was written several times, e.g. by a resumed run, its last row wins.
+        index = np.load(cropped_faces_dir / constants.CROPS_INDEX_FILENAME)[::-1]
+        _, last_rows = np.unique(index['id'], return_index = True)
+        self._index  = index[last_rows]
+        self._shards = {}
+        self._lock   = threading.Lock()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+    def read_bytes(self, patch_id):
+        row = np.searchsorted(self._index['id'], patch_id)
+        if row == len(self._index) or self._index['id'][row] != patch_id:
+            raise FileNotFoundError(f'Face {patch_id} not found in {self.cropped_faces_dir}!')
+
+        _, shard, length, offset = self._index[row]
+        return self._get_shard(shard)[offset:offset + length]
+
+
+    def read(self, patch_id):
+        return cv2.imdecode(np.frombuffer(self.read_bytes(patch_id), dtype = np.uint8), cv2.IMREAD_COLOR)
+
+
+    def export(self, patch_id, path, mode = 'copy'):
+        # Faces are stored PNG-encoded, so they are written out without decoding them. They are
+        # always copied whatever the mode, as there is no file to link to. An existing file is
+        # removed first, as it may be a link whose target must not be overwritten.
+        if os.path.lexists(path):
+            os.remove(path)
+        with open(path, 'wb') as file:
+            file.write(self.read_bytes(patch_id))
+
+
+    def close(self):
+        for shard_file, shard_map in self._shards.values():
+            shard_map.close()
+            shard_file.close()
+        self._shards = {}
+
+
+    def _get_shard(self, shard):
+        with self._lock:
+            if shard not in self._shards:
+                shard_file = open(_shard_path(self.cropped_faces_dir, shard), 'rb')
+                self._shards[shard] = (shard_file, mmap.mmap(shard_file.fileno(), 0, access = mmap.ACCESS_READ))
+            return self._shards[shard][1]
+
+
+
+def open_reader(cropped_faces_dir):
+    if _existing_format(cropped_faces_dir) == 'packed':
+        return PackedCropReader(cropped_faces_dir)
+    return PngCropReader(cropped_faces_dir)
+
+
+
+def merge_crops(cropped_faces_dirs, id_offsets, output_dir, mode = 'hardlink'):
+    # Places the faces of several directories into output_dir, shifting the ids of each by its
+    # offset. Faces are linked rather than copied depending on mode: PNG files one by one under
+    # their new name, and packed shards as a whole, renumbered, with a new index.
+    output_dir.mkdir(parents = True)
+    formats = {_existing_format(cropped_faces_dir) for cropped_faces_dir in cropped_faces_dirs} - {None}
+    if len(formats) > 1:
+        raise ValueError('Faces saved as PNG files and packed faces cannot be merged!')
+
+    if formats == {'packed'}:
+        with array_store.AppendableArray(output_dir / constants.CROPS_INDEX_FILENAME, _INDEX_DTYPE, ()) as merged_index:
+            shard_offset = 0
+            for cropped_faces_dir, id_offset in zip(cropped_faces_dirs, id_offsets):
+                if _existing_format(cropped_faces_dir) is None:
+                    continue
+                index    = np.array(np.load(cropped_faces_dir / constants.CROPS_INDEX_FILENAME))
+                n_shards = int(index['shard'].max()) + 1 if len(index) else 0
+                for shard in range(n_shards):
+                    if _shard_path(cropped_faces_dir, shard).is_file():
+                        utils.link_file(_shard_path(cropped_faces_dir, shard), _shard_path(output_dir, shard + shard_offset), mode)
+
+                index['id']    += id_offset
+                index['shard'] += shard_offset
+                merged_index.append(index)
+                shard_offset += n_shards
+            merged_index.commit()
+        return
+
+    for cropped_faces_dir, id_offset in zip(cropped_faces_dirs, id_offsets):
+        if not cropped_faces_dir.is_dir():
+            continue
+        for entry in tqdm(list(os.scandir(cropped_faces_dir)), ascii = True, desc = f'Linking faces of {cropped_faces_dir.parent.name}'):
+            stem, extension = os.path.splitext(entry.name)
+            if extension == '.png' and stem.isdigit():
+                utils.link_file(entry.path, output_dir / f'{int(stem) + id_offset}.png', mode)
+
+
+
+def export_faces(crop_reader, output_dir, patch_ids, labels, mode = 'copy', n_workers = 1):
+    # Writes each face as a PNG file in the subdirectory of output_dir named after its label, as a
+    # link or copy of the extracted face depending on mode. Returns the number of faces which were
+    # not found, e.g. when they were not saved.
+    for label in np.unique(labels):
+        (output_dir / str(label)).mkdir(parents = True, exist_ok = True)
+
+    def export(patch_id, label):
+        try:
+            with profiling.stage('copy'):
+                crop_reader.export(patch_id, output_dir / str(label) / f"{patch_id}.png", mode)
+            return False
+        except FileNotFoundError:
+            return True
+
+    with concurrent.futures.ThreadPoolExecutor(n_workers) as executor:
+        missing = executor.map(export, patch_ids, labels)
+        return sum(tqdm(missing, total = len(labels), ascii = True, desc = 'Files copied'))
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+from collections import defaultdict
+
+import cv2
+import numpy as np
+
+import array_store
+
+
+_INDEX_DTYPE = np.dtype([('hash', '<u8'), ('first_id', '<i8'), ('n_faces', '<i4')])
+_HASH_BITS   = 64
+
+
+
+def dhash(image):
+    # 64 bits difference hash: whether each pixel of a 9x8 grayscale thumbnail is brighter than
+    # its left neighbour. Robust to re-encoding, resizing and small edits.
+    gray  = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    small = cv2.resize(gray, (9, 8), interpolation = cv2.INTER_AREA)
+    return int(np.packbits(small[:, 1:] > small[:, :-1]).view('>u8')[0])
+
+
+
+def merge_indexes(index_paths, id_offsets, output_path):
+    # Concatenates the hashes of several indexes, shifting the ids of the faces of each by its offset.
+    with array_store.AppendableArray(output_path, _INDEX_DTYPE, ()) as merged:
+        for index_path, id_offset in zip(index_paths, id_offsets):
+            if not index_path.is_file():
+                continue
+            index = np.array(np.load(index_path))
+            index['first_id'] = np.where(index['n_faces'] > 0, index['first_id'] + id_offset, index['first_id'])
+            merged.append(index)
+        merged.commit()
+
+
+
+class Canonical:
+    # An image whose faces were detected, which near-duplicate images reuse. patch_ids stays None
+    # until the faces are given their ids. file_idx is the index of its file in the current run,
+    # or -1 for images of previous runs.
+    __slots__ = ('hash', 'file_idx', 'patch_ids')
+
+    def __init__(self, hash, file_idx, patch_ids = None):
+        self.hash      = hash
+        self.file_idx  = file_idx
+        self.patch_ids = patch_ids
+
+
+
+class DuplicateIndex:
+    # Persistent index of the hashes of canonical images, stored as an AppendableArray of (hash,
+    # first_id, n_faces) rows. Near-duplicates within max_distance bits are found with a multi-index
+    # search: hashes are split into max_distance + 1 chunks, of which at least one is identical
+    # between two hashes within max_distance bits, so only hashes sharing a chunk are compared.
+
+    def __init__(self, path, max_distance):
+        self.max_distance = max_distance
+        self._store       = array_store.AppendableArray(path, _INDEX_DTYPE, ())
+
+        n_chunks      = max_distance + 1
+        bounds        = np.linspace(0, _HASH_BITS, n_chunks + 1).astype(int)
+        self._chunks  = [(int(start), (1 << int(end - start)) - 1) for start, end in zip(bounds[:-1], bounds[1:])]
+        self._load()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+    def find(self, hash, max_file_idx):
+        # Returns a canonical image within max_distance bits of hash whose file comes no later than
+        # max_file_idx, so that its faces always have ids when the duplicate's are assigned.
+        for table, (shift, mask) in zip(self._tables, self._chunks):
+            for canonical in table.get((hash >> shift) & mask, ()):
+                if canonical.file_idx <= max_file_idx and bin(canonical.hash ^ hash).count('1') <= self.max_distance:
+                    return canonical
+        return None
+
+
+    def add(self, hash, file_idx):
+        canonical = Canonical(hash, file_idx)
+        self._insert(canonical)
+        return canonical
+
+
+    def commit(self, canonicals):
+        rows = [(canonical.hash, canonical.patch_ids.start if len(canonical.patch_ids) else -1, len(canonical.patch_ids))
+                for canonical in canonicals]
+        self._store.append(np.array(rows, dtype = _INDEX_DTYPE))
+        self._store.commit()
+
+
+    def retain(self, patch_ids):
+        # Drops canonical images whose faces are not in patch_ids anymore. Images without faces are
+        # kept, as their detection result does not depend on any face.
+        index = self._store.read()
+        keep  = (index['n_faces'] == 0) | np.isin(index['first_id'], patch_ids)
+        del index
+        if not keep.all():
+            self._store.compact(keep)
+            self._load()
+
+
+    def close(self):
+        self._store.close()
+
+
+    def _load(self):
+        self._tables = [defaultdict(list) for _ in self._chunks]
+        for hash, first_id, n_faces in self._store.read().tolist():
+            self._insert(Canonical(hash, -1, range(first_id, first_id + n_faces) if n_faces else range(0)))
+
+
+    def _insert(self, canonical):
+        for table, (shift, mask) in zip(self._tables, self._chunks):
+            table[(canonical.hash >> shift) & mask].append(canonical)
\ No newline at end of file
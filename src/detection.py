@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+# Constants is imported first so that it sets up the environment variables.
+import constants as _
+
+import random
+from collections import Counter
+
+import image_io
+import model_client
+import profiling
+
+
+# Candidates of the first stage are expanded by this fraction of their size on every side, so
+# that the second detector sees the whole head and some context.
+_REGION_MARGIN = 0.5
+# Beyond this fraction of the image covered by regions, the second stage runs on the whole image.
+_MAX_REGIONS_AREA = 0.5
+# Minimum intersection over union for a face of the cascade to match one of the single-stage run.
+_RECALL_IOU = 0.5
+
+
+
+def detect_faces(image, detector_name, align_output_faces, min_confidence, min_size):
+    # Returns (face, box, confidence, eyes) for each face detected in image, box being (x, y, w, h)
+    # in its pixels and eyes the (x, y) positions of both eyes, or None if the detector does not
+    # find them. Runs in the model server instead if one is connected.
+    if model_client.is_connected():
+        with profiling.stage(f'detect_{detector_name}'):
+            faces = model_client.detect(image, detector_name, align_output_faces, min_confidence, min_size)
+        profiling.count(f'faces_{detector_name}', len(faces))
+        # Tuples arrive as lists.
+        return [(face, tuple(box), confidence, tuple(map(tuple, eyes)) if eyes is not None else None)
+                for face, box, confidence, eyes in faces]
+
+    # Imported here, as loading Tensorflow takes seconds which scripts not detecting faces, or
+    # showing their help, should not wait for.
+    from deepface import DeepFace
+
+    with profiling.stage(f'detect_{detector_name}'):
+        results = DeepFace.extract_faces(image,
+                                         detector_name,
+                                         align = align_output_faces,
+                                         enforce_detection = False,
+                                         color_face = 'bgr',
+                                         normalize_face = False,
+                                         anti_spoofing = False)
+
+    faces = []
+    for result in results:
+        if result['confidence'] < min_confidence:
+            continue
+
+        height, width, _ = result['face'].shape
+        if any(e < min_size for e in (height, width)):
+            continue
+
+        profiling.count(f'faces_{detector_name}')
+        area = result['facial_area']
+        eyes = (area.get('left_eye'), area.get('right_eye'))
+        faces.append((result['face'], (area['x'], area['y'], area['w'], area['h']), result['confidence'],
+                      eyes if all(eye is not None for eye in eyes) else None))
+
+    return faces
+
+
+
+class CascadeDetector:
+    # Runs a fast detector on a downscaled copy of each image, and the main detector only on the
+    # regions of the full resolution image around its candidates, so that images without faces
+    # are rejected cheaply and min_size keeps applying to full resolution faces. A fraction of the
+    # images is also run through the main detector alone, to measure the recall of the cascade.
+
+    def __init__(self, prefilter_name, prefilter_max_size, prefilter_confidence,
+                 detector_name, align_output_faces, min_confidence, min_size, recall_sample_rate):
+        self.prefilter_name       = prefilter_name
+        self.prefilter_max_size   = prefilter_max_size
+        self.prefilter_confidence = prefilter_confidence
+        self.detector_name        = detector_name
+        self.align_output_faces   = align_output_faces
+        self.min_confidence       = min_confidence
+        self.min_size             = min_size
+        self.recall_sample_rate   = recall_sample_rate
+        self.counters             = Counter()
+        self._random              = random.Random(0)
+
+
+    def __call__(self, image):
+        faces = self._detect(image)
+
+        if self.recall_sample_rate > 0 and self._random.random() < self.recall_sample_rate:
+            reference = detect_faces(image, self.detector_name, self.align_output_faces, self.min_confidence, self.min_size)
+            self.counters['recall_images']    += 1
+            self.counters['reference_faces']  += len(reference)
+            self.counters['recovered_faces']  += sum(any(_iou(box, found) >= _RECALL_IOU for _, found, _, _ in faces) for _, box, _, _ in reference)
+
+        return faces
+
+
+    def report(self):
+        counters = self.counters
+        lines = [f'Cascade: {counters["images"]} images, {counters["rejected_prefilter"]} rejected by {self.prefilter_name}, '
+                 f'{counters["rejected_detector"]} more rejected by {self.detector_name} '
+                 f'({counters["region_runs"]} runs on regions, {counters["full_runs"]} on whole images).']
+        if counters['recall_images']:
+            recall = counters['recovered_faces'] / counters['reference_faces'] if counters['reference_faces'] else 1.0
+            lines.append(f'Cascade recall on {counters["recall_images"]} sampled images: {recall:.3f} '
+                         f'({counters["recovered_faces"]} of {counters["reference_faces"]} faces found by {self.detector_name} alone).')
+        return '\n'.join(lines)
+
+
+    def _detect(self, image):
+        self.counters['images'] += 1
+
+        small = image_io.downscale_image(image, self.prefilter_max_size)
+        scale = image.shape[1] / small.shape[1]
+        candidates = [tuple(round(e * scale) for e in box)
+                      for _, box, _, _ in detect_faces(small, self.prefilter_name, False, self.prefilter_confidence, 0)]
+
+        if not candidates:
+            self.counters['rejected_prefilter'] += 1
+            return []
+
+        height, width = image.shape[:2]
+        regions = _merge_boxes([_expand_box(box, width, height) for box in candidates])
+
+        faces = []
+        if sum(w * h for _, _, w, h in regions) > _MAX_REGIONS_AREA * width * height:
+            self.counters['full_runs'] += 1
+            faces = detect_faces(image, self.detector_name, self.align_output_faces, self.min_confidence, self.min_size)
+        else:
+            self.counters['region_runs'] += 1
+            for x, y, w, h in regions:
+                for face, (fx, fy, fw, fh), confidence, eyes in detect_faces(image[y:y + h, x:x + w], self.detector_name, self.align_output_faces, self.min_confidence, self.min_size):
+                    if eyes is not None:
+                        eyes = tuple((ex + x, ey + y) for ex, ey in eyes)
+                    faces.append((face, (fx + x, fy + y, fw, fh), confidence, eyes))
+
+        if not faces:
+            self.counters['rejected_detector'] += 1
+        return faces
+
+
+
+def _expand_box(box, width, height):
+    x, y, w, h = box
+    margin = round(_REGION_MARGIN * max(w, h))
+    x0, y0 = max(0, x - margin), max(0, y - margin)
+    x1, y1 = min(width, x + w + margin), min(height, y + h + margin)
+    return x0, y0, x1 - x0, y1 - y0
+
+
+
+def _merge_boxes(boxes):
+    # Replaces overlapping boxes by their bounding box until none overlap, so that no face is
+    # detected twice by the second stage.
+    boxes  = list(boxes)
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                if _intersection(boxes[i], boxes[j]) > 0:
+                    (x0, y0, w0, h0), (x1, y1, w1, h1) = boxes[i], boxes.pop(j)
+                    x, y = min(x0, x1), min(y0, y1)
+                    boxes[i] = (x, y, max(x0 + w0, x1 + w1) - x, max(y0 + h0, y1 + h1) - y)
+                    merged = True
+                    break
+            if merged:
+                break
+    return boxes
+
+
+
+def _intersection(a, b):
+    w = min(a[0] + a[2], b[0] + b[2]) - max(a[0], b[0])
+    h = min(a[1] + a[3], b[1] + b[3]) - max(a[1], b[1])
+    return max(0, w) * max(0, h)
+
+
+
+def _iou(a, b):
+    intersection = _intersection(a, b)
+    union = a[2] * a[3] + b[2] * b[3] - intersection
+    return intersection / union if union else 0
\ No newline at end of file
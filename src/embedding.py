@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+# Constants is imported first so that it sets up the environment variables.
+import constants as _
+
+import numpy as np
+
+import model_client
+import profiling
+
+
+
+class FaceEmbedder:
+    # Computes the same embeddings as DeepFace.represent(..., detector_backend = 'skip'), but builds
+    # the model once and runs keras models on whole batches of faces instead of one face at a time.
+    # If a model server is connected, faces are preprocessed and embedded there instead.
+
+    def __init__(self, model_name, normalization):
+        self.model_name    = model_name
+        self.normalization = normalization
+        self.remote        = model_client.is_connected()
+        if self.remote:
+            return
+
+        # Imported here, as loading Tensorflow takes seconds which scripts not creating embeddings,
+        # or showing their help, should not wait for. Deepface's preprocessing imports it too.
+        from deepface import DeepFace
+        from deepface.modules import preprocessing
+
+        self.client        = DeepFace.build_model(model_name)
+        self.preprocessing = preprocessing
+
+        # Models which are not keras models (e.g. SFace, Dlib) are run one face at a time.
+        self.supports_batches = hasattr(self.client.model, 'predict')
+
+
+    def preprocess(self, face):
+        # Same steps as DeepFace.represent: BGR to RGB, padded resize to the input shape of the
+        # model and normalization. The result has a leading batch dimension of size 1. Faces are
+        # only given that dimension when the server preprocesses them.
+        if self.remote:
+            return face[np.newaxis]
+
+        target_height, target_width = self.client.input_shape[1], self.client.input_shape[0]
+        with profiling.stage('preprocess'):
+            face = self.preprocessing.resize_image(face[:, :, ::-1], target_size = (target_height, target_width))
+            return self.preprocessing.normalize_input(face, normalization = self.normalization)
+
+
+    def embed(self, preprocessed_faces):
+        profiling.count('faces_embedded', len(preprocessed_faces))
+        with profiling.stage('embed_batch'):
+            if self.remote:
+                return model_client.embed([face[0] for face in preprocessed_faces], self.model_name, self.normalization)
+
+            if self.supports_batches:
+                return self.client.model(np.concatenate(preprocessed_faces, axis = 0), training = False).numpy()
+
+            return np.array([self.client.forward(face) for face in preprocessed_faces], dtype = np.float32)
\ No newline at end of file
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+
+# Distances of exactly 0 (duplicate faces) would be taken as missing edges of a sparse graph.
+_MIN_GRAPH_DISTANCE = 1e-10
+
+# Number of nearest representatives of other components each one is linked to before taking the
+# minimum spanning tree, which is exact as long as each of its edges joins a representative to one
+# of its nearest ones.
+_LINK_NEIGHBOURS = 16
+
+
+
+def iter_chunks(n_rows, chunk_size):
+    for start in range(0, n_rows, chunk_size):
+        yield slice(start, min(start + chunk_size, n_rows))
+
+
+
+def l2_normalize(embeddings):
+    norms = np.linalg.norm(embeddings, axis = 1, keepdims = True)
+    return embeddings / np.maximum(norms, np.finfo(embeddings.dtype).tiny)
+
+
+
+def fit_pca(embeddings, n_components, whiten, normalize, chunk_size):
+    # Streams over the (possibly memory-mapped) embeddings twice, to accumulate the mean and then
+    # the covariance matrix, so that only chunk_size rows are ever converted to float64 at once.
+    n_rows, n_dims = embeddings.shape
+
+    mean = np.zeros(n_dims)
+    for rows in iter_chunks(n_rows, chunk_size):
+        chunk = _load_chunk(embeddings, rows, normalize)
+        mean += chunk.sum(axis = 0)
+    mean /= n_rows
+
+    covariance = np.zeros((n_dims, n_dims))
+    for rows in iter_chunks(n_rows, chunk_size):
+        chunk = _load_chunk(embeddings, rows, normalize) - mean
+        covariance += chunk.T @ chunk
+    covariance /= max(n_rows - 1, 1)
+
+    eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+    order      = np.argsort(eigenvalues)[::-1][:n_components]
+    components = eigenvectors[:, order]
+    if whiten:
+        components = components / np.sqrt(np.maximum(eigenvalues[order], np.finfo(float).tiny))
+
+    return mean, components
+
+
+
+def transform(embeddings, mean, components, normalize, chunk_size):
+    # Returns the float32 projection of the embeddings, or the normalized embeddings if components is None.
+    n_dims  = embeddings.shape[1] if components is None else components.shape[1]
+    reduced = np.empty((len(embeddings), n_dims), dtype = np.float32)
+
+    for rows in iter_chunks(len(embeddings), chunk_size):
+        chunk = _load_chunk(embeddings, rows, normalize)
+        reduced[rows] = chunk if components is None else (chunk - mean) @ components
+
+    return reduced
+
+
+
+def _load_chunk(embeddings, rows, normalize):
+    chunk = np.asarray(embeddings[rows], dtype = np.float64)
+    return l2_normalize(chunk) if normalize else chunk
+
+
+
+def knn(queries, points, k, chunk_size, exclude_self = False):
+    # Exact k nearest neighbours by euclidean distance, computed block by block so that memory is
+    # bounded by chunk_size x chunk_size distances whatever the number of points. Returns
+    # (n_queries, k) arrays of neighbour indices and distances, sorted by increasing distance.
+    queries = np.asarray(queries, dtype = np.float32)
+    points  = np.asarray(points, dtype = np.float32)
+    k       = min(k, len(points) - exclude_self)
+
+    points_sq_norms = np.einsum('ij,ij->i', points, points)
+    indices   = np.empty((len(queries), k), dtype = np.int64)
+    distances = np.empty((len(queries), k), dtype = np.float32)
+
+    for query_rows in iter_chunks(len(queries), chunk_size):
+        query_chunk    = queries[query_rows]
+        query_sq_norms = np.einsum('ij,ij->i', query_chunk, query_chunk)
+        best_indices   = np.empty((len(query_chunk), 0), dtype = np.int64)
+        best_sq_dists  = np.empty((len(query_chunk), 0), dtype = np.float32)
+
+        for point_rows in iter_chunks(len(points), chunk_size):
+            sq_dists = query_sq_norms[:, None] + points_sq_norms[None, point_rows] - 2 * query_chunk @ points[point_rows].T
+            if exclude_self:
+                # Queries are the points themselves, each query is excluded from its own neighbours.
+                own_rows = np.arange(query_rows.start, query_rows.stop)
+                inside   = (own_rows >= point_rows.start) & (own_rows < point_rows.stop)
+                sq_dists[inside, own_rows[inside] - point_rows.start] = np.inf
+
+            candidate_indices  = np.concatenate([best_indices, np.broadcast_to(np.arange(point_rows.start, point_rows.stop), sq_dists.shape)], axis = 1)
+            candidate_sq_dists = np.concatenate([best_sq_dists, sq_dists], axis = 1)
+
+            if candidate_sq_dists.shape[1] > k:
+                keep = np.argpartition(candidate_sq_dists, k - 1, axis = 1)[:, :k]
+                candidate_indices  = np.take_along_axis(candidate_indices, keep, axis = 1)
+                candidate_sq_dists = np.take_along_axis(candidate_sq_dists, keep, axis = 1)
+            best_indices, best_sq_dists = candidate_indices, candidate_sq_dists
+
+        order = np.argsort(best_sq_dists, axis = 1)
+        indices[query_rows]   = np.take_along_axis(best_indices, order, axis = 1)
+        distances[query_rows] = np.sqrt(np.maximum(np.take_along_axis(best_sq_dists, order, axis = 1), 0))
+
+    return indices, distances
+
+
+
+def knn_distance_graph(points, k, chunk_size):
+    # Symmetric sparse matrix of the distances between each point and its k nearest neighbours,
+    # made connected so that it can be used as a precomputed distance matrix by HDBSCAN. SciPy's
+    # sparse matrices and graph routines are imported here, as they take a while to load, which
+    # scripts only using the other operations should not wait for.
+    from scipy import sparse
+
+    indices, distances = knn(points, points, k, chunk_size, exclude_self = True)
+
+    n_points = len(points)
+    rows     = np.repeat(np.arange(n_points), indices.shape[1])
+    graph    = sparse.csr_matrix((np.maximum(distances.ravel(), _MIN_GRAPH_DISTANCE), (rows, indices.ravel())), shape = (n_points, n_points))
+    graph    = graph.maximum(graph.T)
+
+    return _connect_components(graph, points, chunk_size)
+
+
+
+def _connect_components(graph, points, chunk_size):
+    # HDBSCAN rejects disconnected graphs. Components are joined along the minimum spanning tree of
+    # their most central points, with edges as long as the actual distance between these points, so
+    # that they only merge at the top of the hierarchy like distant clusters do. The tree is that of
+    # the nearest neighbours graph of these points, itself connected the same way, so that memory
+    # stays bounded however many components there are. Each component of a nearest neighbours graph
+    # has at least two points, so the recursion ends.
+    from scipy import sparse
+    from scipy.sparse import csgraph
+
+    n_components, component_labels = csgraph.connected_components(graph, directed = False)
+    if n_components == 1:
+        return graph
+
+    representatives = _central_points(points, component_labels, n_components, chunk_size)
+    rep_graph       = knn_distance_graph(np.asarray(points[representatives], dtype = np.float32), _LINK_NEIGHBOURS, chunk_size)
+    tree            = csgraph.minimum_spanning_tree(rep_graph).tocoo()
+
+    links = sparse.csr_matrix((tree.data, (representatives[tree.row], representatives[tree.col])), shape = graph.shape)
+    return graph.maximum(links).maximum(links.T).tocsr()
+
+
+
+def _central_points(points, labels, n_groups, chunk_size):
+    # Index of the point closest to the centroid of each group, streaming over the points twice.
+    sums = np.zeros((n_groups, points.shape[1]))
+    for rows in iter_chunks(len(points), chunk_size):
+        np.add.at(sums, labels[rows], np.asarray(points[rows], dtype = np.float64))
+    centroids = sums / np.bincount(labels, minlength = n_groups)[:, None]
+
+    distances = np.empty(len(points))
+    for rows in iter_chunks(len(points), chunk_size):
+        distances[rows] = np.linalg.norm(np.asarray(points[rows], dtype = np.float64) - centroids[labels[rows]], axis = 1)
+
+    # Points sorted by group, then by distance: the first point of each group is its most central.
+    order = np.lexsort((distances, labels))
+    return order[np.searchsorted(labels[order], np.arange(n_groups))]
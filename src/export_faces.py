@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+# Constants is imported first so that it sets up the environment variables.
+import constants
+
+import pathlib
+import argparse
+
+import crop_store
+import profiling
+import utils
+
+
+
+def main():
+    args = parse_args()
+    profiling.start(args.profile, args.cprofile)
+
+    cropped_faces_dir   = args.work_dir / constants.CROPPED_FACES_DIRNAME
+    cluster_labels_path = args.work_dir / constants.CLUSTER_LABELS_FILENAME
+    output_dir          = args.output_dir or args.work_dir / constants.CLUSTERED_FACES_DIRNAME
+
+    print('Loading labels...')
+    df = utils.load_csv(cluster_labels_path)
+    df = df[df.label.astype(str).isin(args.labels)]
+
+    print('Exporting faces...')
+    with crop_store.open_reader(cropped_faces_dir) as crop_reader:
+        n_missing = crop_store.export_faces(crop_reader, output_dir, df.id.to_numpy(), df.label.to_numpy(), args.materialize, args.materialize_workers)
+
+    print(f'Process completed. Exported {len(df) - n_missing} faces.')
+    if n_missing:
+        print(f'{n_missing} extracted faces were not found.')
+
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description = "This script exports the faces of selected clusters as PNG images into one subfolder per cluster, for example to review them when cluster.py was run with --no-group_faces.",
+                                     formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-w', '--work_dir',
+                        required = True,
+                        type = pathlib.Path,
+                        help = 'Output directory from step extract_faces. It contains the extracted faces and the cluster labels.')
+
+    parser.add_argument('-l', '--labels',
+                        required = True,
+                        nargs = '+',
+                        help = 'Labels of the clusters to export, as found in the labels CSV written by cluster.py.')
+
+    parser.add_argument('-o', '--output_dir',
+                        type = pathlib.Path,
+                        default = None,
+                        help = 'Directory in which to export the faces. Defaults to the clusters directory of the work directory.')
+
+    parser.add_argument('--materialize',
+                        choices = ['hardlink', 'symlink', 'reflink', 'copy'],
+                        default = 'hardlink',
+                        help = 'How faces are exported. Hardlinks and reflinks take no extra space and fall back to copies where the filesystem does not support them. Faces extracted with --crop_format packed are always copied.')
+
+    parser.add_argument('--materialize_workers',
+                        type = int,
+                        default = 8,
+                        help = 'Number of threads exporting faces.')
+
+    profiling.add_arguments(parser)
+
+    args = parser.parse_args()
+
+    return args
+
+
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
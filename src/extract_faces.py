@@ -3,54 +3,127 @@
 # Constants is imported first so that it sets up the environment variables.
 import constants
 
+import os
 import pathlib
 import argparse
-import csv
 import contextlib
 from shutil import rmtree
-from collections import Counter
+from functools import partial
+from collections import Counter, defaultdict
 
-import matplotlib.pyplot as plt
-from deepface import DeepFace
+import numpy as np
 from tqdm import tqdm
 
+import ann_index
+import array_store
+import crop_store
+import dedupe
+import detection
+import embedding
+import face_store
 import image_io
+import inventory
+import manifest
+import model_client
+import pipeline
+import profiling
+import quality
 import utils
 
 
-
-
 def main():
     args = _parse_args()
+    profiling.start(args.profile, args.cprofile)
+    model_client.connect(args.model_server)
 
     extension_hist_path = args.work_dir / constants.EXTENSION_HIST_FILENAME
     faces_csv_path      = args.work_dir / constants.FACES_CSV_FILENAME
+    face_store_dir      = args.work_dir / constants.FACE_METADATA_DIRNAME
     cropped_faces_dir   = args.work_dir / constants.CROPPED_FACES_DIRNAME
+    manifest_path       = args.work_dir / constants.MANIFEST_FILENAME
+    embeddings_path     = args.work_dir / constants.EMBEDDINGS_FILENAME
+    embedding_ids_path  = args.work_dir / constants.EMBEDDING_IDS_FILENAME
+    image_hashes_path   = args.work_dir / constants.IMAGE_HASHES_FILENAME
+    inventory_path      = args.work_dir / constants.INVENTORY_FILENAME
+    settings_path       = args.work_dir / constants.SETTINGS_FILENAME
+    search_index_dir    = args.work_dir / constants.SEARCH_INDEX_DIRNAME
     
-    if args.work_dir.is_dir():
+    if args.work_dir.is_dir() and not args.incremental:
         if not utils.user_query_yes_no(f'Folder at "{args.work_dir}" already exists. Do you want to delete its content?'):
             return
         rmtree(args.work_dir)
         
-    cropped_faces_dir.mkdir(parents = True)
-    
-    print('Counting number of files in directory...')
-    n_files, extension_counts = _count_extensions_dir_children(args.input_dir)
+    cropped_faces_dir.mkdir(parents = True, exist_ok = True)
+
+    # Recorded so that search.py detects faces in reference photos the same way.
+    utils.update_settings(settings_path, detector_name = args.detector_name, min_confidence = args.min_confidence,
+                          min_size = args.min_size, align_output_faces = args.align_output_faces)
+    # Recorded so that merge_shards.py can check that all shards were processed alike.
+    if args.shard is not None:
+        utils.update_settings(settings_path, shard = list(args.shard), input_dir = str(args.input_dir),
+                              read_videos = args.read_videos, secs_between_frames = args.secs_between_frames)
+    if args.embed:
+        utils.update_settings(settings_path, model = args.model, normalization = args.normalization)
+
+    # Work directories of previous versions listed faces in a CSV, which is moved to the store.
+    # They had no manifest, so the files of the migrated faces are recorded as processed, as they
+    # are now, for their faces to be kept rather than dropped as those of unknown files.
+    if args.incremental:
+        with face_store.FaceStoreWriter(face_store_dir) as face_writer:
+            migrated_files = face_store.migrate_legacy_csv(faces_csv_path, face_writer)
+        if migrated_files and not manifest_path.is_file():
+            with manifest.Manifest(manifest_path, args.hash_contents) as file_manifest:
+                for path, (size, mtime_ns) in migrated_files.items():
+                    file_manifest.commit(path, size, mtime_ns)
+
+    print('Listing files in directory...')
+    files = inventory.update_inventory(args.input_dir, inventory_path, args.trust_extensions, args.walk_workers, rewalk = not args.reuse_inventory)
+    if args.shard is not None:
+        files = inventory.shard_files(files, args.input_dir, *args.shard)
+        print(f'{len(files)} files belong to shard {args.shard[0]}/{args.shard[1]}.')
+    n_files, extension_counts = _count_extensions(files)
 
     print('Generating extensions histogram...')
     _plot_extensions_barchart(extension_counts, extension_hist_path)
 
     print('Starting face detection and extraction...')
-    n_faces = detect_and_extract_faces(args.input_dir,
-                                       faces_csv_path,
+    n_faces = detect_and_extract_faces(files,
+                                       face_store_dir,
                                        cropped_faces_dir,
-                                       n_files,
+                                       manifest_path,
+                                       args.hash_contents,
                                        args.read_videos,
                                        args.secs_between_frames,
+                                       args.trust_extensions,
+                                       args.video_sampling,
+                                       args.scene_threshold,
                                        args.detector_name,
                                        args.min_confidence,
                                        args.min_size,
-                                       args.align_output_faces)
+                                       args.align_output_faces,
+                                       args.prefilter_detector,
+                                       args.prefilter_max_size,
+                                       args.prefilter_confidence,
+                                       args.recall_sample_rate,
+                                       image_hashes_path if args.dedupe_distance is not None else None,
+                                       args.dedupe_distance,
+                                       args.decode_workers,
+                                       args.write_workers,
+                                       args.queue_depth,
+                                       args.save_crops,
+                                       args.thumbnail_size,
+                                       args.crop_format,
+                                       args.shard_size_mb * 2 ** 20,
+                                       embeddings_path if args.embed else None,
+                                       embedding_ids_path,
+                                       args.model,
+                                       args.normalization,
+                                       args.embeddings_dtype,
+                                       args.batch_size,
+                                       quality.thresholds(args))
+
+    if args.embed:
+        ann_index.sync_existing(search_index_dir, embeddings_path, embedding_ids_path)
 
     print(f'Process completed. Extracted {n_faces} faces from {n_files} files.')
 
@@ -81,6 +154,21 @@ def _parse_args():
                         dest = 'secs_between_frames',
                         help = 'How many seconds of video to skip between two consecutively parsed frames.')
 
+    parser.add_argument('--video_sampling',
+                        choices = ['seek', 'grab'],
+                        default = 'seek',
+                        help = 'How sampled video frames are reached. "seek" jumps to each of them, falling back to "grab" for short skips and videos which cannot be seeked reliably. "grab" goes through every intermediate frame.')
+
+    parser.add_argument('--scene_threshold',
+                        type = float,
+                        default = 0,
+                        help = 'Skip sampled video frames whose mean absolute difference with the previous kept frame, in grey levels out of 255 on small thumbnails, is below this threshold. 0 keeps all sampled frames.')
+
+    parser.add_argument('-t', '--trust_extensions', 
+                        action = argparse.BooleanOptionalAction,
+                        default = False,
+                        help = 'Whether or not to determine the type of files from their extension instead of reading their header. Extensions not known in advance are learned from the first file which has them.')
+
     parser.add_argument('-d', '--detector', 
                         default = 'retinaface',
                         dest = 'detector_name',
@@ -102,14 +190,142 @@ def _parse_args():
                         help = 'Whether or not to align the output faces. This can improve performance of subsequent steps but has a large overhead.')
 
 
+    parser.add_argument('--prefilter_detector',
+                        default = None,
+                        help = 'If set, this fast detector (e.g. "yunet", "ssd" or "opencv") first runs on a downscaled copy of each image, and the main detector only runs around the faces it finds, on the full resolution image. Images where it finds nothing are skipped.')
+
+    parser.add_argument('--prefilter_max_size',
+                        type = int,
+                        default = 640,
+                        help = 'Size of the longest side of the downscaled images given to the prefilter detector.')
+
+    parser.add_argument('--prefilter_confidence',
+                        type = float,
+                        default = 0.5,
+                        help = 'Minimum confidence score for a detection of the prefilter detector to be checked by the main detector. Lower values trade speed for recall.')
+
+    parser.add_argument('--recall_sample_rate',
+                        type = float,
+                        default = 0,
+                        help = 'Fraction of images also run through the main detector alone when using --prefilter_detector, to report the fraction of its faces which the cascade finds.')
+
+    parser.add_argument('--dedupe_distance',
+                        type = int,
+                        default = None,
+                        help = 'If set, images and video frames whose perceptual hash differs by at most this many bits (out of 64) from an already processed image are not run through the detector, and reuse the faces of that image instead. Values around 4 catch re-encoded and resized copies.')
+
+    parser.add_argument('-r', '--incremental', 
+                        action = argparse.BooleanOptionalAction,
+                        default = False,
+                        help = 'Whether or not to update an existing work directory instead of deleting it. Only new or modified files are processed, faces of deleted files are dropped and an interrupted run resumes from the last completed file.')
+
+    parser.add_argument('--reuse_inventory',
+                        action = argparse.BooleanOptionalAction,
+                        default = False,
+                        help = 'With --incremental, whether or not to take the list of files from the inventory saved in the work directory by the previous run instead of listing the input directory again.')
+
+    parser.add_argument('--walk_workers',
+                        type = int,
+                        default = 8,
+                        help = 'Number of threads listing directories and classifying new files in parallel. Mostly useful on network storage.')
+
+    parser.add_argument('--hash_contents', 
+                        action = argparse.BooleanOptionalAction,
+                        default = False,
+                        help = 'Whether or not to store a content hash of each processed file, so that files whose modification time changed but whose content did not are not processed again.')
+
+    parser.add_argument('--decode_workers', 
+                        type = int,
+                        default = max(1, (os.cpu_count() or 1) // 2),
+                        help = 'Number of processes reading and decoding images and video frames while faces are being detected. If 0, files are decoded in the main process.')
+
+    parser.add_argument('--write_workers', 
+                        type = int,
+                        default = 4,
+                        help = 'Number of threads encoding and saving extracted faces. If 0, faces are saved in the main thread.')
+
+    parser.add_argument('--queue_depth', 
+                        type = int,
+                        default = 16,
+                        help = 'Maximum number of decoded images waiting for face detection, and of processed files waiting for their faces to be saved.')
+
+    parser.add_argument('--save_crops', 
+                        default = 'full',
+                        choices = ['full', 'thumbnail', 'none'],
+                        help = 'How extracted faces are saved for the manual review of clusters. "thumbnail" saves downscaled faces and "none" saves nothing, which only makes sense together with --embed since make_embeddings reads the saved faces.')
+
+    parser.add_argument('--thumbnail_size', 
+                        type = int,
+                        default = 112,
+                        help = 'Maximum width and height in pixels of faces saved with --save_crops thumbnail.')
+
+    parser.add_argument('--crop_format', 
+                        default = 'png',
+                        choices = ['png', 'packed'],
+                        help = 'Whether extracted faces are saved as one PNG file per face, or packed into a few large shard files. Packed faces are exported to PNG files by cluster.py or export_faces.py.')
+
+    parser.add_argument('--shard_size_mb', 
+                        type = int,
+                        default = 1024,
+                        help = 'With --crop_format packed, the size in MB above which a new shard file is started.')
+
+    parser.add_argument('-e', '--embed', 
+                        action = argparse.BooleanOptionalAction,
+                        default = False,
+                        help = 'Whether or not to also compute the embeddings of the extracted faces in the same pass, from the faces in memory. This replaces the make_embeddings step.')
+
+    parser.add_argument('-m', '--model',
+                        default = 'Facenet',
+                        help = 'With --embed, the name of the model used to create the face embeddings. Must be supported by DeepFace.represent().')
+
+    parser.add_argument('-n', '--normalization',
+                        default = 'Facenet',
+                        help = 'With --embed, the normalization technique used in the pre-processing step of the face images. Must be supported by DeepFace.represent().')
+
+    parser.add_argument('--embeddings_dtype',
+                        default = 'float32',
+                        choices = ['float16', 'float32', 'float64'],
+                        help = 'With --embed, the data type in which embeddings are stored on disk.')
+
+    parser.add_argument('-b', '--batch_size',
+                        type = int,
+                        default = 32,
+                        help = 'With --embed, the minimum number of faces whose embeddings are computed together.')
+
+    # With --embed, faces below the quality thresholds are not embedded. Their scores are always
+    # saved in the face metadata, so that the next steps can use other thresholds.
+    quality.add_arguments(parser)
+
+    parser.add_argument('--shard',
+                        type = _parse_shard,
+                        default = None,
+                        help = 'Only process the files of shard i out of N, given as "i/N" with i from 0 to N - 1, e.g. to split a library between several processes or machines with one work directory each. Files are assigned to shards from their path relative to the input directory. The work directories of all shards are then combined with merge_shards.py.')
+
+    model_client.add_arguments(parser)
+    profiling.add_arguments(parser)
+
     args = parser.parse_args()
 
+    if args.reuse_inventory and not args.incremental:
+        parser.error('--reuse_inventory requires --incremental.')
+
     return args
 
 
 
-def _count_extensions_dir_children(topdir):
-    counter = Counter(p.suffix.lower() for p in utils.iter_files(topdir))
+def _parse_shard(value):
+    try:
+        shard_idx, n_shards = map(int, value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Invalid shard "{value}", expected "i/N".')
+    if not 0 <= shard_idx < n_shards:
+        raise argparse.ArgumentTypeError(f'Invalid shard "{value}", i must be between 0 and N - 1.')
+    return shard_idx, n_shards
+
+
+
+def _count_extensions(files):
+    counter = Counter(os.path.splitext(path)[1].lower() for path, *_ in files)
     counter = dict(counter.most_common())
     return sum(counter.values()), counter
 
@@ -118,7 +334,10 @@ def _count_extensions_dir_children(topdir):
 def _plot_extensions_barchart(extension_counts, output_path = None):
     if output_path is None:
         return
-    
+
+    # Imported here, as matplotlib takes a while to load and most runs do not plot anything.
+    import matplotlib.pyplot as plt
+
     plt.bar(extension_counts.keys(), extension_counts.values())
     plt.ylabel('Count')
     plt.yscale('log')
@@ -128,52 +347,222 @@ def _plot_extensions_barchart(extension_counts, output_path = None):
     plt.savefig(output_path, dpi = 600)
 
 
-@contextlib.contextmanager
-def _get_csv_writer(path):
-    with open(path, 'w', newline = '') as file:
-        csv_writer = csv.writer(file, delimiter = ',', quotechar = '"', quoting = csv.QUOTE_ALL)
-        yield csv_writer
+def detect_and_extract_faces(files, face_store_dir, cropped_faces_dir, manifest_path, hash_contents,
+                             read_videos, secs_between_frames, trust_extensions, video_sampling, scene_threshold, detector_name, 
+                             min_confidence, min_size, align_output_faces,
+                             prefilter_detector, prefilter_max_size, prefilter_confidence, recall_sample_rate,
+                             image_hashes_path, dedupe_distance,
+                             decode_workers, write_workers, queue_depth, save_crops, thumbnail_size, crop_format, shard_size,
+                             embeddings_path, embedding_ids_path, model, normalization, embeddings_dtype, batch_size, quality_thresholds):
+
+    file_manifest = manifest.Manifest(manifest_path, hash_contents)
+    # files are the (path, size, mtime_ns, format) rows of the file inventory.
+    unchanged_paths, files_to_process = file_manifest.partition(files)
+
+    # Faces of deleted, modified or uncommitted files are dropped. Kept faces keep their ids and
+    # ids of dropped faces are not reused.
+    face_writer = face_store.FaceStoreWriter(face_store_dir)
+    kept_ids, patch_id = face_writer.retain_paths(unchanged_paths)
+    file_manifest.compact(unchanged_paths)
+
+    crop_writer = crop_store.open_writer(cropped_faces_dir, crop_format, shard_size)
+    crop_writer.retain(kept_ids)
+
+    # Without a hashes path, every image is run through the detector.
+    duplicate_index = contextlib.nullcontext()
+    if image_hashes_path is not None:
+        duplicate_index = dedupe.DuplicateIndex(image_hashes_path, dedupe_distance)
+        duplicate_index.retain(kept_ids)
+
+    # Without an embeddings path, faces are only saved and make_embeddings creates their embeddings.
+    embedder, embeddings_writer = None, contextlib.nullcontext()
+    if embeddings_path is not None:
+        embedder          = embedding.FaceEmbedder(model, normalization)
+        embeddings_writer = array_store.EmbeddingsWriter(embeddings_path, embedding_ids_path, embeddings_dtype, append = True)
+        embeddings_writer.retain(kept_ids)
+
+    # With a prefilter detector, the main detector only runs where it found candidates.
+    if prefilter_detector is None:
+        detect = partial(detection.detect_faces, detector_name = detector_name, align_output_faces = align_output_faces,
+                         min_confidence = min_confidence, min_size = min_size)
+    else:
+        detect = detection.CascadeDetector(prefilter_detector, prefilter_max_size, prefilter_confidence,
+                                           detector_name, align_output_faces, min_confidence, min_size, recall_sample_rate)
+
+    if unchanged_paths:
+        print(f'Skipping {len(unchanged_paths)} files already processed.')
+
+    first_patch_id = patch_id
+    file_paths     = [pathlib.Path(file_path) for file_path, _, _, _ in files_to_process]
+    file_formats   = [file_format for _, _, _, file_format in files_to_process]
+    decoded        = pipeline.iter_decoded_images(file_paths, file_formats, read_videos, secs_between_frames, trust_extensions,
+                                                  video_sampling, scene_threshold, decode_workers, queue_depth)
+
+    # Files are decoded in parallel and may finish out of order. Their faces are kept until all
+    # previous files finished, so that patch ids and metadata rows are assigned in file order. Each
+    # frame is kept as (timestamp, image shape, faces, canonical), faces being None for
+    # near-duplicates.
+    frames_per_file = defaultdict(list)
+    finished_files  = {}
+    next_file_idx   = 0
+    n_duplicates    = 0
+
+    # Files whose patch ids were assigned, waiting for enough faces to fill a batch of embeddings.
+    ready_files   = []
+    n_ready_faces = 0
+    # Number of faces checked against the quality thresholds, and failing each of them.
+    quality_counts = Counter()
+
+    with face_writer, \
+         file_manifest, \
+         crop_writer, \
+         embeddings_writer, \
+         duplicate_index, \
+         contextlib.closing(decoded), \
+         tqdm(total = len(files_to_process), ascii = True, desc = 'Files processed') as pbar, \
+         pipeline.OrderedCommitter(write_workers, queue_depth, partial(_commit_file, face_writer, crop_writer, embeddings_writer, duplicate_index, file_manifest, pbar)) as committer:
+
+        for file_idx, timestamp, image in decoded:
+            if image is not None:
+                canonical = None
+                if image_hashes_path is not None:
+                    with profiling.stage('dedupe'):
+                        image_hash = dedupe.dhash(image)
+                        canonical  = duplicate_index.find(image_hash, file_idx)
+                    if canonical is not None:
+                        frames_per_file[file_idx].append((timestamp, image.shape, None, canonical))
+                        n_duplicates += 1
+                        continue
+                    canonical = duplicate_index.add(image_hash, file_idx)
+
+                frames_per_file[file_idx].append((timestamp, image.shape, detect(image), canonical))
+                continue
 
+            finished_files[file_idx] = frames_per_file.pop(file_idx, [])
 
+            while next_file_idx in finished_files:
+                file_info = files_to_process[next_file_idx]
+                rows, patch_ids, faces, canonicals, patch_id = _assign_patch_ids(file_info, finished_files.pop(next_file_idx), patch_id)
 
-def detect_and_extract_faces(input_dir, faces_csv_path, cropped_faces_dir, n_files,
-                             read_videos, secs_between_frames, detector_name, 
-                             min_confidence, min_size, align_output_faces):
+                ready_files.append((file_info, rows, patch_ids, faces, canonicals))
+                n_ready_faces += len(faces)
+                next_file_idx += 1
 
-    with _get_csv_writer(faces_csv_path) as csv_writer:
-        csv_writer.writerow(['id', 'image_path'])
-        
-        patch_id = 0
-    
-        with tqdm(total = n_files, ascii = True, desc = 'Files processed') as pbar:
-            for file_idx, file_path, image in image_io.photos_video_frames_iterator(input_dir, read_videos, secs_between_frames):
-                results = DeepFace.extract_faces(image,
-                                                 detector_name,
-                                                 align = align_output_faces,
-                                                 enforce_detection = False,
-                                                 color_face = 'bgr',
-                                                 normalize_face = False,
-                                                 anti_spoofing = False)
-
-                for result in results:
-                    if result['confidence'] < min_confidence:
-                        continue
-                    
-                    height, width, _ = result['face'].shape
-                    if any(e < min_size for e in (height, width)):
-                        continue
+            if embedder is None or n_ready_faces >= batch_size or next_file_idx == len(files_to_process):
+                _submit_files(committer, ready_files, embedder, crop_writer, save_crops, thumbnail_size, quality_thresholds, quality_counts)
+                ready_files   = []
+                n_ready_faces = 0
+
+    if prefilter_detector is not None:
+        print(detect.report())
+    if n_duplicates:
+        print(f'{n_duplicates} near-duplicate images and frames reused the faces of an earlier image.')
+    if embedder is not None and quality_thresholds:
+        n_checked, n_rejected = quality_counts.pop('checked', 0), quality_counts.pop('rejected', 0)
+        print(quality.report(quality_counts, n_rejected, n_checked, 'embedded'))
+
+    return patch_id - first_patch_id
+
+
+
+def _assign_patch_ids(file_info, frames, patch_id):
+    # Gives consecutive patch ids to the faces detected in the frames of a file, and the ids of
+    # the faces of their canonical image to near-duplicate frames. Returns the metadata rows of
+    # the file without quality scores, the ids and detections of its new faces, its canonical
+    # images and the next unused id.
+    _, size, mtime_ns, _ = file_info
+    rows, new_ids, new_faces, canonicals = [], [], [], []
+
+    for timestamp, (image_height, image_width, *_), faces, canonical in frames:
+        timestamp = float('nan') if timestamp is None else timestamp
+
+        if faces is None:
+            # The boxes of the canonical image's faces do not apply to a resized near-duplicate.
+            rows += [(face_id, timestamp, -1, -1, -1, -1, float('nan'), -1, -1, image_width, image_height, size, mtime_ns, True)
+                     for face_id in canonical.patch_ids]
+            continue
+
+        face_ids  = range(patch_id, patch_id + len(faces))
+        patch_id += len(faces)
+        new_ids.extend(face_ids)
+        new_faces.extend(faces)
+        if canonical is not None:
+            canonical.patch_ids = face_ids
+            canonicals.append(canonical)
+
+        rows += [(face_id, timestamp, *box, confidence, face.shape[1], face.shape[0], image_width, image_height, size, mtime_ns, False)
+                 for face_id, (face, box, confidence, _) in zip(face_ids, faces)]
+
+    return rows, new_ids, new_faces, canonicals, patch_id
+
+
+
+def _submit_files(committer, ready_files, embedder, crop_writer, save_crops, thumbnail_size, quality_thresholds, quality_counts):
+    # Quality scores and embeddings are computed in one batch for the faces of all ready files,
+    # skipping the embeddings of faces below the quality thresholds. Each file is then handed to
+    # the committer with its own rows, embeddings and faces to save.
+    detections = [detection for _, _, _, file_detections, _ in ready_files for detection in file_detections]
+    faces      = [face for face, _, _, _ in detections]
+
+    with profiling.stage('quality'):
+        scores = quality.score_faces(faces, [box for _, box, _, _ in detections], [eyes for _, _, _, eyes in detections])
+        failed = quality.failed_thresholds(scores, quality_thresholds)
+        keep   = ~quality.rejected(failed, len(faces))
+
+    embeddings = None
+    if embedder is not None:
+        quality_counts.update({name: int(np.count_nonzero(mask)) for name, mask in failed.items()})
+        quality_counts.update(checked = len(faces), rejected = len(faces) - int(np.count_nonzero(keep)))
+        profiling.count('faces_rejected_quality', len(faces) - int(np.count_nonzero(keep)))
+
+        kept_faces = [face for face, kept in zip(faces, keep) if kept]
+        embeddings = embedder.embed([embedder.preprocess(face) for face in kept_faces]) if kept_faces else None
+
+    # Rows of reused faces have no scores, those of new faces take the scores of their faces in order.
+    unknown_scores = (np.nan,) * len(quality.COLUMNS)
+    offset, embedded_offset = 0, 0
+    for (file_path, size, mtime_ns, _), rows, patch_ids, file_detections, canonicals in ready_files:
+        file_scores = zip(*(scores[name][offset:offset + len(file_detections)].tolist() for name in quality.COLUMNS))
+        rows        = [(*row, *(unknown_scores if row[-1] else next(file_scores))) for row in rows]
+
+        jobs = []
+        if save_crops != 'none':
+            jobs = [(_save_face, crop_writer, face_id, face, save_crops == 'thumbnail', thumbnail_size)
+                    for face_id, (face, *_) in zip(patch_ids, file_detections)]
+
+        file_keep       = keep[offset:offset + len(file_detections)]
+        embedded_ids    = [face_id for face_id, kept in zip(patch_ids, file_keep) if kept]
+        file_embeddings = embeddings[embedded_offset:embedded_offset + len(embedded_ids)] if embeddings is not None else None
+        offset          += len(file_detections)
+        embedded_offset += len(embedded_ids)
+
+        committer.submit(jobs, rows, embedded_ids, file_embeddings, canonicals, file_path, size, mtime_ns)
+
+
+
+def _save_face(crop_writer, patch_id, face, as_thumbnail, thumbnail_size):
+    if as_thumbnail:
+        face = image_io.downscale_image(face, thumbnail_size)
+    crop_writer.write(patch_id, face)
+
+
+
+def _commit_file(face_writer, crop_writer, embeddings_writer, duplicate_index, file_manifest, pbar, rows, embedded_ids, embeddings, canonicals, file_path, size, mtime_ns):
+    # A file is committed to the manifest only once all of its faces and embeddings are on disk.
+    with profiling.stage('commit'):
+        crop_writer.commit()
+        face_writer.append(file_path, rows)
+        face_writer.commit()
 
-                    image_io.save_image(result['face'], cropped_faces_dir / f"{patch_id}.png")
-                    csv_writer.writerow([patch_id, file_path])
-                    patch_id += 1
-            
-                pbar.n = file_idx + 1
-                pbar.refresh()
+        if embeddings is not None and len(embeddings):
+            embeddings_writer.append(embedded_ids, embeddings)
+            embeddings_writer.commit()
 
-            pbar.n = n_files
-            pbar.refresh()
+        if canonicals:
+            duplicate_index.commit(canonicals)
 
-    return patch_id
+        file_manifest.commit(file_path, size, mtime_ns)
+    pbar.update()
 
 
 
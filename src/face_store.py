@@ -0,0 +1,433 @@
+# -*- coding: utf-8 -*-
+
+# Constants is imported first so that it sets up the environment variables.
+import constants
+
+import os
+import csv
+import pathlib
+import argparse
+from shutil import rmtree
+
+import numpy as np
+import pandas as pd
+
+import array_store
+import utils
+
+
+# One row per face found in an image or video frame. Near-duplicate images reuse the face, and so
+# the id, of their canonical image, so ids repeat. Unknown values are -1, or NaN for floats:
+# photos have no frame timestamp, and faces reused from a near-duplicate or of a Faces.csv
+# written by a previous version have no box, confidence, sizes or quality scores. Columns added
+# since a store was written are filled with unknown values when it is opened.
+_COLUMNS = {'id'             : np.int64,
+            'path_idx'       : np.int32,
+            'frame_timestamp': np.float64,
+            'x'              : np.int32,
+            'y'              : np.int32,
+            'w'              : np.int32,
+            'h'              : np.int32,
+            'confidence'     : np.float32,
+            'crop_width'     : np.int32,
+            'crop_height'    : np.int32,
+            'image_width'    : np.int32,
+            'image_height'   : np.int32,
+            'source_size'    : np.int64,
+            'source_mtime_ns': np.int64,
+            'reused'         : np.bool_,
+            'sharpness'      : np.float32,
+            'brightness'     : np.float32,
+            'contrast'       : np.float32,
+            'eye_distance'   : np.float32,
+            'yaw'            : np.float32}
+
+# Fields of the rows given to FaceStoreWriter.append, path_idx being filled in by the writer.
+ROW_FIELDS = [name for name in _COLUMNS if name != 'path_idx']
+
+_PATHS_FILENAME   = 'Paths.csv'
+_NEXT_ID_FILENAME = 'Next Id.txt'
+_CHUNK_ROWS       = 1 << 16
+
+# Faces.csv written before frame timestamps were recorded lack the last column.
+_LEGACY_CSV_HEADER = ['id', 'image_path', 'frame_timestamp']
+
+
+
+def _column_path(store_dir, name):
+    return store_dir / f'{name}.npy'
+
+
+
+def _unknown_column(name, n_rows):
+    dtype = np.dtype(_COLUMNS[name])
+    value = np.nan if dtype.kind == 'f' else False if dtype.kind == 'b' else -1
+    return np.full(n_rows, value, dtype = dtype)
+
+
+
+def _load_paths(store_dir):
+    paths_path = store_dir / _PATHS_FILENAME
+    if not paths_path.is_file():
+        return []
+
+    with open(paths_path, newline = '', encoding = 'utf-8', errors = 'surrogateescape') as file:
+        csv_reader = csv.reader(file)
+        next(csv_reader, None)
+        return [row[0] for row in csv_reader if row]
+
+
+
+class FaceStoreWriter:
+    # Face metadata stored column by column, each column being an AppendableArray in store_dir, so
+    # that readers only load the columns they need. Source paths are stored once each, in a table
+    # whose row numbers are the path_idx column. Rows are committed to all columns together.
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self._open()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+    @property
+    def n_rows(self):
+        return self._columns['id'].n_rows
+
+
+    def append(self, path, rows):
+        # rows are tuples of the values of ROW_FIELDS for the faces found in the file at path.
+        if not rows:
+            return
+
+        path = str(path)
+        if path not in self._path_idx:
+            self._path_idx[path] = len(self._paths)
+            self._paths.append(path)
+
+        self._n_pending += len(rows)
+        values = dict(zip(ROW_FIELDS, zip(*rows)))
+        values['path_idx'] = [self._path_idx[path]] * len(rows)
+        self._pending_next_id = max(self._pending_next_id, max(values['id']) + 1)
+        for name, column in self._columns.items():
+            column.append(np.array(values[name], dtype = column.dtype))
+
+
+    def commit(self):
+        if not self._n_pending:
+            return
+
+        # New paths are on disk before any row refers to them.
+        if len(self._paths) > self._n_committed:
+            with open(self.store_dir / _PATHS_FILENAME, 'a', newline = '', encoding = 'utf-8', errors = 'surrogateescape') as file:
+                csv.writer(file).writerows([path] for path in self._paths[self._n_committed:])
+            self._n_committed = len(self._paths)
+
+        for column in self._columns.values():
+            column.commit()
+        self._n_pending = 0
+
+        if self._pending_next_id > self._next_id:
+            self._next_id = self._pending_next_id
+            _write_next_id(self.store_dir, self._next_id)
+
+
+    def retain_paths(self, kept_paths):
+        # Drops the rows of files not in kept_paths, e.g. deleted or modified files, and the paths
+        # no row refers to anymore. Returns the ids of kept faces and the next unused id, so that
+        # ids of kept faces never change and ids of dropped faces are not reused, even those of
+        # the last faces, as the next id is stored with the store rather than found from its ids.
+        next_id = self._next_id
+        if not self.n_rows:
+            return np.empty(0, dtype = np.int64), next_id
+
+        ids           = self._columns['id'].read()
+        path_idx      = np.array(self._columns['path_idx'].read())
+        kept_path_idx = np.array([path in kept_paths for path in self._paths], dtype = bool)
+        keep          = kept_path_idx[path_idx]
+        kept_ids      = np.array(ids[keep])
+        del ids
+
+        if keep.all():
+            return kept_ids, next_id
+
+        # The kept rows are written to a new store which then replaces this one, so that columns
+        # never disagree even if interrupted. Paths keep their order, skipping the dropped ones.
+        new_path_idx = (np.cumsum(kept_path_idx) - 1)[path_idx[keep]]
+        tmp_dir      = self.store_dir.with_name(self.store_dir.name + '.tmp')
+        rmtree(tmp_dir, ignore_errors = True)
+        tmp_dir.mkdir()
+
+        for name, column in self._columns.items():
+            with array_store.AppendableArray(_column_path(tmp_dir, name), column.dtype, ()) as tmp_column:
+                if name == 'path_idx':
+                    tmp_column.append(new_path_idx)
+                else:
+                    data = column.read()
+                    for start in range(0, len(data), _CHUNK_ROWS):
+                        tmp_column.append(data[start:start + _CHUNK_ROWS][keep[start:start + _CHUNK_ROWS]])
+                    del data
+                tmp_column.commit()
+
+        self._paths = [path for path, kept in zip(self._paths, kept_path_idx) if kept]
+        _write_paths(tmp_dir, self._paths)
+        _write_next_id(tmp_dir, next_id)
+
+        self.close()
+        _swap_dirs(tmp_dir, self.store_dir)
+        self._open()
+
+        return kept_ids, next_id
+
+
+    def close(self):
+        for column in self._columns.values():
+            column.close()
+
+
+    def _open(self):
+        store_dir = self.store_dir
+        _recover_store(store_dir)
+        store_dir.mkdir(parents = True, exist_ok = True)
+        missing       = {name for name in _COLUMNS if not _column_path(store_dir, name).is_file()}
+        self._columns = {name: array_store.AppendableArray(_column_path(store_dir, name), dtype, ()) for name, dtype in _COLUMNS.items()}
+
+        # Columns are committed one after the other, so an interrupted commit may leave some of
+        # them with a few more rows than the others.
+        n_rows = min((column.n_rows for name, column in self._columns.items() if name not in missing), default = 0)
+        for name, column in self._columns.items():
+            if name in missing:
+                for start in range(0, n_rows, _CHUNK_ROWS):
+                    column.append(_unknown_column(name, min(_CHUNK_ROWS, n_rows - start)))
+                column.commit()
+            column.truncate(n_rows)
+
+        # The path table is rewritten, which drops a line left incomplete by an interrupted run.
+        self._paths       = _load_paths(store_dir)
+        self._path_idx    = {path: idx for idx, path in enumerate(self._paths)}
+        self._n_committed = len(self._paths)
+        self._n_pending   = 0
+        _write_paths(store_dir, self._paths)
+
+        self._next_id         = next_id(store_dir)
+        self._pending_next_id = self._next_id
+
+
+
+def _write_paths(store_dir, paths):
+    paths_path = store_dir / _PATHS_FILENAME
+    tmp_path   = paths_path.with_suffix('.tmp')
+    with open(tmp_path, 'w', newline = '', encoding = 'utf-8', errors = 'surrogateescape') as file:
+        csv_writer = csv.writer(file)
+        csv_writer.writerow(['path'])
+        csv_writer.writerows([path] for path in paths)
+    os.replace(tmp_path, paths_path)
+
+
+
+def _write_next_id(store_dir, next_id):
+    next_id_path = store_dir / _NEXT_ID_FILENAME
+    tmp_path     = next_id_path.with_suffix('.tmp')
+    tmp_path.write_text(str(next_id))
+    os.replace(tmp_path, next_id_path)
+
+
+
+def _swap_dirs(new_dir, store_dir):
+    # Directories cannot be replaced atomically, so the previous store is first moved aside and only
+    # deleted once the new one is in place. _recover_store completes an interrupted swap.
+    old_dir = store_dir.with_name(store_dir.name + '.old')
+    os.replace(store_dir, old_dir)
+    os.replace(new_dir, store_dir)
+    rmtree(old_dir)
+
+
+
+def _recover_store(store_dir):
+    old_dir = store_dir.with_name(store_dir.name + '.old')
+    if old_dir.is_dir():
+        if store_dir.is_dir():
+            rmtree(old_dir)
+        else:
+            os.replace(old_dir, store_dir)
+
+
+
+def migrate_legacy_csv(faces_csv_path, writer):
+    # Moves the rows of a Faces.csv written by a previous version into an empty store, then deletes
+    # the CSV. Its rows only have an id, a path and possibly a frame timestamp. The size and
+    # modification time of their files are taken as they are now, as previous versions did not
+    # record them. Returns the (size, mtime_ns) of each file still found by path, so that they
+    # can be recorded as processed.
+    if not faces_csv_path.is_file() or writer.n_rows:
+        return {}
+
+    unknown    = dict(zip(ROW_FIELDS[2:], (_unknown_column(name, 1)[0] for name in ROW_FIELDS[2:])))
+    file_stats = {}
+    with open(faces_csv_path, newline = '') as file:
+        csv_reader = csv.reader(file)
+        next(csv_reader, None)
+        for row in csv_reader:
+            if not 2 <= len(row) <= len(_LEGACY_CSV_HEADER):
+                continue
+            path = row[1]
+            if path not in file_stats:
+                try:
+                    stat = os.stat(path)
+                    file_stats[path] = (stat.st_size, stat.st_mtime_ns)
+                except OSError:
+                    file_stats[path] = None
+
+            values = {**unknown}
+            if file_stats[path] is not None:
+                values['source_size'], values['source_mtime_ns'] = file_stats[path]
+            timestamp = float(row[2]) if len(row) > 2 and row[2] else np.nan
+            writer.append(path, [(int(row[0]), timestamp, *values.values())])
+
+    writer.commit()
+    faces_csv_path.unlink()
+
+    return {path: stats for path, stats in file_stats.items() if stats is not None}
+
+
+
+def next_id(store_dir):
+    # The id following the largest id ever given to a face of the store, including faces dropped
+    # since. Stores written by a previous version only tell the largest id they still have, and
+    # the stored id may lag behind the ids of a commit which was interrupted.
+    stored_id = 0
+    if (store_dir / _NEXT_ID_FILENAME).is_file():
+        stored_id = int((store_dir / _NEXT_ID_FILENAME).read_text())
+    if not _column_path(store_dir, 'id').is_file():
+        return stored_id
+    ids = np.load(_column_path(store_dir, 'id'), mmap_mode = 'r')
+    return max(stored_id, int(ids.max()) + 1 if len(ids) else 0)
+
+
+
+def merge_stores(store_dirs, id_offsets, output_dir):
+    # Writes the rows of several stores to a new store, shifting the ids of each by its offset.
+    # Paths shared by several stores are stored once. Returns the number of rows written.
+    output_dir.mkdir(parents = True)
+    path_idx = {}
+    _write_next_id(output_dir, max((id_offset + next_id(store_dir) for store_dir, id_offset in zip(store_dirs, id_offsets)), default = 0))
+    columns  = {name: array_store.AppendableArray(_column_path(output_dir, name), dtype, ()) for name, dtype in _COLUMNS.items()}
+
+    for store_dir, id_offset in zip(store_dirs, id_offsets):
+        store_paths = _load_paths(store_dir)
+        for path in store_paths:
+            path_idx.setdefault(path, len(path_idx))
+        remap  = np.array([path_idx[path] for path in store_paths], dtype = np.int32)
+        arrays = {name: np.load(_column_path(store_dir, name), mmap_mode = 'r') for name in _COLUMNS if _column_path(store_dir, name).is_file()}
+        n_rows = min(map(len, arrays.values()))
+        arrays.update({name: _unknown_column(name, n_rows) for name in _COLUMNS if name not in arrays})
+
+        for start in range(0, n_rows, _CHUNK_ROWS):
+            rows = slice(start, min(start + _CHUNK_ROWS, n_rows))
+            for name, column in columns.items():
+                data = np.asarray(arrays[name][rows])
+                if name == 'id':
+                    data = data + id_offset
+                elif name == 'path_idx':
+                    data = remap[data]
+                column.append(data)
+        del arrays
+
+    for column in columns.values():
+        column.commit()
+        column.close()
+    _write_paths(output_dir, list(path_idx))
+
+    return columns['id'].n_rows
+
+
+
+def load_faces(store_dir, columns = None, legacy_csv_path = None):
+    # Returns a DataFrame of the requested columns of the store, only reading those columns from
+    # disk. The column image_path gives the source path of each face, as a categorical. Falls back
+    # to the Faces.csv of a previous version, whose rows only have id, image_path and
+    # frame_timestamp.
+    if not _column_path(store_dir, 'id').is_file():
+        if legacy_csv_path is None or not legacy_csv_path.is_file():
+            raise RuntimeError(f'No face metadata found in {store_dir}, run extract_faces.py first!')
+        df = utils.load_csv(legacy_csv_path)
+        return df if columns is None else df[[column for column in columns if column in df]]
+
+    columns = list(_COLUMNS) + ['image_path'] if columns is None else list(columns)
+    arrays  = {name: np.load(_column_path(store_dir, name), mmap_mode = 'r') for name in set(columns + ['id', 'path_idx'])
+               if name in _COLUMNS and _column_path(store_dir, name).is_file()}
+    n_rows  = min(map(len, arrays.values()))
+    arrays.update({name: _unknown_column(name, n_rows) for name in columns if name in _COLUMNS and name not in arrays})
+
+    data = {}
+    for name in columns:
+        if name == 'image_path':
+            data[name] = pd.Categorical.from_codes(arrays['path_idx'][:n_rows], categories = _load_paths(store_dir))
+        else:
+            data[name] = np.array(arrays[name][:n_rows])
+    return pd.DataFrame(data)
+
+
+
+def source_paths(store_dir, face_ids, legacy_csv_path = None):
+    # Returns, for each id of face_ids, the source paths of the images it was found in: one path,
+    # or several for faces shared by near-duplicate images. Only the id and path_idx columns are
+    # read, and ids are found by binary search rather than by scanning all rows for each of them.
+    faces = load_faces(store_dir, ['id', 'image_path'], legacy_csv_path)
+    ids   = faces['id'].to_numpy()
+    paths = faces['image_path'].to_numpy()
+    order = np.argsort(ids, kind = 'stable')
+
+    sorted_ids = ids[order]
+    starts     = np.searchsorted(sorted_ids, face_ids, side = 'left')
+    ends       = np.searchsorted(sorted_ids, face_ids, side = 'right')
+
+    return [[paths[i] for i in order[start:end]] for start, end in zip(starts, ends)]
+
+
+
+def main():
+    args = parse_args()
+
+    store_dir = args.work_dir / constants.FACE_METADATA_DIRNAME
+    faces     = load_faces(store_dir, args.columns, args.work_dir / constants.FACES_CSV_FILENAME)
+    faces.to_csv(args.output, index = False)
+
+    print(f'Exported {len(faces)} faces to {args.output}.')
+
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description = "This script exports the face metadata written by extract_faces.py to a CSV file, e.g. to inspect it in a spreadsheet.",
+                                     formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-w', '--work_dir',
+                        required = True,
+                        type = pathlib.Path,
+                        help = 'Output directory from step extract_faces.')
+
+    parser.add_argument('-o', '--output',
+                        required = True,
+                        type = pathlib.Path,
+                        help = 'Path of the CSV file to write.')
+
+    parser.add_argument('-c', '--columns',
+                        nargs = '+',
+                        choices = list(_COLUMNS) + ['image_path'],
+                        default = None,
+                        help = 'Columns to export. All of them by default.')
+
+    args = parser.parse_args()
+
+    return args
+
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,7 @@
 # Constants is imported first so that it sets up the environment variables.
 import constants as _
 
+import os
 from enum import IntEnum
 
 import cv2
@@ -10,92 +11,254 @@ import pillow_heif
 from PIL import Image, ImageOps
 from numpy import asarray
 
+import profiling
 import utils
 
 
 pillow_heif.register_heif_opener()
 pillow_heif.register_avif_opener()
 _FileType = IntEnum('_FileType', ['IMAGE', 'VIDEO', 'UNKNOWN'])
+_Decoder  = IntEnum('_Decoder', ['OPENCV', 'PIL'])
 
 
+# File type and decoder of each format. OpenCV is preferred as it is faster and applies the EXIF
+# orientation itself while decoding, PIL is used for the formats OpenCV cannot read.
+_FORMATS = {'jpeg'       : (_FileType.IMAGE,   _Decoder.OPENCV),
+            'png'        : (_FileType.IMAGE,   _Decoder.OPENCV),
+            'tiff'       : (_FileType.IMAGE,   _Decoder.OPENCV),
+            'bmp'        : (_FileType.IMAGE,   _Decoder.OPENCV),
+            'webp'       : (_FileType.IMAGE,   _Decoder.OPENCV),
+            'gif'        : (_FileType.IMAGE,   _Decoder.PIL),
+            'heif'       : (_FileType.IMAGE,   _Decoder.PIL),
+            'avif'       : (_FileType.IMAGE,   _Decoder.PIL),
+            'other_image': (_FileType.IMAGE,   _Decoder.PIL),
+            'mp4'        : (_FileType.VIDEO,   None),
+            'avi'        : (_FileType.VIDEO,   None),
+            'matroska'   : (_FileType.VIDEO,   None),
+            'mpeg'       : (_FileType.VIDEO,   None),
+            'flv'        : (_FileType.VIDEO,   None),
+            'asf'        : (_FileType.VIDEO,   None),
+            'other_video': (_FileType.VIDEO,   None),
+            'unknown'    : (_FileType.UNKNOWN, None)}
 
-def _load_image(path):
-    image = None
+_EXTENSION_FORMATS = {'.jpg' : 'jpeg', '.jpeg': 'jpeg', '.jpe' : 'jpeg', '.png' : 'png',
+                      '.tif' : 'tiff', '.tiff': 'tiff', '.bmp' : 'bmp',  '.webp': 'webp',
+                      '.gif' : 'gif',  '.heic': 'heif', '.heif': 'heif', '.avif': 'avif',
+                      '.mp4' : 'mp4',  '.m4v' : 'mp4',  '.mov' : 'mp4',  '.3gp' : 'mp4',
+                      '.avi' : 'avi',  '.mkv' : 'matroska', '.webm': 'matroska',
+                      '.mpg' : 'mpeg', '.mpeg': 'mpeg', '.flv' : 'flv',  '.wmv' : 'asf'}
 
-    # Try reading with PIL.
+# Major brands of ISO base media files holding still images rather than videos.
+_HEIF_BRANDS = {b'heic', b'heix', b'hevc', b'hevx', b'heim', b'heis', b'mif1', b'msf1'}
+_AVIF_BRANDS = {b'avif', b'avis'}
+
+_SNIFF_SIZE = 16
+
+# Format of each extension, seeded with the known extensions and completed with the format sniffed
+# for the first file of every other extension. Only used when extensions are trusted.
+_extension_verdicts = dict(_EXTENSION_FORMATS)
+
+
+
+def _sniff_header(header):
+    if header.startswith(b'\xff\xd8\xff'):
+        return 'jpeg'
+    if header.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if header[:4] in (b'II*\x00', b'MM\x00*'):
+        return 'tiff'
+    if header.startswith(b'BM'):
+        return 'bmp'
+    if header[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if header.startswith(b'RIFF'):
+        return {b'WEBP': 'webp', b'AVI ': 'avi'}.get(header[8:12])
+    if header[4:8] == b'ftyp':
+        brand = header[8:12]
+        return 'heif' if brand in _HEIF_BRANDS else 'avif' if brand in _AVIF_BRANDS else 'mp4'
+    if header.startswith(b'\x1aE\xdf\xa3'):
+        return 'matroska'
+    if header[:4] in (b'\x00\x00\x01\xba', b'\x00\x00\x01\xb3'):
+        return 'mpeg'
+    if header.startswith(b'FLV'):
+        return 'flv'
+    if header.startswith(b'\x30\x26\xb2\x75\x8e\x66\xcf\x11'):
+        return 'asf'
+    return None
+
+
+
+def _probe_file(path):
+    # Slow path for files whose magic bytes are not recognised: let the decoders try to open them.
     try:
-        image = Image.open(path)
-        image = ImageOps.exif_transpose(image)
-        image = asarray(image.convert('BGR'))
+        Image.open(path).verify()
+        return 'other_image'
+
     except Exception:
-        image = None
-    
-    # OpenCV returns None if cv2.imread could not read image.
-    image = cv2.imread(path, cv2.IMREAD_COLOR)
-    return image
+        pass
+
+    cap = cv2.VideoCapture(str(path))
+
+    if cap.isOpened():
+        # cv2.VideoCapture is capable of reading images too, so need to check if it loaded the file,
+        # and if the file contains multiple frames for it to be a video.
+        n_frames = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+        cap.release()
+        return 'other_video' if n_frames > 1 else 'other_image'
+
+    return 'unknown'
+
+
+
+def sniff_format(path):
+    try:
+        with open(path, 'rb') as file:
+            header = file.read(_SNIFF_SIZE)
+    except OSError:
+        return 'unknown'
+
+    return _sniff_header(header) or _probe_file(path)
+
+
+
+def classify_file(path, trust_extensions):
+    extension = os.path.splitext(path)[1].lower()
+
+    if trust_extensions and extension in _extension_verdicts:
+        return _extension_verdicts[extension]
 
+    with profiling.stage('sniff'):
+        file_format = sniff_format(path)
+    if trust_extensions and extension:
+        _extension_verdicts[extension] = file_format
 
+    return file_format
 
-def _iter_video(path, secs_between_frames):
+
+
+def _load_image(path, decoder):
+    if decoder == _Decoder.OPENCV:
+        # OpenCV returns None if cv2.imread could not read image.
+        return cv2.imread(str(path), cv2.IMREAD_COLOR)
+
+    try:
+        with Image.open(path) as image:
+            image = ImageOps.exif_transpose(image).convert('RGB')
+        return cv2.cvtColor(asarray(image), cv2.COLOR_RGB2BGR)
+    except Exception:
+        return None
+
+
+
+# Seeking decodes from the previous keyframe, so it only pays off when skipping enough frames.
+_MIN_FRAMES_TO_SEEK = 12
+# Side of the grayscale thumbnails compared by the scene change filter.
+_SCENE_SIGNATURE_SIZE = 32
+
+
+
+def _iter_video(path, secs_between_frames, sampling = 'seek', scene_threshold = 0):
+    # Yields (timestamp, frame) for one frame every secs_between_frames, timestamp being the
+    # position of the frame in seconds. Frames are reached by seeking where the skip is long
+    # enough, and by grabbing every intermediate frame otherwise or when the video cannot be
+    # seeked reliably. With a scene_threshold, frames whose mean absolute difference with the
+    # previous yielded frame (in grey levels, on small thumbnails) is below it are skipped.
     # Regardless of format, try reading it as a video. If OpenCV fails, it will write to
     # stderr but no exception is launched in Python. Therefore program will keep running
     # without interruptions, just cap.isOpened() will return False. 
     # CAP_FFMPEG is needed to allow auto-rotating frames from videos taken by iOS and Android devices.
-    cap = cv2.VideoCapture(path, cv2.CAP_FFMPEG)
+    cap = cv2.VideoCapture(str(path), cv2.CAP_FFMPEG)
 
     fps = cap.get(cv2.CAP_PROP_FPS)    
     fps = 24 if fps == 0 else fps
     frames_to_skip = int(secs_between_frames * fps)
 
+    seek = sampling == 'seek' and frames_to_skip >= _MIN_FRAMES_TO_SEEK and cap.get(cv2.CAP_PROP_FRAME_COUNT) > 0
+
+    previous_signature = None
+    frame_idx = frames_to_skip
+    position  = 0
+
     while cap.isOpened():
-        for _ in range(frames_to_skip):
-            cap.grab()
+        with profiling.stage('decode_video_frame'):
+            if seek:
+                cap.set(cv2.CAP_PROP_POS_MSEC, frame_idx * 1000 / fps)
+                ret, frame = cap.read()
 
-        ret, frame = cap.read()
+                # Some containers ignore or misplace seeks, the rest of the video is then read by
+                # grabbing frames from the start.
+                if ret and abs(cap.get(cv2.CAP_PROP_POS_FRAMES) - 1 - frame_idx) > 1:
+                    seek = False
+                    cap.release()
+                    cap = cv2.VideoCapture(str(path), cv2.CAP_FFMPEG)
+                    position = 0
+                    continue
+
+            else:
+                for _ in range(frame_idx - position):
+                    cap.grab()
+                ret, frame = cap.read()
 
         if not ret:
             break
-        
-        yield frame
+
+        position   = frame_idx + 1
+        timestamp  = frame_idx / fps
+        frame_idx += frames_to_skip + 1
+
+        if scene_threshold > 0:
+            profiling.count('video_frames_sampled')
+            signature = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), (_SCENE_SIGNATURE_SIZE, _SCENE_SIGNATURE_SIZE), interpolation = cv2.INTER_AREA)
+            if previous_signature is not None and cv2.absdiff(signature, previous_signature).mean() < scene_threshold:
+                continue
+            previous_signature = signature
+
+        profiling.count('video_frames_decoded')
+        yield timestamp, frame
     
     cap.release()
 
 
 
-def _file_is_image_or_video(path):
-    try:
-        Image.open(path).verify()
-        return _FileType.IMAGE
+def iter_file_images(path, read_videos, secs_between_frames, trust_extensions = False, video_sampling = 'seek', scene_threshold = 0, file_format = None):
+    # Yields (timestamp, image) for the image of a photo, whose timestamp is None, or for the
+    # sampled frames of a video, whose timestamp is their position in seconds. file_format, if
+    # already known e.g. from the file inventory, saves classifying the file again.
+    file_type, decoder = _FORMATS[file_format or classify_file(path, trust_extensions)]
 
-    except Exception:
-        pass
+    if profiling.is_enabled():
+        profiling.count('bytes_read', os.path.getsize(path))
 
-    cap = cv2.VideoCapture(path)
+    if file_type == _FileType.IMAGE:
+        with profiling.stage('decode_image'):
+            image = _load_image(path, decoder)
 
-    if cap.isOpened():
-        # cv2.VideoCapture is capable of reading images too, so need to check if it loaded the file, 
-        # and if the file contains multiple frames for it to be a video.
-        if cap.get(cv2.CAP_PROP_FRAME_COUNT) > 1:
-            return _FileType.VIDEO
+        # The extension may lie about the content, so the file is sniffed before giving up on it.
+        if image is None and trust_extensions:
+            file_type, decoder = _FORMATS[sniff_format(path)]
+            image = _load_image(path, decoder) if file_type == _FileType.IMAGE else None
 
-        return _FileType.IMAGE    
+        if image is not None:
+            yield None, image
 
-    return _FileType.UNKNOWN
+    elif file_type == _FileType.VIDEO and read_videos:
+        yield from _iter_video(path, secs_between_frames, video_sampling, scene_threshold)
 
 
 
-def photos_video_frames_iterator(input_dir, read_videos, secs_between_frames):
+def photos_video_frames_iterator(input_dir, read_videos, secs_between_frames, trust_extensions = False):
     for idx, path in enumerate(utils.iter_files(input_dir)):
-        file_type = _file_is_image_or_video(path)
-        
-        if file_type == _FileType.IMAGE:
-            image = _load_image(path)
-            if image is not None:
-                yield idx, path, image
-            
-        elif file_type == _FileType.VIDEO and read_videos:
-            for image in _iter_video(path, secs_between_frames):
-                yield idx, path, image
+        for _, image in iter_file_images(path, read_videos, secs_between_frames, trust_extensions):
+            yield idx, path, image
+
+
+
+def downscale_image(image, max_size):
+    height, width = image.shape[:2]
+    scale = max_size / max(height, width)
+    if scale >= 1:
+        return image
+    return cv2.resize(image, (max(1, round(width * scale)), max(1, round(height * scale))), interpolation = cv2.INTER_AREA)
 
 
 
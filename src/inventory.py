@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+import os
+import csv
+import hashlib
+import concurrent.futures
+
+import image_io
+import utils
+
+
+_FIELDS = ['path', 'size', 'mtime_ns', 'format']
+
+
+
+def update_inventory(input_dir, inventory_path, trust_extensions, n_workers, rewalk = True):
+    # Returns (path, size, mtime_ns, format) for every file of input_dir and saves them to
+    # inventory_path. Files listed in the previous inventory with the same size and modification
+    # time keep their format, the others are classified by n_workers threads. Without rewalk,
+    # the previous inventory is returned as is, without listing input_dir again.
+    previous = load_inventory(inventory_path)
+    if not rewalk and previous:
+        return previous
+
+    previous = {path: (size, mtime_ns, file_format) for path, size, mtime_ns, file_format in previous}
+    files    = utils.scan_files(input_dir, n_workers)
+
+    unknown = [path for path, size, mtime_ns in files if previous.get(path, (None, None, None))[:2] != (size, mtime_ns)]
+    with concurrent.futures.ThreadPoolExecutor(max(1, n_workers)) as executor:
+        formats = dict(zip(unknown, executor.map(lambda path: image_io.classify_file(path, trust_extensions), unknown)))
+
+    inventory = [(path, size, mtime_ns, formats[path] if path in formats else previous[path][2])
+                 for path, size, mtime_ns in files]
+    save_inventory(inventory_path, inventory)
+
+    return inventory
+
+
+
+def load_inventory(inventory_path):
+    if not inventory_path.is_file():
+        return []
+
+    inventory = []
+    with open(inventory_path, newline = '', encoding = 'utf-8', errors = 'surrogateescape') as file:
+        csv_reader = csv.reader(file)
+        next(csv_reader, None)
+        for row in csv_reader:
+            # A row truncated by a hard kill is ignored, its file is simply classified again.
+            if len(row) != len(_FIELDS):
+                continue
+            try:
+                inventory.append((row[0], int(row[1]), int(row[2]), row[3]))
+            except ValueError:
+                continue
+
+    return inventory
+
+
+
+def save_inventory(inventory_path, inventory):
+    tmp_path = inventory_path.with_suffix('.tmp')
+    with open(tmp_path, 'w', newline = '', encoding = 'utf-8', errors = 'surrogateescape') as file:
+        csv_writer = csv.writer(file)
+        csv_writer.writerow(_FIELDS)
+        csv_writer.writerows(inventory)
+    os.replace(tmp_path, inventory_path)
+
+
+
+def shard_of(path, input_dir, n_shards):
+    # Shard of a file, from a hash of its path relative to input_dir, so that every run and every
+    # machine assigns it to the same shard wherever the input directory is mounted.
+    relative_path = os.path.relpath(path, input_dir).replace(os.sep, '/')
+    digest        = hashlib.blake2b(relative_path.encode('utf-8', 'surrogateescape'), digest_size = 8).digest()
+    return int.from_bytes(digest, 'little') % n_shards
+
+
+
+def shard_files(files, input_dir, shard_idx, n_shards):
+    # Keeps the rows of the inventory whose file belongs to shard shard_idx out of n_shards.
+    return [file for file in files if shard_of(file[0], input_dir, n_shards) == shard_idx]
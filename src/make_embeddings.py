@@ -6,11 +6,20 @@ import constants
 
 import pathlib
 import argparse
+from functools import partial
 
 import numpy as np
-from deepface import DeepFace
 from tqdm import tqdm
 
+import ann_index
+import array_store
+import crop_store
+import embedding
+import face_store
+import model_client
+import pipeline
+import profiling
+import quality
 import utils
 
 
@@ -18,22 +27,28 @@ import utils
 
 def main():
     args = parse_args()
+    profiling.start(args.profile, args.cprofile)
+    model_client.connect(args.model_server)
 
     faces_csv_path       = args.work_dir / constants.FACES_CSV_FILENAME
+    face_store_dir       = args.work_dir / constants.FACE_METADATA_DIRNAME
     cropped_faces_dir    = args.work_dir / constants.CROPPED_FACES_DIRNAME
     embeddings_file_path = args.work_dir / constants.EMBEDDINGS_FILENAME
-    
-    if embeddings_file_path.is_file():
-        embeddings_file_path.unlink()
+    embedding_ids_path   = args.work_dir / constants.EMBEDDING_IDS_FILENAME
+    settings_path        = args.work_dir / constants.SETTINGS_FILENAME
+    search_index_dir     = args.work_dir / constants.SEARCH_INDEX_DIRNAME
+
+    # Recorded so that search.py embeds faces of reference photos with the same model.
+    utils.update_settings(settings_path, model = args.model, normalization = args.normalization)
     
     print('Starting creating face embeddings...')
-    embeddings = make_embeddings(cropped_faces_dir, faces_csv_path, args.model, args.normalization)
+    n_embeddings = make_embeddings(cropped_faces_dir, face_store_dir, faces_csv_path, embeddings_file_path, embedding_ids_path,
+                                   args.model, args.normalization, args.batch_size, args.dtype, args.incremental, quality.thresholds(args))
 
-    print('Saving embeddings...')
-    embeddings = np.stack(embeddings, axis = 0)
-    np.save(embeddings_file_path, embeddings, allow_pickle = False)
+    # A search index built by search.py is kept up to date with the new embeddings.
+    ann_index.sync_existing(search_index_dir, embeddings_file_path, embedding_ids_path)
 
-    print('Process completed.')
+    print(f'Process completed. Created {n_embeddings} embeddings.')
 
 
 
@@ -54,23 +69,72 @@ def parse_args():
                         default = 'Facenet',
                         help = 'The normalization technique used in the pre-processing step of the face images. Must be supported by DeepFace.represent().')
 
+    parser.add_argument('-b', '--batch_size',
+                        type = int,
+                        default = 32,
+                        help = 'Number of faces whose embeddings are computed together. The next batch is read from disk while the current one is processed.')
+
+    parser.add_argument('-t', '--dtype',
+                        default = 'float32',
+                        choices = ['float16', 'float32', 'float64'],
+                        help = 'The data type in which embeddings are stored on disk. float16 halves the size of the file at the cost of precision.')
+
+    parser.add_argument('-r', '--incremental',
+                        action = argparse.BooleanOptionalAction,
+                        default = False,
+                        help = 'Whether or not to keep the existing embeddings and only create the ones of new faces. This also resumes an interrupted run.')
+
+    # Embeddings of faces below the quality thresholds are not created, but those created by an
+    # earlier run are kept, cluster.py leaving them out with the same thresholds.
+    quality.add_arguments(parser)
+    model_client.add_arguments(parser)
+    profiling.add_arguments(parser)
+
     args = parser.parse_args()
     
     return args
 
 
 
-def make_embeddings(cropped_faces_dir, faces_csv_path, model, normalization):
+def make_embeddings(cropped_faces_dir, face_store_dir, faces_csv_path, embeddings_file_path, embedding_ids_path,
+                    model, normalization, batch_size, dtype, incremental, quality_thresholds):
     
-    face_paths = utils.load_csv(faces_csv_path)['id']
-    face_paths = [cropped_faces_dir / f"{id_}.png" for id_ in face_paths]
+    # Near-duplicate images share the ids of their faces. Only the id and quality score columns are read.
+    face_metadata = face_store.load_faces(face_store_dir, ['id', *quality.COLUMNS] if quality_thresholds else ['id'], faces_csv_path)
+    face_ids      = face_metadata['id'].unique()
+
+    with array_store.EmbeddingsWriter(embeddings_file_path, embedding_ids_path, dtype, append = incremental) as writer, \
+         crop_store.open_reader(cropped_faces_dir) as crop_reader:
+        # Embeddings of faces which were dropped from the metadata are deleted, those of kept faces are reused.
+        writer.retain(face_ids)
+        face_ids = face_ids[~np.isin(face_ids, writer.ids)]
+
+        if quality_thresholds:
+            rejected, failed_ids = quality.rejected_ids(face_metadata, quality_thresholds)
+            n_rejected, failed_counts = quality.count_rejected(face_ids, rejected, failed_ids)
+            print(quality.report(failed_counts, n_rejected, len(face_ids), 'embedded'))
+            profiling.count('faces_rejected_quality', n_rejected)
+            face_ids = face_ids[~np.isin(face_ids, rejected)]
+
+        batches = [face_ids[i:i + batch_size] for i in range(0, len(face_ids), batch_size)]
+
+        embedder   = embedding.FaceEmbedder(model, normalization)
+        load_batch = partial(_load_faces, embedder, crop_reader)
+
+        # Each batch is committed as soon as it is computed, so a crash only loses the current batch.
+        with tqdm(total = len(face_ids), ascii = True, desc = 'Files processed') as pbar:
+            for ids, faces in zip(batches, pipeline.iter_prefetched(load_batch, batches)):
+                writer.append(ids, embedder.embed(faces))
+                writer.commit()
+                pbar.update(len(faces))
+
+    return len(face_ids)
+
 
-    embeddings = []
-    for path in tqdm(face_paths, ascii = True, desc = 'Files processed'):
-        result, = DeepFace.represent(path, model_name = model, detector_backend = 'skip', normalization = normalization, anti_spoofing = False)
-        embeddings.append(result['embedding'])
 
-    return embeddings
+def _load_faces(embedder, crop_reader, face_ids):
+    with profiling.stage('load_faces'):
+        return [embedder.preprocess(crop_reader.read(id_)) for id_ in face_ids]
 
 
 
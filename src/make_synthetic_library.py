@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+
+# Constants is imported first so that it sets up the environment variables.
+import constants as _
+
+import json
+import random
+import pathlib
+import argparse
+
+import cv2
+import numpy as np
+import pillow_heif
+from PIL import Image
+
+
+pillow_heif.register_heif_opener()
+pillow_heif.register_avif_opener()
+
+# PIL format and extension of each image format which can be generated.
+_IMAGE_FORMATS = {'jpeg': ('JPEG', '.jpg'),
+                  'png' : ('PNG',  '.png'),
+                  'heif': ('HEIF', '.heic'),
+                  'avif': ('AVIF', '.avif')}
+
+# EXIF orientations of photos taken with a rotated camera: 180, 90 clockwise and 90 anticlockwise.
+_ROTATED_ORIENTATIONS = [3, 6, 8]
+_EXIF_ORIENTATION_TAG = 0x0112
+
+_VIDEO_FPS = 30
+# Videos cut to a different scene every this many seconds, so that the scene filter has work to do.
+_VIDEO_SCENE_SECS = 2
+
+
+
+def main():
+    args = parse_args()
+
+    args.output_dir.mkdir(parents = True, exist_ok = True)
+    if any(args.output_dir.iterdir()):
+        raise SystemExit(f'Output directory {args.output_dir} is not empty.')
+
+    counts = make_library(args.output_dir, args.n_images, _parse_weights(args.formats), args.sizes,
+                          args.rotated_rate, args.duplicate_rate, args.n_videos, args.video_secs,
+                          args.n_other, args.n_dirs, args.seed)
+
+    print('Synthetic library generated:')
+    print(json.dumps(counts, indent = 4))
+
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description = "This script generates a reproducible synthetic photo library, with a controllable mix of image formats and sizes, rotated photos, near-duplicates, short videos and non-media files, to benchmark the pipeline on (see benchmark.py).",
+                                     formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-o', '--output_dir',
+                        required = True,
+                        type = pathlib.Path,
+                        help = 'Empty directory in which to generate the library.')
+
+    parser.add_argument('-n', '--n_images',
+                        type = int,
+                        default = 200,
+                        help = 'Number of photos, near-duplicates included.')
+
+    parser.add_argument('--formats',
+                        type = str,
+                        default = 'jpeg:0.7,png:0.1,heif:0.1,avif:0.1',
+                        help = f'Comma-separated format:weight pairs giving the share of photos in each format. Formats: {", ".join(_IMAGE_FORMATS)}.')
+
+    parser.add_argument('--sizes',
+                        nargs = '+',
+                        type = _parse_size,
+                        default = [(1024, 768), (2016, 1512), (4032, 3024)],
+                        help = 'Photo sizes as WIDTHxHEIGHT, chosen uniformly at random. Portrait photos are obtained with --rotated_rate.')
+
+    parser.add_argument('--rotated_rate',
+                        type = float,
+                        default = 0.2,
+                        help = 'Fraction of JPEG photos stored rotated, with an EXIF orientation tag to undo the rotation.')
+
+    parser.add_argument('--duplicate_rate',
+                        type = float,
+                        default = 0.1,
+                        help = 'Fraction of photos which are near-duplicates of another one: re-encoded at another quality, resized or converted to another format.')
+
+    parser.add_argument('--n_videos',
+                        type = int,
+                        default = 4,
+                        help = 'Number of MP4 videos.')
+
+    parser.add_argument('--video_secs',
+                        type = float,
+                        default = 10,
+                        help = 'Duration of each video in seconds.')
+
+    parser.add_argument('--n_other',
+                        type = int,
+                        default = 20,
+                        help = 'Number of non-media files: text and JSON files, empty files and files whose extension lies about their content.')
+
+    parser.add_argument('--n_dirs',
+                        type = int,
+                        default = 10,
+                        help = 'Number of sub-directories files are spread into, some nested in others like "Year/Event" folders.')
+
+    parser.add_argument('-s', '--seed',
+                        type = int,
+                        default = 0,
+                        help = 'Seed of the random generators. The same seed and arguments generate the same library.')
+
+    args = parser.parse_args()
+
+    return args
+
+
+
+def _parse_size(size):
+    try:
+        width, height = map(int, size.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid size {size}, expected WIDTHxHEIGHT')
+    return width, height
+
+
+
+def _parse_weights(formats):
+    weights = {}
+    for pair in formats.split(','):
+        name, weight = pair.split(':')
+        if name not in _IMAGE_FORMATS:
+            raise SystemExit(f'Unknown format {name}, expected one of {", ".join(_IMAGE_FORMATS)}.')
+        weights[name] = float(weight)
+    return weights
+
+
+
+def make_library(output_dir, n_images, format_weights, sizes, rotated_rate, duplicate_rate,
+                 n_videos, video_secs, n_other, n_dirs, seed):
+    # Returns the number of files generated of each kind.
+    rng        = random.Random(seed)
+    np_rng     = np.random.default_rng(seed)
+    dirs       = _make_dirs(output_dir, n_dirs, rng)
+    formats    = list(format_weights)
+    counts     = {'rotated': 0, 'duplicates': 0, 'videos': 0, 'other': 0}
+    originals  = []
+
+    for i in range(n_images):
+        path_stem = rng.choice(dirs) / f'IMG_{i:05d}'
+        file_format = rng.choices(formats, weights = [format_weights[f] for f in formats])[0]
+
+        if originals and rng.random() < duplicate_rate:
+            # Near-duplicate of an earlier photo: same content, another encoding or size.
+            image = rng.choice(originals)
+            scale = rng.choice([1, 0.75, 0.5])
+            if scale != 1:
+                image = cv2.resize(image, None, fx = scale, fy = scale, interpolation = cv2.INTER_AREA)
+            counts['duplicates'] += 1
+        else:
+            image = _make_image(rng.choice(sizes), np_rng)
+            originals.append(image)
+
+        orientation = None
+        if file_format == 'jpeg' and rng.random() < rotated_rate:
+            orientation = rng.choice(_ROTATED_ORIENTATIONS)
+            counts['rotated'] += 1
+
+        _save_image(image, path_stem, file_format, rng.randint(70, 95), orientation)
+        counts[file_format] = counts.get(file_format, 0) + 1
+
+    for i in range(n_videos):
+        _save_video(rng.choice(dirs) / f'VID_{i:05d}.mp4', rng.choice(sizes), video_secs, np_rng)
+        counts['videos'] += 1
+
+    for i in range(n_other):
+        _save_other(rng.choice(dirs), i, rng, np_rng)
+        counts['other'] += 1
+
+    return counts
+
+
+
+def _make_dirs(output_dir, n_dirs, rng):
+    dirs = [output_dir]
+    for i in range(n_dirs):
+        # Half of the sub-directories are nested in a previous one, like "Year/Event" folders.
+        parent = rng.choice(dirs) if rng.random() < 0.5 else output_dir
+        path   = parent / f'Folder {i:03d}'
+        path.mkdir()
+        dirs.append(path)
+    return dirs
+
+
+
+def _make_image(size, np_rng):
+    # Smooth random background with blobs, so that photos compress like real ones rather than like
+    # noise or flat colours, and a few bright ellipses standing in for faces.
+    width, height = size
+    image = np_rng.integers(0, 256, (max(2, height // 64), max(2, width // 64), 3), dtype = np.uint8)
+    image = cv2.resize(image, (width, height), interpolation = cv2.INTER_CUBIC)
+    image = cv2.add(image, np_rng.integers(0, 12, image.shape, dtype = np.uint8))
+
+    for _ in range(np_rng.integers(0, 4)):
+        axes   = int(np_rng.integers(min(size) // 20, min(size) // 6))
+        center = (int(np_rng.integers(axes, width - axes)), int(np_rng.integers(axes, height - axes)))
+        colour = tuple(int(c) for c in np_rng.integers(120, 230, 3))
+        cv2.ellipse(image, center, (axes, int(axes * 1.3)), 0, 0, 360, colour, -1)
+        for side in (-1, 1):
+            cv2.circle(image, (center[0] + side * axes // 2, center[1] - axes // 4), max(1, axes // 8), (40, 40, 40), -1)
+
+    return image
+
+
+
+def _save_image(image, path_stem, file_format, quality, orientation):
+    pil_format, extension = _IMAGE_FORMATS[file_format]
+
+    kwargs = {'quality': quality} if file_format != 'png' else {}
+    if orientation is not None:
+        # The pixels are stored rotated, as a camera does, and the tag tells viewers to undo it.
+        rotation = {3: cv2.ROTATE_180, 6: cv2.ROTATE_90_COUNTERCLOCKWISE, 8: cv2.ROTATE_90_CLOCKWISE}[orientation]
+        image    = cv2.rotate(image, rotation)
+        exif     = Image.Exif()
+        exif[_EXIF_ORIENTATION_TAG] = orientation
+        kwargs['exif'] = exif.tobytes()
+
+    Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB)).save(path_stem.with_suffix(extension), pil_format, **kwargs)
+
+
+
+def _save_video(path, size, secs, np_rng):
+    # Smaller than photos, like phone videos, with a slowly panning scene cut every few seconds.
+    width, height = (dim // 2 // 16 * 16 for dim in size)
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*'mp4v'), _VIDEO_FPS, (width, height))
+
+    n_frames = int(secs * _VIDEO_FPS)
+    scene    = None
+    for frame_idx in range(n_frames):
+        if frame_idx % (_VIDEO_SCENE_SECS * _VIDEO_FPS) == 0:
+            scene = _make_image((width * 2, height), np_rng)
+        offset = frame_idx % (_VIDEO_SCENE_SECS * _VIDEO_FPS) * width // (_VIDEO_SCENE_SECS * _VIDEO_FPS)
+        writer.write(np.ascontiguousarray(scene[:, offset:offset + width]))
+
+    writer.release()
+
+
+
+def _save_other(directory, i, rng, np_rng):
+    kind = rng.choice(['text', 'json', 'empty', 'fake_image', 'binary'])
+
+    if kind == 'text':
+        (directory / f'notes_{i:03d}.txt').write_text('Synthetic note.\n' * rng.randint(1, 100))
+    elif kind == 'json':
+        (directory / f'metadata_{i:03d}.json').write_text(json.dumps({'index': i, 'tags': ['synthetic'] * rng.randint(1, 10)}))
+    elif kind == 'empty':
+        (directory / f'empty_{i:03d}.jpg').touch()
+    elif kind == 'fake_image':
+        # An extension which lies about the content, e.g. a file renamed by hand.
+        (directory / f'IMG_fake_{i:03d}.jpg').write_text('This is not a JPEG.\n')
+    else:
+        (directory / f'data_{i:03d}.bin').write_bytes(np_rng.bytes(rng.randint(1, 1 << 16)))
+
+
+
+if __name__ == '__main__':
+    main()
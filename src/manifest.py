@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+import os
+import csv
+
+import utils
+
+
+_FIELDS = ['path', 'size', 'mtime_ns', 'hash']
+
+
+
+class Manifest:
+    # Persistent record of every input file whose faces were fully written to the work directory.
+    # Rows are appended and flushed one file at a time, so after a crash or Ctrl-C the manifest
+    # lists exactly the files that do not need to be processed again.
+
+    def __init__(self, path, hash_contents):
+        self.path          = path
+        self.hash_contents = hash_contents
+        self.entries       = _load_entries(path)
+        self._file         = None
+        self._csv_writer   = None
+
+
+    def __enter__(self):
+        self._file = open(self.path, 'a', newline = '', encoding = 'utf-8', errors = 'surrogateescape')
+        self._csv_writer = csv.writer(self._file)
+        if self._file.tell() == 0:
+            self._csv_writer.writerow(_FIELDS)
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self._file.close()
+        self._file = self._csv_writer = None
+
+
+    def partition(self, files):
+        # Splits files, given as tuples starting with (path, size, mtime_ns) such as the rows of
+        # the file inventory, into the set of paths already processed with the same content and
+        # the list of tuples of files which are new or were modified since.
+        unchanged_paths  = set()
+        files_to_process = []
+
+        for file in files:
+            path, size, mtime_ns = file[:3]
+            if self._is_unchanged(str(path), size, mtime_ns):
+                unchanged_paths.add(str(path))
+            else:
+                files_to_process.append(file)
+
+        return unchanged_paths, files_to_process
+
+
+    def compact(self, kept_paths):
+        # Rewrites the manifest keeping only kept_paths, dropping deleted and modified files.
+        self.entries = {path: entry for path, entry in self.entries.items() if path in kept_paths}
+
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w', newline = '', encoding = 'utf-8', errors = 'surrogateescape') as file:
+            csv_writer = csv.writer(file)
+            csv_writer.writerow(_FIELDS)
+            for path, (size, mtime_ns, content_hash) in self.entries.items():
+                csv_writer.writerow([path, size, mtime_ns, content_hash])
+        os.replace(tmp_path, self.path)
+
+
+    def commit(self, path, size, mtime_ns):
+        content_hash = utils.hash_file(path) if self.hash_contents else ''
+        self.entries[str(path)] = (size, mtime_ns, content_hash)
+        self._csv_writer.writerow([path, size, mtime_ns, content_hash])
+        self._file.flush()
+
+
+    def _is_unchanged(self, key, size, mtime_ns):
+        entry = self.entries.get(key)
+        if entry is None:
+            return False
+
+        old_size, old_mtime_ns, old_hash = entry
+        if (old_size, old_mtime_ns) == (size, mtime_ns):
+            return True
+
+        # Copies and syncs may touch the modification time without changing the content.
+        if self.hash_contents and old_hash and old_size == size:
+            content_hash = utils.hash_file(key)
+            if content_hash == old_hash:
+                self.entries[key] = (size, mtime_ns, content_hash)
+                return True
+
+        return False
+
+
+
+def _load_entries(path):
+    entries = {}
+    if not path.is_file():
+        return entries
+
+    with open(path, newline = '', encoding = 'utf-8', errors = 'surrogateescape') as file:
+        csv_reader = csv.reader(file)
+        next(csv_reader, None)
+        for row in csv_reader:
+            # A row truncated by a hard kill is ignored, its file is simply processed again.
+            if len(row) != len(_FIELDS):
+                continue
+            try:
+                entries[row[0]] = (int(row[1]), int(row[2]), row[3])
+            except ValueError:
+                continue
+
+    return entries
\ No newline at end of file
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+# Constants is imported first so that it sets up the environment variables.
+import constants
+
+import os
+import pathlib
+import argparse
+from shutil import rmtree
+from collections import Counter
+
+import numpy as np
+from tqdm import tqdm
+
+import array_store
+import crop_store
+import dedupe
+import face_store
+import inventory
+import manifest
+import profiling
+import utils
+
+
+# Settings which may differ between shards, e.g. when machines mount the input directory at
+# different places.
+_SHARD_SETTINGS = {'shard', 'input_dir'}
+# Number of problematic files listed when validating the shards.
+_MAX_LISTED     = 10
+_CHUNK_ROWS     = 1 << 16
+
+
+
+def main():
+    args = parse_args()
+    profiling.start(args.profile, args.cprofile)
+
+    if args.output_dir.is_dir():
+        if not utils.user_query_yes_no(f'Folder at "{args.output_dir}" already exists. Do you want to delete its content?'):
+            return
+        rmtree(args.output_dir)
+
+    print('Checking shards...')
+    settings = check_shards(args.shard_dirs, args.allow_incomplete)
+
+    # Ids of each shard are shifted past the ids of the previous shards, so that ids stay in the
+    # order of the shards and no id is used twice.
+    next_ids   = [face_store.next_id(shard_dir / constants.FACE_METADATA_DIRNAME) for shard_dir in args.shard_dirs]
+    id_offsets = np.concatenate([[0], np.cumsum(next_ids)[:-1]]).astype(np.int64).tolist()
+
+    args.output_dir.mkdir(parents = True)
+    with utils.print_duration('Merging face metadata'):
+        n_faces = face_store.merge_stores([shard_dir / constants.FACE_METADATA_DIRNAME for shard_dir in args.shard_dirs],
+                                          id_offsets, args.output_dir / constants.FACE_METADATA_DIRNAME)
+
+    with utils.print_duration('Merging extracted faces'):
+        crop_store.merge_crops([shard_dir / constants.CROPPED_FACES_DIRNAME for shard_dir in args.shard_dirs],
+                               id_offsets, args.output_dir / constants.CROPPED_FACES_DIRNAME, args.mode)
+
+    with utils.print_duration('Merging embeddings'):
+        n_embeddings = merge_embeddings(args.shard_dirs, id_offsets, args.output_dir)
+
+    if any((shard_dir / constants.IMAGE_HASHES_FILENAME).is_file() for shard_dir in args.shard_dirs):
+        dedupe.merge_indexes([shard_dir / constants.IMAGE_HASHES_FILENAME for shard_dir in args.shard_dirs],
+                             id_offsets, args.output_dir / constants.IMAGE_HASHES_FILENAME)
+
+    merge_file_lists(args.shard_dirs, args.output_dir)
+    utils.update_settings(args.output_dir / constants.SETTINGS_FILENAME,
+                          **{name: value for name, value in settings.items() if name not in _SHARD_SETTINGS})
+
+    print(f'Process completed. Merged {n_faces} faces and {n_embeddings} embeddings from {len(args.shard_dirs)} shards.')
+    n_embedded = sum((shard_dir / constants.EMBEDDINGS_FILENAME).is_file() for shard_dir in args.shard_dirs)
+    if 0 < n_embedded < len(args.shard_dirs):
+        print('Some shards have no embeddings, run make_embeddings.py with --incremental on the merged work directory to create them.')
+
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description = "This script combines the work directories written by extract_faces.py --shard into a single work directory, which the next steps use as if it had been extracted at once.",
+                                     formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-s', '--shard_dirs',
+                        required = True,
+                        nargs = '+',
+                        type = pathlib.Path,
+                        help = 'Work directories of all shards, written by extract_faces.py --shard.')
+
+    parser.add_argument('-w', '--output_dir',
+                        required = True,
+                        type = pathlib.Path,
+                        help = 'Merged work directory to create.')
+
+    parser.add_argument('-m', '--mode',
+                        choices = ['hardlink', 'symlink', 'reflink', 'copy'],
+                        default = 'hardlink',
+                        help = 'How extracted faces and shard files are placed into the merged work directory. Hardlinks and reflinks take no extra space and fall back to copies where the filesystem does not support them.')
+
+    parser.add_argument('--allow_incomplete',
+                        action = argparse.BooleanOptionalAction,
+                        default = False,
+                        help = 'Whether or not to merge shards even if some of their files were not processed, e.g. when one of them was interrupted. Missing shards and files processed by several shards are always errors.')
+
+    profiling.add_arguments(parser)
+
+    args = parser.parse_args()
+
+    return args
+
+
+
+def check_shards(shard_dirs, allow_incomplete):
+    # Checks that the shard directories are all the shards of one extraction, with the same settings,
+    # that no file was processed by two shards and that no file of the input directory was skipped.
+    # Returns the settings of the shards.
+    all_settings = [utils.load_settings(shard_dir / constants.SETTINGS_FILENAME) for shard_dir in shard_dirs]
+    for shard_dir, settings in zip(shard_dirs, all_settings):
+        if 'shard' not in settings:
+            raise SystemExit(f'{shard_dir} was not extracted with --shard!')
+
+    shards   = [tuple(settings['shard']) for settings in all_settings]
+    n_shards = {n_shards for _, n_shards in shards}
+    if len(n_shards) != 1:
+        raise SystemExit(f'The shards were extracted with different numbers of shards: {sorted(n_shards)}!')
+
+    n_shards = n_shards.pop()
+    counts   = Counter(shard_idx for shard_idx, _ in shards)
+    missing  = sorted(set(range(n_shards)) - set(counts))
+    repeated = sorted(shard_idx for shard_idx, count in counts.items() if count > 1)
+    if missing or repeated:
+        raise SystemExit(f'Expected each of the {n_shards} shards once, missing shards: {missing}, repeated shards: {repeated}!')
+
+    for shard_dir, settings in zip(shard_dirs, all_settings):
+        different = sorted(name for name in set(settings) | set(all_settings[0])
+                           if name not in _SHARD_SETTINGS and settings.get(name) != all_settings[0].get(name))
+        if different:
+            raise SystemExit(f'{shard_dir} was extracted with different settings than {shard_dirs[0]}: {", ".join(different)}!')
+
+    # Every processed file is in the manifest of its shard. Files are compared by their path relative
+    # to the input directory of their shard.
+    processed = [set(manifest.Manifest(shard_dir / constants.MANIFEST_FILENAME, False).entries) for shard_dir in shard_dirs]
+    counts    = Counter(os.path.relpath(path, settings['input_dir']) for settings, paths in zip(all_settings, processed) for path in paths)
+    twice     = [path for path, count in counts.items() if count > 1]
+    if twice:
+        raise SystemExit(f'{len(twice)} files were processed by several shards, e.g.:\n' + '\n'.join(twice[:_MAX_LISTED]))
+
+    skipped = []
+    for shard_dir, settings, paths in zip(shard_dirs, all_settings, processed):
+        files    = inventory.load_inventory(shard_dir / constants.INVENTORY_FILENAME)
+        skipped += [path for path, *_ in inventory.shard_files(files, settings['input_dir'], settings['shard'][0], n_shards) if path not in paths]
+    if skipped:
+        message = f'{len(skipped)} files of the inventories were not processed by their shard, e.g.:\n' + '\n'.join(skipped[:_MAX_LISTED])
+        if not allow_incomplete:
+            raise SystemExit(message + '\nRun extract_faces.py --incremental on these shards to complete them.')
+        print(message)
+
+    return all_settings[0]
+
+
+
+def merge_embeddings(shard_dirs, id_offsets, output_dir):
+    # Concatenates the embeddings of the shards which have some, with their ids shifted. Returns the
+    # number of embeddings written.
+    shards = [(shard_dir / constants.EMBEDDINGS_FILENAME, shard_dir / constants.EMBEDDING_IDS_FILENAME, id_offset)
+              for shard_dir, id_offset in zip(shard_dirs, id_offsets) if (shard_dir / constants.EMBEDDINGS_FILENAME).is_file()]
+    if not shards:
+        return 0
+
+    dtype = np.load(shards[0][0], mmap_mode = 'r').dtype
+    with array_store.EmbeddingsWriter(output_dir / constants.EMBEDDINGS_FILENAME, output_dir / constants.EMBEDDING_IDS_FILENAME, dtype, append = False) as writer:
+        for embeddings_path, embedding_ids_path, id_offset in tqdm(shards, ascii = True, desc = 'Shards merged'):
+            ids, embeddings = array_store.open_embeddings(embeddings_path, embedding_ids_path)
+            for start in range(0, len(ids), _CHUNK_ROWS):
+                writer.append(np.asarray(ids[start:start + _CHUNK_ROWS]) + id_offset, embeddings[start:start + _CHUNK_ROWS])
+                writer.commit()
+        return len(writer.ids)
+
+
+
+def merge_file_lists(shard_dirs, output_dir):
+    # The merged manifest lists the files processed by every shard, so that extract_faces.py
+    # --incremental on the merged work directory only processes new or modified files. The merged
+    # inventory is the one of the first shard, which listed the whole input directory.
+    merged = manifest.Manifest(output_dir / constants.MANIFEST_FILENAME, False)
+    for shard_dir in shard_dirs:
+        merged.entries.update(manifest.Manifest(shard_dir / constants.MANIFEST_FILENAME, False).entries)
+    merged.compact(set(merged.entries))
+
+    files = inventory.load_inventory(shard_dirs[0] / constants.INVENTORY_FILENAME)
+    inventory.save_inventory(output_dir / constants.INVENTORY_FILENAME, files)
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import hdbscan
+from tqdm import tqdm
+from sklearn import metrics
+
+import embedding_ops
+
+
+# Fraction of --max_memory given to the batch of embeddings being read, the rest being left to the
+# centroids, the labels of all faces and the distance blocks.
+_BATCH_MEMORY_FRACTION = 0.25
+
+
+
+def n_micro_clusters(n_rows, min_cluster_size):
+    # Two micro-clusters per smallest cluster HDBSCAN may find, so that small clusters are not
+    # merged into larger ones before HDBSCAN sees them.
+    return int(min(n_rows, max(100, 2 * n_rows // max(min_cluster_size, 1))))
+
+
+
+def compress(embeddings, n_clusters, normalize, n_epochs, max_memory, chunk_size, seed = 0):
+    # Streams over the (possibly memory-mapped) embeddings with mini-batch k-means, reading one batch
+    # of rows at a time, then assigns every embedding to its nearest centroid. Returns the
+    # centroids, the number of embeddings of each of them and the micro-cluster of each embedding.
+    n_rows, n_dims = embeddings.shape
+    batch_size     = max(chunk_size, int(max_memory * _BATCH_MEMORY_FRACTION) // (4 * n_dims))
+    if n_clusters * n_dims * 8 + n_rows * 4 > max_memory:
+        raise MemoryError(f'{n_clusters} micro-clusters of {n_rows} embeddings do not fit in {max_memory >> 20} MB, raise --max_memory or lower --n_micro_clusters.')
+
+    # Centroids start from a random sample of rows, read in increasing order.
+    rng       = np.random.default_rng(seed)
+    centroids = _load_batch(embeddings, np.sort(rng.choice(n_rows, n_clusters, replace = False)), normalize).astype(np.float64)
+    counts    = np.zeros(n_clusters, dtype = np.int64)
+
+    # Each centroid moves towards the mean of its points with a learning rate of one over the number
+    # of points it was assigned so far (Sculley, 2010). Batches are visited in random order.
+    for epoch in range(n_epochs):
+        batches = list(embedding_ops.iter_chunks(n_rows, batch_size))
+        for batch_idx in tqdm(rng.permutation(len(batches)), ascii = True, desc = f'Micro-clusters, epoch {epoch + 1}/{n_epochs}'):
+            batch        = _load_batch(embeddings, batches[batch_idx], normalize)
+            assignment   = embedding_ops.knn(batch, centroids, 1, chunk_size)[0][:, 0]
+            batch_counts = np.bincount(assignment, minlength = n_clusters)
+            sums         = np.zeros_like(centroids)
+            np.add.at(sums, assignment, batch)
+
+            counts += batch_counts
+            updated = batch_counts > 0
+            centroids[updated] += (sums[updated] - batch_counts[updated, np.newaxis] * centroids[updated]) / counts[updated, np.newaxis]
+
+    labels = np.empty(n_rows, dtype = np.int32)
+    for rows in tqdm(list(embedding_ops.iter_chunks(n_rows, batch_size)), ascii = True, desc = 'Assigning to micro-clusters'):
+        labels[rows] = embedding_ops.knn(_load_batch(embeddings, rows, normalize), centroids, 1, chunk_size)[0][:, 0]
+
+    return centroids.astype(np.float32), np.bincount(labels, minlength = n_clusters), labels
+
+
+
+def cluster_weighted(data, weights, hdbscan_kwargs):
+    # HDBSCAN on micro-clusters standing for weights embeddings each. HDBSCAN has no sample weights,
+    # so min_cluster_size is converted to a number of micro-clusters, and clusters of fewer than
+    # min_cluster_size embeddings are then made noise. Returns the label of each micro-cluster.
+    min_cluster_size = hdbscan_kwargs['min_cluster_size']
+    mean_weight      = weights[weights > 0].mean()
+    scaled_kwargs    = {**hdbscan_kwargs,
+                        'min_cluster_size': max(2, int(round(min_cluster_size / mean_weight))),
+                        'min_samples'     : max(1, int(round(hdbscan_kwargs['min_samples'] / mean_weight)))}
+
+    labels = hdbscan.HDBSCAN(**scaled_kwargs).fit_predict(data)
+    if labels.max() < 0:
+        return labels
+
+    # Empty micro-clusters are not used by any face, their label does not matter.
+    cluster_sizes = np.bincount(labels[labels >= 0], weights = weights[labels >= 0])
+    too_small     = cluster_sizes < min_cluster_size
+    remap         = np.where(too_small, -1, np.cumsum(~too_small) - 1)
+    return np.where(labels >= 0, remap[np.maximum(labels, 0)], -1)
+
+
+
+def compare_with_exact(embeddings, n_sample, n_micro_clusters, hdbscan_kwargs, normalize, n_epochs, max_memory, chunk_size, seed = 0):
+    # Clusters a random sample of the embeddings both in two stages and directly with HDBSCAN, with
+    # the same parameters, and scores how much the two clusterings agree. The sample is compressed
+    # into as many faces per micro-cluster as all embeddings were into n_micro_clusters, so that
+    # both stages see the same parameters as the full run. Returns a dict of scores.
+    n_rows = len(embeddings)
+    rows   = np.sort(np.random.default_rng(seed).choice(n_rows, min(n_sample, n_rows), replace = False))
+    sample = np.asarray(embeddings[rows], dtype = np.float32)
+
+    n_sample_micro_clusters = max(2, int(round(n_micro_clusters * len(rows) / n_rows)))
+    centroids, weights, micro_labels = compress(sample, n_sample_micro_clusters, normalize, n_epochs, max_memory, chunk_size, seed)
+    two_stage_labels = cluster_weighted(centroids.astype(np.float64), weights, hdbscan_kwargs)[micro_labels]
+
+    exact_labels = hdbscan.HDBSCAN(**hdbscan_kwargs).fit_predict(_load_batch(sample, slice(None), normalize).astype(np.float64))
+
+    return {'n_sample'                : len(rows),
+            'n_micro_clusters'        : n_sample_micro_clusters,
+            'adjusted_mutual_info'    : metrics.adjusted_mutual_info_score(exact_labels, two_stage_labels),
+            'adjusted_rand'           : metrics.adjusted_rand_score(exact_labels, two_stage_labels),
+            'n_clusters_exact'        : int(exact_labels.max()) + 1,
+            'n_clusters_two_stage'    : int(two_stage_labels.max()) + 1,
+            'noise_fraction_exact'    : float(np.mean(exact_labels == -1)),
+            'noise_fraction_two_stage': float(np.mean(two_stage_labels == -1))}
+
+
+
+def _load_batch(embeddings, rows, normalize):
+    batch = np.asarray(embeddings[rows], dtype = np.float32)
+    return embedding_ops.l2_normalize(batch) if normalize else batch
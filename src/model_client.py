@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import json
+import stat
+import socket
+import struct
+import tempfile
+import threading
+
+import numpy as np
+
+
+# Socket of model_server.py used by default, in a directory only the user can access, so that
+# no other user can serve or intercept the requests.
+if os.environ.get('XDG_RUNTIME_DIR'):
+    DEFAULT_SOCKET_PATH = os.path.join(os.environ['XDG_RUNTIME_DIR'], 'find-people-in-photos', 'model_server.sock')
+else:
+    DEFAULT_SOCKET_PATH = os.path.join(tempfile.gettempdir(), f'find-people-in-photos-{os.getuid()}', 'model_server.sock')
+
+_HEADER = struct.Struct('<Q')
+
+# Connection to the model server, if any. Detection and embedding are run locally when it is None.
+_socket = None
+_lock   = threading.Lock()
+
+
+
+def add_arguments(parser):
+    parser.add_argument('--model_server',
+                        nargs = '?',
+                        const = DEFAULT_SOCKET_PATH,
+                        default = None,
+                        help = f'Socket of a running model_server.py, which keeps the models loaded between runs, to detect faces and create embeddings with instead of loading the models in this process. Without a value, {DEFAULT_SOCKET_PATH}.')
+
+
+
+def connect(socket_path):
+    # Detection and embedding go through the server at socket_path from now on. If it cannot be
+    # reached, or may belong to another user, they are run locally as without a server.
+    global _socket
+    if socket_path is None:
+        return
+
+    try:
+        check_private_dir(os.path.dirname(os.path.abspath(socket_path)))
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(str(socket_path))
+        check_peer(client, socket_path)
+    except (OSError, PermissionError) as error:
+        print(f'Model server at {socket_path} not usable ({error}), models are loaded locally.')
+        return
+
+    _socket = client
+
+
+
+def is_connected():
+    return _socket is not None
+
+
+
+def detect(image, detector_name, align_output_faces, min_confidence, min_size):
+    return _request('detect', image = image, detector_name = detector_name, align_output_faces = align_output_faces,
+                    min_confidence = min_confidence, min_size = min_size)
+
+
+
+def embed(faces, model_name, normalization):
+    return _request('embed', faces = faces, model_name = model_name, normalization = normalization)
+
+
+
+def check_private_dir(dir_path):
+    # Raises PermissionError unless the directory is owned by the user and only accessible to
+    # them, as anyone who can write to it can replace the socket.
+    info = os.lstat(dir_path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise PermissionError(f'{dir_path} must be a directory owned by the current user and not accessible to others')
+
+
+
+def check_peer(sock, socket_path):
+    # Raises PermissionError unless the other end of the connection runs as the current user. The
+    # owner of the socket file is checked where the credentials of the peer are not available.
+    if hasattr(socket, 'SO_PEERCRED'):
+        _, uid, _ = struct.unpack('3i', sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i')))
+    else:
+        uid = os.stat(socket_path).st_uid
+    if uid != os.getuid():
+        raise PermissionError(f'{socket_path} belongs to another user')
+
+
+
+def send_message(sock, message):
+    # Messages are a JSON document in which arrays are replaced by their index, followed by the
+    # arrays in .npy format, each prefixed by its length. No pickle is ever loaded.
+    arrays = []
+    parts  = [json.dumps(_encode(message, arrays)).encode()]
+    for array in arrays:
+        buffer = io.BytesIO()
+        np.save(buffer, array, allow_pickle = False)
+        parts.append(buffer.getvalue())
+
+    sock.sendall(_HEADER.pack(len(parts)) + b''.join(_HEADER.pack(len(part)) + part for part in parts))
+
+
+
+def receive_message(sock):
+    # Returns None when the other side closed the connection.
+    header = _receive_exactly(sock, _HEADER.size)
+    if header is None:
+        return None
+
+    parts = []
+    for _ in range(_HEADER.unpack(header)[0]):
+        length = _receive_exactly(sock, _HEADER.size)
+        part   = _receive_exactly(sock, _HEADER.unpack(length)[0]) if length is not None else None
+        if part is None:
+            return None
+        parts.append(part)
+
+    arrays = [np.load(io.BytesIO(part), allow_pickle = False) for part in parts[1:]]
+    return _decode(json.loads(parts[0]), arrays)
+
+
+
+def _encode(value, arrays):
+    # Tuples are sent as lists.
+    if isinstance(value, np.ndarray):
+        arrays.append(value)
+        return {'__array__': len(arrays) - 1}
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, dict):
+        return {key: _encode(item, arrays) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_encode(item, arrays) for item in value]
+    return value
+
+
+
+def _decode(value, arrays):
+    if isinstance(value, dict):
+        if set(value) == {'__array__'}:
+            return arrays[value['__array__']]
+        return {key: _decode(item, arrays) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_decode(item, arrays) for item in value]
+    return value
+
+
+
+def _request(operation, **arguments):
+    # Requests of the threads of a process are sent one after the other on its connection.
+    with _lock:
+        send_message(_socket, {'operation': operation, **arguments})
+        response = receive_message(_socket)
+
+    if response is None:
+        raise ConnectionError('The model server closed the connection!')
+    if 'error' in response:
+        raise RuntimeError(f'The model server failed to {operation}: {response["error"]}')
+    return response['result']
+
+
+
+def _receive_exactly(sock, n_bytes):
+    chunks = []
+    while n_bytes:
+        chunk = sock.recv(min(n_bytes, 1 << 20))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        n_bytes -= len(chunk)
+    return b''.join(chunks)
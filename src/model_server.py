@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+
+# Constants is imported first so that it sets up the environment variables.
+import constants as _
+
+import os
+import queue
+import signal
+import socket
+import pathlib
+import argparse
+import threading
+import traceback
+import socketserver
+from concurrent.futures import Future
+
+import numpy as np
+
+import detection
+import embedding
+import model_client
+import profiling
+
+
+
+def main():
+    args = parse_args()
+    profiling.start(args.profile, args.cprofile)
+
+    # Anyone who can write to the directory of the socket could replace it, so it is only
+    # accessible to the user.
+    args.socket.parent.mkdir(mode = 0o700, parents = True, exist_ok = True)
+    try:
+        model_client.check_private_dir(args.socket.parent)
+    except PermissionError as error:
+        raise SystemExit(f'{error}!')
+
+    if args.socket.exists():
+        if _is_listening(args.socket):
+            raise SystemExit(f'A model server is already running at {args.socket}!')
+        # Left behind by a server which did not exit cleanly.
+        args.socket.unlink()
+
+    # Importing Tensorflow and building the models is what the server saves its clients, so it is
+    # done once here rather than on the first request.
+    models = ModelServer(args.max_batch_size, args.batch_wait / 1000)
+    for detector_name in args.detectors:
+        print(f'Loading detector {detector_name}...')
+        models.detect(np.zeros((64, 64, 3), dtype = np.uint8), detector_name, False, 0, 0)
+    for model_name in args.models:
+        print(f'Loading model {model_name}...')
+        models.load_model(model_name, args.normalization)
+
+    # Only the user running the server may connect.
+    previous_umask = os.umask(0o177)
+    try:
+        server = _Server(str(args.socket), _Handler)
+    finally:
+        os.umask(previous_umask)
+    server.models = models
+
+    # Terminating the server, e.g. when it runs in the background, stops it as Ctrl+C does, so
+    # that the socket is removed.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    print(f'Model server listening at {args.socket}, stop it with Ctrl+C.')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        args.socket.unlink(missing_ok = True)
+
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description = "This script keeps face detectors and embedding models loaded in a long-lived process, and serves the face detections and embeddings of extract_faces.py, make_embeddings.py and search.py when they are run with --model_server, so that they start without loading Tensorflow and the models every time.",
+                                     formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-s', '--socket',
+                        type = pathlib.Path,
+                        default = pathlib.Path(model_client.DEFAULT_SOCKET_PATH),
+                        help = 'Path of the Unix socket to listen on. Its directory is created if needed, and must only be accessible to the user.')
+
+    parser.add_argument('-d', '--detectors',
+                        nargs = '*',
+                        default = ['retinaface'],
+                        help = 'Detectors loaded at startup. Other detectors supported by Deepface.extract_faces() are loaded on their first request.')
+
+    parser.add_argument('-m', '--models',
+                        nargs = '*',
+                        default = ['Facenet'],
+                        help = 'Embedding models loaded at startup. Other models supported by DeepFace.represent() are loaded on their first request.')
+
+    parser.add_argument('--normalization',
+                        type = str,
+                        default = 'Facenet',
+                        help = 'Normalization of the models loaded at startup. Requests may use any other normalization with the same model.')
+
+    parser.add_argument('--max_batch_size',
+                        type = int,
+                        default = 64,
+                        help = 'Largest number of faces embedded at once. Faces of concurrent requests for the same model are embedded together up to this size.')
+
+    parser.add_argument('--batch_wait',
+                        type = float,
+                        default = 2.0,
+                        help = 'Milliseconds to wait for requests of other clients to fill a batch of embeddings before running it.')
+
+    profiling.add_arguments(parser)
+
+    args = parser.parse_args()
+
+    return args
+
+
+
+class ModelServer:
+    # The models of the server, shared by all connections. Detections run one at a time, as the
+    # detectors of DeepFace are not thread-safe. Embedding requests are queued per model and
+    # normalization, and a thread per queue embeds the faces of all waiting requests together.
+
+    def __init__(self, max_batch_size, batch_wait):
+        self.max_batch_size = max_batch_size
+        self.batch_wait     = batch_wait
+        self._detect_lock   = threading.Lock()
+        self._batchers_lock = threading.Lock()
+        self._batchers      = {}
+
+
+    def detect(self, image, detector_name, align_output_faces, min_confidence, min_size):
+        with self._detect_lock:
+            return detection.detect_faces(image, detector_name, align_output_faces, min_confidence, min_size)
+
+
+    def embed(self, faces, model_name, normalization):
+        if not faces:
+            return np.empty((0, 0), dtype = np.float32)
+
+        future = Future()
+        self.load_model(model_name, normalization).put((faces, future))
+        return future.result()
+
+
+    def load_model(self, model_name, normalization):
+        # Returns the queue of the batching thread of the model, starting it on the first request.
+        key = (model_name, normalization)
+        with self._batchers_lock:
+            if key not in self._batchers:
+                requests = queue.Queue()
+                embedder = embedding.FaceEmbedder(model_name, normalization)
+                threading.Thread(target = self._run_batches, args = (embedder, requests), daemon = True).start()
+                self._batchers[key] = requests
+            return self._batchers[key]
+
+
+    def _run_batches(self, embedder, requests):
+        while True:
+            batch = [requests.get()]
+            n_faces = len(batch[0][0])
+            try:
+                while n_faces < self.max_batch_size:
+                    batch.append(requests.get(timeout = self.batch_wait))
+                    n_faces += len(batch[-1][0])
+            except queue.Empty:
+                pass
+
+            try:
+                preprocessed = [embedder.preprocess(face) for faces, _ in batch for face in faces]
+                embeddings   = np.concatenate([embedder.embed(preprocessed[start:start + self.max_batch_size])
+                                               for start in range(0, len(preprocessed), self.max_batch_size)])
+            except Exception as error:
+                for _, future in batch:
+                    future.set_exception(error)
+                continue
+
+            start = 0
+            for faces, future in batch:
+                future.set_result(embeddings[start:start + len(faces)])
+                start += len(faces)
+
+
+
+class _Server(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    # Serves the requests of one client, one after the other, until it disconnects.
+
+    def handle(self):
+        try:
+            model_client.check_peer(self.request, self.server.server_address)
+        except PermissionError as error:
+            print(f'Connection refused: {error}.')
+            return
+
+        models = self.server.models
+        while (request := model_client.receive_message(self.request)) is not None:
+            try:
+                operation = request.pop('operation')
+                if operation == 'detect':
+                    response = {'result': models.detect(**request)}
+                elif operation == 'embed':
+                    response = {'result': models.embed(**request)}
+                else:
+                    response = {'error': f'Unknown operation {operation}!'}
+            except Exception as error:
+                traceback.print_exc()
+                response = {'error': repr(error)}
+            model_client.send_message(self.request, response)
+
+
+
+def _is_listening(socket_path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(str(socket_path))
+        except OSError:
+            return False
+        return True
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+import queue
+import signal
+import traceback
+import itertools
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from tqdm import tqdm
+
+import image_io
+import profiling
+
+
+_WORKER_POLL_SECS = 1
+
+
+
+def iter_decoded_images(file_paths, file_formats, read_videos, secs_between_frames, trust_extensions, video_sampling, scene_threshold, n_workers, queue_depth):
+    # Yields (file_idx, timestamp, image) for every image or video frame of every file, followed
+    # by (file_idx, None, None) once the file is exhausted. timestamp is None for photos.
+    # file_formats gives the format of each file if already known, or None. With several workers, files are decoded in
+    # parallel processes and the messages of different files are interleaved, but the messages
+    # of a single file keep their order. The bounded queue keeps decoded frames from piling up
+    # in memory when the consumer is slower than the workers. A file failing to decode is reported
+    # and ends after the frames decoded so far, so that one broken file does not stop the run.
+    if n_workers == 0:
+        for file_idx, (path, file_format) in enumerate(zip(file_paths, file_formats)):
+            try:
+                yield from ((file_idx, timestamp, image) for timestamp, image in image_io.iter_file_images(path, read_videos, secs_between_frames, trust_extensions, video_sampling, scene_threshold, file_format))
+            except Exception:
+                _report_decode_error(path, traceback.format_exc())
+            yield file_idx, None, None
+        return
+
+    task_queue   = multiprocessing.Queue()
+    result_queue = multiprocessing.Queue(maxsize = queue_depth)
+    workers      = [multiprocessing.Process(target = _decode_worker,
+                                            args = (task_queue, result_queue, read_videos, secs_between_frames, trust_extensions, video_sampling, scene_threshold, profiling.is_enabled()),
+                                            daemon = True)
+                    for _ in range(n_workers)]
+
+    for worker in workers:
+        worker.start()
+
+    for file_idx, (path, file_format) in enumerate(zip(file_paths, file_formats)):
+        task_queue.put((file_idx, path, file_format))
+    for _ in workers:
+        task_queue.put(None)
+
+    try:
+        n_files_done = 0
+        while n_files_done < len(file_paths):
+            try:
+                # Time spent waiting here means that decoding is the bottleneck.
+                with profiling.stage('decode_wait'):
+                    file_idx, timestamp, image, error, metrics = result_queue.get(timeout = _WORKER_POLL_SECS)
+            except queue.Empty:
+                if any(worker.exitcode not in (None, 0) for worker in workers):
+                    raise RuntimeError('A decode worker died unexpectedly.')
+                continue
+
+            if error is not None:
+                _report_decode_error(file_paths[file_idx], error)
+
+            if image is None:
+                n_files_done += 1
+                profiling.merge(metrics)
+
+            yield file_idx, timestamp, image
+
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
+
+
+
+def _decode_worker(task_queue, result_queue, read_videos, secs_between_frames, trust_extensions, video_sampling, scene_threshold, profile):
+    # Ctrl-C is handled by the main process, which terminates the workers.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # Metrics of each file are sent to the main process with its last message. Those inherited
+    # from the main process when forked are discarded, as it already counts them.
+    profiling.drain()
+    if profile:
+        profiling.enable()
+
+    while (task := task_queue.get()) is not None:
+        file_idx, path, file_format = task
+
+        try:
+            for timestamp, image in image_io.iter_file_images(path, read_videos, secs_between_frames, trust_extensions, video_sampling, scene_threshold, file_format):
+                result_queue.put((file_idx, timestamp, image, None, None))
+        except Exception:
+            result_queue.put((file_idx, None, None, traceback.format_exc(), profiling.drain()))
+            continue
+
+        result_queue.put((file_idx, None, None, None, profiling.drain()))
+
+
+
+def _report_decode_error(path, error):
+    tqdm.write(f'Skipping "{path}", which failed to decode:\n{error}')
+    profiling.count('decode_errors')
+
+
+
+class OrderedCommitter:
+    # Runs the jobs of each submitted item on a thread pool, then calls commit_fn for the items
+    # strictly in submission order once all of their jobs completed. At most max_pending items
+    # are in flight, submit() blocks on the oldest one beyond that.
+
+    def __init__(self, n_workers, max_pending, commit_fn):
+        self.commit_fn   = commit_fn
+        self.max_pending = max(1, max_pending)
+        self._executor   = ThreadPoolExecutor(n_workers) if n_workers > 0 else None
+        self._pending    = deque()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, *exc_info):
+        try:
+            # On errors and Ctrl-C, only items whose jobs already succeeded are committed.
+            self._commit_ready(block = exc_type is None)
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(wait = True, cancel_futures = True)
+
+
+    def submit(self, jobs, *commit_args):
+        if self._executor is None:
+            for fn, *args in jobs:
+                fn(*args)
+            futures = []
+        else:
+            futures = [self._executor.submit(fn, *args) for fn, *args in jobs]
+
+        self._pending.append((futures, commit_args))
+
+        while len(self._pending) > self.max_pending:
+            self._commit_oldest()
+        self._commit_ready(block = False)
+
+
+    def _commit_ready(self, block):
+        while self._pending:
+            futures, _ = self._pending[0]
+            if not block and not all(future.done() for future in futures):
+                return
+            self._commit_oldest()
+
+
+    def _commit_oldest(self):
+        futures, commit_args = self._pending.popleft()
+        wait(futures)
+        for future in futures:
+            # Re-raises the exception of a failed job.
+            future.result()
+        self.commit_fn(*commit_args)
+
+
+
+def iter_prefetched(fn, items, n_prefetch = 1):
+    # Yields fn(item) for every item in order, computing the results of the next n_prefetch items
+    # in a background thread while the current result is being used.
+    items = iter(items)
+
+    with ThreadPoolExecutor(1) as executor:
+        futures = deque(executor.submit(fn, item) for item in itertools.islice(items, n_prefetch))
+
+        while futures:
+            result = futures.popleft().result()
+            futures.extend(executor.submit(fn, item) for item in itertools.islice(items, 1))
+            yield result
\ No newline at end of file
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import csv
+import math
+import json
+import time
+import atexit
+import cProfile
+import threading
+import contextlib
+from collections import defaultdict
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# Durations are counted in logarithmic bins, this many per factor of 10 from _MIN_DURATION
+# seconds, so that percentiles are within about 1% whatever the number of samples.
+_BINS_PER_DECADE = 100
+_MIN_DURATION    = 1e-7
+
+
+
+class _Durations:
+    # Count, total and histogram of the durations of a stage, of bounded size however many times
+    # it runs, as they are kept for the whole run and sent by workers for every file.
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.bins  = defaultdict(int)
+
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        self.bins[max(0, math.floor(math.log10(max(duration, _MIN_DURATION) / _MIN_DURATION) * _BINS_PER_DECADE))] += 1
+
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        for index, n in other.bins.items():
+            self.bins[index] += n
+
+
+    def percentile(self, q):
+        # Geometric middle of the bin holding the q-th percentile.
+        rank, cumulated = q / 100 * self.count, 0
+        for index in sorted(self.bins):
+            cumulated += self.bins[index]
+            if cumulated >= rank:
+                break
+        return _MIN_DURATION * 10 ** ((index + 0.5) / _BINS_PER_DECADE)
+
+
+
+# Timers and counters are no-ops until start() is called, so that instrumented code costs nothing
+# in normal runs.
+_enabled   = False
+_lock      = threading.Lock()
+_durations = defaultdict(_Durations)
+_counters  = defaultdict(int)
+
+
+
+def add_arguments(parser):
+    parser.add_argument('--profile',
+                        default = None,
+                        help = 'Path of a report of the time spent in each stage, with throughput, median and 95th percentile latencies, counters such as bytes read and written, and peak memory. Written as JSON, or as CSV if the path ends with .csv.')
+
+    parser.add_argument('--cprofile',
+                        default = None,
+                        help = 'Path where to dump cProfile statistics of the main process, readable with pstats or snakeviz.')
+
+
+
+def start(report_path, cprofile_path = None):
+    # Enables timers and counters, and writes the report and cProfile statistics when the script
+    # exits, whether it completed, failed or was interrupted.
+    if report_path is None and cprofile_path is None:
+        return
+
+    enable()
+    start_time = time.perf_counter()
+
+    profiler = None
+    if cprofile_path is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    def finish():
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(cprofile_path)
+        if report_path is not None:
+            write_report(report_path, time.perf_counter() - start_time)
+
+    atexit.register(finish)
+
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+
+def is_enabled():
+    return _enabled
+
+
+
+@contextlib.contextmanager
+def stage(name):
+    if not _enabled:
+        yield
+        return
+
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start_time
+        with _lock:
+            _durations[name].add(duration)
+
+
+
+def count(name, n = 1):
+    if _enabled:
+        with _lock:
+            _counters[name] += n
+
+
+
+def drain():
+    # Returns and resets the metrics recorded so far, e.g. to send them from a worker process to
+    # the main process, which adds them to its own with merge().
+    with _lock:
+        metrics = (dict(_durations), dict(_counters))
+        _durations.clear()
+        _counters.clear()
+    return metrics
+
+
+
+def merge(metrics):
+    durations, counters = metrics
+    with _lock:
+        for name, values in durations.items():
+            _durations[name].merge(values)
+        for name, n in counters.items():
+            _counters[name] += n
+
+
+
+def report(wall_time):
+    with _lock:
+        durations, counters = dict(_durations), dict(_counters)
+
+    stages = {}
+    for name, values in sorted(durations.items()):
+        stages[name] = {'count'     : values.count,
+                        'total_s'   : values.total,
+                        'per_second': values.count / values.total if values.total > 0 else None,
+                        'p50_ms'    : values.percentile(50) * 1000,
+                        'p95_ms'    : values.percentile(95) * 1000}
+
+    return {'wall_time_s' : wall_time,
+            'peak_rss_mb' : _peak_rss_mb(),
+            'stages'      : stages,
+            'counters'    : dict(sorted(counters.items()))}
+
+
+
+def write_report(path, wall_time):
+    metrics = report(wall_time)
+
+    if str(path).lower().endswith('.csv'):
+        with open(path, 'w', newline = '') as file:
+            csv_writer = csv.writer(file)
+            csv_writer.writerow(['name', 'count', 'total_s', 'per_second', 'p50_ms', 'p95_ms'])
+            for name, stats in metrics['stages'].items():
+                csv_writer.writerow([name, *stats.values()])
+            for name, n in metrics['counters'].items():
+                csv_writer.writerow([name, n, '', '', '', ''])
+            csv_writer.writerow(['wall_time_s', '', metrics['wall_time_s'], '', '', ''])
+            csv_writer.writerow(['peak_rss_mb', metrics['peak_rss_mb'], '', '', '', ''])
+    else:
+        with open(path, 'w') as file:
+            json.dump(metrics, file, indent = 4)
+
+    print(f'Profiling report written to {path}.')
+
+
+
+def _peak_rss_mb():
+    # Peak resident memory of this process and of its largest child, e.g. a decode worker.
+    if resource is None:
+        return None
+
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere.
+    unit = 1 if sys.platform == 'darwin' else 1024
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return peak * unit / 2 ** 20
\ No newline at end of file
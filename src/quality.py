@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+import cv2
+import numpy as np
+
+
+# Scores of each face, stored as columns of the face metadata.
+COLUMNS = ['sharpness', 'brightness', 'contrast', 'eye_distance', 'yaw']
+
+# Crops are scored at this size in grayscale, so that scores of small and large faces compare.
+_SCORE_SIZE = 64
+
+# Quality thresholds, as (argument, face metadata column, whether faces scoring below it are
+# rejected rather than above it).
+_THRESHOLDS = [('min_sharpness'   , 'sharpness'   , True),
+               ('min_eye_distance', 'eye_distance', True),
+               ('max_yaw'         , 'yaw'         , False),
+               ('min_brightness'  , 'brightness'  , True),
+               ('max_brightness'  , 'brightness'  , False),
+               ('min_contrast'    , 'contrast'    , True)]
+
+
+
+def add_arguments(parser):
+    parser.add_argument('--min_sharpness',
+                        type = float,
+                        default = None,
+                        help = f'Faces whose variance of the Laplacian, computed on the face resized to {_SCORE_SIZE}x{_SCORE_SIZE} pixels in grayscale, is below this are skipped as blurry. Values around 50 reject clearly blurred faces.')
+
+    parser.add_argument('--min_eye_distance',
+                        type = float,
+                        default = None,
+                        help = 'Faces whose eyes are closer than this many pixels in their image are skipped as too small to be recognised, e.g. 15.')
+
+    parser.add_argument('--max_yaw',
+                        type = float,
+                        default = None,
+                        help = 'Faces turned sideways by more than this many degrees, as estimated from the position of the eyes in the detected box, are skipped, e.g. 60 for profiles.')
+
+    parser.add_argument('--min_brightness',
+                        type = float,
+                        default = None,
+                        help = 'Faces whose mean gray level (0 to 255) is below this are skipped as underexposed, e.g. 30.')
+
+    parser.add_argument('--max_brightness',
+                        type = float,
+                        default = None,
+                        help = 'Faces whose mean gray level (0 to 255) is above this are skipped as overexposed, e.g. 225.')
+
+    parser.add_argument('--min_contrast',
+                        type = float,
+                        default = None,
+                        help = 'Faces whose standard deviation of gray levels is below this are skipped as washed out, e.g. 15.')
+
+
+
+def thresholds(args):
+    # The thresholds set in the parsed arguments, by argument name.
+    return {name: getattr(args, name) for name, _, _ in _THRESHOLDS if getattr(args, name) is not None}
+
+
+
+def score_faces(faces, boxes, eyes):
+    # Scores the crops of a batch of faces at once, boxes being their (x, y, w, h) in their image
+    # and eyes the (x, y) positions of both eyes in the image, or None when the detector gives
+    # none. Returns a dict of arrays by face metadata column. Scores which cannot be computed are
+    # NaN.
+    n_faces = len(faces)
+    if not n_faces:
+        return {name: np.empty(0, dtype = np.float32) for name in COLUMNS}
+
+    gray = np.stack([cv2.resize(cv2.cvtColor(face, cv2.COLOR_BGR2GRAY), (_SCORE_SIZE, _SCORE_SIZE), interpolation = cv2.INTER_AREA)
+                     for face in faces]).astype(np.float32)
+
+    # Laplacian of every crop at once, from the 4-neighbourhood of each inner pixel.
+    laplacian = (gray[:, :-2, 1:-1] + gray[:, 2:, 1:-1] + gray[:, 1:-1, :-2] + gray[:, 1:-1, 2:]) - 4 * gray[:, 1:-1, 1:-1]
+
+    boxes = np.asarray(boxes, dtype = np.float32).reshape(n_faces, 4)
+    eyes  = np.array([np.ravel(face_eyes) if face_eyes is not None else [np.nan] * 4 for face_eyes in eyes], dtype = np.float32).reshape(n_faces, 4)
+
+    # Turning the head moves the eyes towards one side of the box: the offset of their midpoint
+    # from the centre of the box, relative to half its width, is about the sine of the yaw.
+    eyes_center = (eyes[:, 0] + eyes[:, 2]) / 2
+    box_center  = boxes[:, 0] + boxes[:, 2] / 2
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        offset = np.abs(eyes_center - box_center) / (boxes[:, 2] / 2)
+
+    return {'sharpness'   : laplacian.var(axis = (1, 2)),
+            'brightness'  : gray.mean(axis = (1, 2)),
+            'contrast'    : gray.std(axis = (1, 2)),
+            'eye_distance': np.hypot(eyes[:, 2] - eyes[:, 0], eyes[:, 3] - eyes[:, 1]),
+            'yaw'         : np.degrees(np.arcsin(np.minimum(offset, 1)))}
+
+
+
+def failed_thresholds(scores, thresholds):
+    # Returns, for each threshold, which faces fail it, scores being arrays (or DataFrame columns)
+    # by face metadata column. Faces whose score is unknown pass, e.g. those extracted by a
+    # previous version.
+    failed = {}
+    for name, column, is_minimum in _THRESHOLDS:
+        if name in thresholds and column in scores:
+            values = np.asarray(scores[column], dtype = np.float32)
+            failed[name] = values < thresholds[name] if is_minimum else values > thresholds[name]
+    return failed
+
+
+
+def rejected(failed, n_faces):
+    # Faces failing any threshold.
+    return np.logical_or.reduce(list(failed.values())) if failed else np.zeros(n_faces, dtype = bool)
+
+
+
+def rejected_ids(faces, thresholds):
+    # Returns the ids of the faces of a face metadata DataFrame failing any threshold, and those
+    # failing each threshold. Rows of near-duplicates reusing a face have no scores, so the face
+    # is rejected by the row of its own image.
+    ids        = faces['id'].to_numpy()
+    failed_ids = {name: np.unique(ids[mask]) for name, mask in failed_thresholds(faces, thresholds).items()}
+    return np.unique(np.concatenate([np.empty(0, dtype = ids.dtype), *failed_ids.values()])), failed_ids
+
+
+
+def count_rejected(ids, rejected, failed_ids):
+    # The number of ids rejected, and failing each threshold, for the reports.
+    return int(np.isin(ids, rejected).sum()), {name: int(np.isin(ids, name_ids).sum()) for name, name_ids in failed_ids.items()}
+
+
+
+def report(failed_counts, n_rejected, n_faces, skipped_work):
+    # A line summarizing the faces rejected, failed_counts being the number of faces failing each
+    # threshold. Faces can fail several thresholds.
+    if not n_faces:
+        return 'No face to check against the quality thresholds.'
+
+    reasons = ', '.join(f'{count} by --{name}' for name, count in failed_counts.items() if count)
+    return (f'{n_rejected} of {n_faces} faces ({n_rejected / n_faces:.1%}) were below the quality thresholds and not {skipped_work}'
+            + (f' ({reasons}).' if reasons else '.'))
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+
+# Constants is imported first so that it sets up the environment variables.
+import constants
+
+import csv
+import pathlib
+import argparse
+
+import numpy as np
+
+import ann_index
+import array_store
+import copy_photos_person
+import crop_store
+import detection
+import embedding
+import face_store
+import image_io
+import model_client
+import profiling
+import utils
+
+
+
+def main():
+    args = parse_args()
+    profiling.start(args.profile, args.cprofile)
+    model_client.connect(args.model_server)
+
+    faces_csv_path       = args.work_dir / constants.FACES_CSV_FILENAME
+    face_store_dir       = args.work_dir / constants.FACE_METADATA_DIRNAME
+    cropped_faces_dir    = args.work_dir / constants.CROPPED_FACES_DIRNAME
+    embeddings_file_path = args.work_dir / constants.EMBEDDINGS_FILENAME
+    embedding_ids_path   = args.work_dir / constants.EMBEDDING_IDS_FILENAME
+    settings_path        = args.work_dir / constants.SETTINGS_FILENAME
+    search_index_dir     = args.work_dir / constants.SEARCH_INDEX_DIRNAME
+
+    # Reference faces are detected and embedded as the faces of the work directory were, unless
+    # overridden.
+    settings = {'detector_name': 'retinaface', 'min_confidence': 0.9, 'min_size': 50, 'align_output_faces': False,
+                'model': 'Facenet', 'normalization': 'Facenet', **utils.load_settings(settings_path)}
+    settings.update({key: value for key, value in vars(args).items() if key in settings and value is not None})
+
+    print('Embedding reference faces...')
+    references = embed_references(args.references, settings)
+    if not len(references):
+        raise SystemExit('No face was found in the reference photos!')
+
+    ids, embeddings = array_store.open_embeddings(embeddings_file_path, embedding_ids_path)
+    threshold = args.threshold if args.threshold is not None else _default_threshold(settings['model'], args.metric)
+
+    with ann_index.IVFIndex(search_index_dir, args.metric) as index:
+        with utils.print_duration('Updating the search index'):
+            n_added = index.sync(ids, embeddings)
+        if n_added:
+            print(f'{n_added} embeddings added to the search index.')
+
+        with utils.print_duration('Searching'):
+            results = index.search(references, embeddings, args.top_k, args.n_probe, threshold)
+
+    # A face matching several references keeps its smallest distance.
+    distances = {}
+    for face_id, distance in (match for matches in results for match in matches):
+        distances[face_id] = min(distance, distances.get(face_id, np.inf))
+    matches = sorted(distances.items(), key = lambda match: match[1])
+
+    face_paths = face_store.source_paths(face_store_dir, [face_id for face_id, _ in matches], faces_csv_path)
+
+    print(f'{len(matches)} faces within a {args.metric} distance of {threshold:.3f}:')
+    for rank, ((face_id, distance), paths) in enumerate(zip(matches, face_paths), 1):
+        if rank > args.show:
+            print('...')
+            break
+        print(f'{rank:>5} {face_id:>8} {distance:>8.3f}  {", ".join(map(str, paths))}')
+
+    if args.output_dir is not None:
+        export_matches(args.output_dir, matches, face_paths, cropped_faces_dir, args.mode, args.workers, args.export_faces)
+        print(f'Matching images copied to {args.output_dir}.')
+
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description = "This script finds the faces of a person in the work directory from one or more reference photos of them, without clustering, and optionally copies the images they were found in.",
+                                     formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-w', '--work_dir',
+                        required = True,
+                        type = pathlib.Path,
+                        help = 'Output directory from steps extract_faces and make_embeddings.')
+
+    parser.add_argument('-r', '--references',
+                        required = True,
+                        nargs = '+',
+                        type = pathlib.Path,
+                        help = 'Photos of the person to find, or directories of such photos. Only the largest face of each photo is used.')
+
+    parser.add_argument('-o', '--output_dir',
+                        default = None,
+                        type = pathlib.Path,
+                        help = f'Directory in which to copy the images containing a matching face, with a "{constants.SEARCH_RESULTS_FILENAME}" listing the matches. By default, matches are only printed.')
+
+    parser.add_argument('-t', '--threshold',
+                        type = float,
+                        default = None,
+                        help = 'Largest distance between a reference and a matching face. Defaults to the threshold DeepFace.verify uses for the model and metric.')
+
+    parser.add_argument('--metric',
+                        choices = ann_index.METRICS,
+                        default = 'cosine',
+                        help = 'Distance between embeddings. The search index is built again when it changes.')
+
+    parser.add_argument('-k', '--top_k',
+                        type = int,
+                        default = 1000,
+                        help = 'Maximum number of matching faces per reference photo.')
+
+    parser.add_argument('--n_probe',
+                        type = int,
+                        default = 8,
+                        help = 'Number of lists of the search index compared with each reference. Higher values find more of the matching faces at the cost of speed.')
+
+    parser.add_argument('--show',
+                        type = int,
+                        default = 20,
+                        help = 'Number of best matches printed.')
+
+    parser.add_argument('-m', '--mode',
+                        choices = ['copy', 'hardlink', 'reflink', 'symlink'],
+                        default = 'copy',
+                        help = 'How matching images are placed into the output directory.')
+
+    parser.add_argument('-j', '--workers',
+                        type = int,
+                        default = 8,
+                        help = 'Number of threads copying images.')
+
+    parser.add_argument('--export_faces',
+                        action = argparse.BooleanOptionalAction,
+                        default = False,
+                        help = 'Whether or not to also export the matching faces into a "Faces" subdirectory of the output directory.')
+
+    detector_settings = parser.add_argument_group('detection and embedding', 'By default, the settings the work directory was created with.')
+
+    detector_settings.add_argument('-d', '--detector',
+                                   default = None,
+                                   dest = 'detector_name',
+                                   help = 'The name of the detector used to detect faces in the reference photos.')
+
+    detector_settings.add_argument('--min_confidence',
+                                   type = float,
+                                   default = None,
+                                   help = 'Minimum confidence score to accept a face detection as valid.')
+
+    detector_settings.add_argument('--model',
+                                   default = None,
+                                   help = 'The name of the model used to create embeddings. Must be the one of the embeddings of the work directory.')
+
+    detector_settings.add_argument('--normalization',
+                                   default = None,
+                                   help = 'The normalization applied to faces before they are embedded.')
+
+    model_client.add_arguments(parser)
+    profiling.add_arguments(parser)
+
+    args = parser.parse_args()
+
+    return args
+
+
+
+def embed_references(reference_paths, settings):
+    # Returns the embedding of the largest face of each reference photo.
+    faces = []
+    for reference_path in reference_paths:
+        paths = utils.iter_files(reference_path) if reference_path.is_dir() else [reference_path]
+        for path in paths:
+            for _, image in image_io.iter_file_images(path, False, 0):
+                detected = detection.detect_faces(image, settings['detector_name'], settings['align_output_faces'],
+                                                  settings['min_confidence'], settings['min_size'])
+                if not detected:
+                    print(f'No face found in {path}.')
+                    continue
+                if len(detected) > 1:
+                    print(f'{len(detected)} faces found in {path}, using the largest.')
+
+                face, *_ = max(detected, key = lambda detected_face: detected_face[1][2] * detected_face[1][3])
+                faces.append(face)
+
+    if not faces:
+        return np.empty((0, 0), dtype = np.float32)
+
+    embedder = embedding.FaceEmbedder(settings['model'], settings['normalization'])
+    return embedder.embed([embedder.preprocess(face) for face in faces])
+
+
+
+def export_matches(output_dir, matches, face_paths, cropped_faces_dir, mode, n_workers, export_faces):
+    output_dir.mkdir(parents = True, exist_ok = True)
+
+    with open(output_dir / constants.SEARCH_RESULTS_FILENAME, 'w', newline = '', encoding = 'utf-8', errors = 'surrogateescape') as file:
+        csv_writer = csv.writer(file)
+        csv_writer.writerow(['rank', 'id', 'distance', 'image_path'])
+        for rank, ((face_id, distance), paths) in enumerate(zip(matches, face_paths), 1):
+            csv_writer.writerows([rank, face_id, f'{distance:.4f}', path] for path in paths)
+
+    # Images are listed once, in the order of their best match.
+    images = list(dict.fromkeys(pathlib.Path(path) for paths in face_paths for path in paths))
+    copy_photos_person.copy_images({output_dir: images}, mode, False, n_workers)
+
+    if export_faces:
+        patch_ids = [face_id for face_id, _ in matches]
+        with crop_store.open_reader(cropped_faces_dir) as crop_reader:
+            crop_store.export_faces(crop_reader, output_dir, patch_ids, ['Faces'] * len(patch_ids), mode, n_workers)
+
+
+
+def _default_threshold(model, metric):
+    # The distance DeepFace.verify accepts for the model and metric. Imported here, as it loads
+    # Tensorflow, which is not needed when a threshold is given and a model server is used.
+    from deepface.modules import verification
+    return verification.find_threshold(model, metric)
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+import itertools
+import concurrent.futures
+
+import numpy as np
+import pandas as pd
+import hdbscan
+from hdbscan._hdbscan_tree import condense_tree, compute_stability, get_clusters
+from sklearn import metrics
+
+
+_SCORES = {'adjusted_mutual_info': metrics.adjusted_mutual_info_score,
+           'adjusted_rand'       : metrics.adjusted_rand_score,
+           'homogeneity'         : metrics.homogeneity_score,
+           'completeness'        : metrics.completeness_score,
+           'v_measure'           : metrics.v_measure_score,
+           'fowlkes_mallows'     : metrics.fowlkes_mallows_score}
+
+
+# Set in each worker process by _init_worker, so that the data is only sent once per process.
+_worker_data = None
+
+
+
+def _init_worker(data):
+    global _worker_data
+    _worker_data = data
+
+
+
+def _single_linkage_tree(min_samples, hdbscan_kwargs):
+    # Core distances and the minimum spanning tree only depend on min_samples (and the metric),
+    # the other hyperparameters only act on the condensed tree derived from this hierarchy.
+    clusterer = hdbscan.HDBSCAN(**{**hdbscan_kwargs, 'min_samples': min_samples})
+    clusterer.fit(_worker_data)
+    return clusterer.single_linkage_tree_.to_numpy()
+
+
+
+def _select_clusters(single_linkage_tree, min_cluster_size, selections, truth_rows, truth_labels):
+    # Condenses the tree once for min_cluster_size, then selects clusters for each (method, epsilon)
+    # pair. Returns one result row per pair.
+    condensed_tree = condense_tree(single_linkage_tree, min_cluster_size)
+    stability      = compute_stability(condensed_tree)
+
+    results = []
+    for cluster_selection_method, cluster_selection_epsilon in selections:
+        # get_clusters updates the stabilities it is given.
+        labels, _, _ = get_clusters(condensed_tree, dict(stability),
+                                    cluster_selection_method  = cluster_selection_method,
+                                    cluster_selection_epsilon = cluster_selection_epsilon)
+
+        result = {'min_cluster_size'         : min_cluster_size,
+                  'cluster_selection_method' : cluster_selection_method,
+                  'cluster_selection_epsilon': cluster_selection_epsilon,
+                  'n_clusters'               : int(labels.max()) + 1,
+                  'noise_fraction'           : float(np.mean(labels == -1))}
+        if truth_rows is not None:
+            result.update({name: score(truth_labels, labels[truth_rows]) for name, score in _SCORES.items()})
+        results.append(result)
+
+    return results
+
+
+
+def run_sweep(data, patch_ids, hdbscan_kwargs, min_samples_values, min_cluster_size_values,
+              cluster_selection_epsilon_values, cluster_selection_method_values, ground_truth, n_workers):
+    # Evaluates HDBSCAN on every combination of the given hyperparameters, building the hierarchy
+    # once per min_samples value and condensing it once per min_cluster_size value. If ground_truth
+    # (a DataFrame of face ids and labels) is given, each combination is scored against it.
+    # Returns a DataFrame with one row per combination.
+    truth_rows, truth_labels = None, None
+    if ground_truth is not None:
+        rows_by_id   = pd.Series(np.arange(len(patch_ids)), index = patch_ids)
+        ground_truth = ground_truth[ground_truth.id.isin(rows_by_id.index)]
+        truth_rows   = rows_by_id[ground_truth.id].to_numpy()
+        truth_labels = ground_truth.label.to_numpy()
+        print(f'Scoring against {len(ground_truth)} labelled faces.')
+
+    selections = list(itertools.product(cluster_selection_method_values, cluster_selection_epsilon_values))
+
+    with concurrent.futures.ProcessPoolExecutor(n_workers, initializer = _init_worker, initargs = (data,)) as executor:
+        trees = dict(zip(min_samples_values, executor.map(_single_linkage_tree, min_samples_values, itertools.repeat(hdbscan_kwargs))))
+
+        futures = {executor.submit(_select_clusters, trees[min_samples], min_cluster_size, selections, truth_rows, truth_labels): min_samples
+                   for min_samples, min_cluster_size in itertools.product(min_samples_values, min_cluster_size_values)}
+
+        results = []
+        for future in concurrent.futures.as_completed(futures):
+            results += [{'min_samples': futures[future], **result} for result in future.result()]
+
+    results = pd.DataFrame(results)
+    sort_by = ['adjusted_mutual_info'] if ground_truth is not None else ['min_samples', 'min_cluster_size']
+    return results.sort_values(sort_by, ascending = ground_truth is None, ignore_index = True)
\ No newline at end of file
@@ -1,9 +1,31 @@
 # -*- coding: utf-8 -*-
 
-from distutils.util import strtobool
+import os
+import json
+import time
+import errno
+import shutil
+import hashlib
+import pathlib
+import contextlib
+import concurrent.futures
 
 import pandas as pd
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import profiling
+
+
+# ioctl request cloning a file on Linux filesystems with copy-on-write support (Btrfs, XFS, ...).
+_FICLONE = 0x40049409
+
+# Errors of os.link meaning that hardlinks are not possible here, rather than that the files are wrong.
+_LINK_UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.EMLINK}
+
 
 
 def load_csv(path):
@@ -21,17 +43,170 @@ def load_csv(path):
 
 
 
+def load_settings(path):
+    # Settings the steps of the pipeline were run with, e.g. so that search.py detects and embeds
+    # faces the same way as they were for the work directory.
+    if not path.is_file():
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+
+
+def update_settings(path, **settings):
+    settings = {**load_settings(path), **settings}
+    tmp_path = path.with_suffix('.tmp')
+    with open(tmp_path, 'w') as file:
+        json.dump(settings, file, indent = 4)
+    os.replace(tmp_path, path)
+
+
+
+# Answers accepted by user_query_yes_no, as by distutils.util.strtobool, which was removed from
+# Python 3.12 and took longer to import than anything else in this module.
+_YES_ANSWERS = {'y', 'yes', 't', 'true', 'on', '1'}
+_NO_ANSWERS  = {'n', 'no', 'f', 'false', 'off', '0'}
+
+
+
 def user_query_yes_no(question):
     print(f'{question} [y/n]')
     while True:
-        try:
-            return strtobool(input().lower())
-        except ValueError:
-            print("Please respond with 'y' or 'n'.")
+        answer = input().strip().lower()
+        if answer in _YES_ANSWERS or answer in _NO_ANSWERS:
+            return answer in _YES_ANSWERS
+        print("Please respond with 'y' or 'n'.")
 
 
 
 def iter_files(dir_path):
-    for file_path in dir_path.glob("**/*"):
-        if file_path.is_file():
-            yield file_path
\ No newline at end of file
+    for path, _, _ in scan_files(dir_path):
+        yield pathlib.Path(path)
+
+
+
+def scan_files(dir_path, n_workers = 0):
+    # Returns (path, size, mtime_ns) for every file below dir_path, sorted by path. Directories
+    # are listed with os.scandir, whose entries tell directories from files without a stat call,
+    # and are listed in parallel by n_workers threads if n_workers > 1, which hides the latency of
+    # network filesystems. Symlinks to directories are not followed, so that loops are impossible.
+    files = []
+
+    if n_workers <= 1:
+        pending = [str(dir_path)]
+        while pending:
+            dir_files, subdirs = _scan_dir(pending.pop())
+            files   += dir_files
+            pending += subdirs
+
+    else:
+        with concurrent.futures.ThreadPoolExecutor(n_workers) as executor:
+            pending = {executor.submit(_scan_dir, str(dir_path))}
+            while pending:
+                done, pending = concurrent.futures.wait(pending, return_when = concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    dir_files, subdirs = future.result()
+                    files   += dir_files
+                    pending |= {executor.submit(_scan_dir, subdir) for subdir in subdirs}
+
+    files.sort()
+    return files
+
+
+
+def _scan_dir(dir_path):
+    files, subdirs = [], []
+
+    try:
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks = False):
+                        subdirs.append(entry.path)
+                    elif entry.is_file():
+                        stat = entry.stat()
+                        files.append((entry.path, stat.st_size, stat.st_mtime_ns))
+                except OSError:
+                    continue
+    except OSError:
+        pass
+
+    return files, subdirs
+
+
+
+def hash_file(path, chunk_size = 1 << 20):
+    hasher = hashlib.blake2b(digest_size = 16)
+    with open(path, 'rb') as file:
+        while chunk := file.read(chunk_size):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+
+@contextlib.contextmanager
+def print_duration(description):
+    # The duration is also recorded as a stage of the profiling report.
+    start = time.perf_counter()
+    with profiling.stage(description):
+        yield
+    print(f'{description} took {time.perf_counter() - start:.2f} s.')
+
+
+
+
+def link_file(source, destination, mode):
+    # Creates destination as a hardlink, symlink, reflink or copy of source. Hardlinks and reflinks
+    # fall back to a copy where the filesystem does not support them. Symlinks are absolute so
+    # that they can be moved around. An existing destination, e.g. from a previous export or a face
+    # placed by cluster.py, is kept if it already is source and replaced otherwise. The new file is
+    # created under a temporary name first, so that a symlink there is replaced, not written through.
+    if not os.path.lexists(destination):
+        _link_file(source, destination, mode)
+        return
+
+    if os.path.exists(destination) and os.path.samefile(source, destination):
+        return
+
+    temporary = f'{destination}.{os.getpid()}.tmp'
+    try:
+        _link_file(source, temporary, mode)
+        os.replace(temporary, destination)
+    finally:
+        if os.path.lexists(temporary):
+            os.remove(temporary)
+
+
+
+def _link_file(source, destination, mode):
+    if mode == 'symlink':
+        if not os.path.isfile(source):
+            raise FileNotFoundError(errno.ENOENT, 'No such file', str(source))
+        os.symlink(os.path.abspath(source), destination)
+        return
+
+    if mode == 'hardlink':
+        try:
+            os.link(source, destination)
+            return
+        except OSError as error:
+            if error.errno not in _LINK_UNSUPPORTED_ERRNOS:
+                raise
+
+    elif mode == 'reflink' and _reflink(source, destination):
+        return
+
+    shutil.copy(source, destination)
+
+
+
+def _reflink(source, destination):
+    if fcntl is None:
+        return False
+
+    with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+        try:
+            fcntl.ioctl(destination_file.fileno(), _FICLONE, source_file.fileno())
+            return True
+        except OSError:
+            return False